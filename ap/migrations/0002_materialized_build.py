@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ap', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflowsmethods',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='application',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='attribute',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='attributeinamethod',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='attributetype',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='ksgroup',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='ksrole',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='ksuser',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='permissionstatement',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='widget',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='attributegroup',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='workflowmethod',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='applicationstructurenodesearch',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='attributeinasearch',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='modelmetadatasearch',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+    ]
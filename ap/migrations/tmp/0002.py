@@ -9,6 +9,7 @@ from __future__ import unicode_literals
 from django.db import migrations
 
 from knowledge_server.models import KnowledgeServer, DataSet, DataSetStructure, Workflow
+from knowledge_server.models import DataMigration
 
 
 def forwards_func(apps, schema_editor):
@@ -100,12 +101,12 @@ def forwards_func(apps, schema_editor):
 class Migration(migrations.Migration):
 
     dependencies = [
-        ('ap', '0001_initial'),
+        ('ap', '0003_content_hash'),
     ]
 
     operations = [
         migrations.RunPython(
-            forwards_func,
+            DataMigration.after_migrate(forwards_func),
         ),
     ]
 
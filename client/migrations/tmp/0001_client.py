@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 
 from django.db import models, migrations
 from knowledge_server.models import Organization, KnowledgeServer, DataSet, DataSetStructure, StructureNode, ModelMetadata
+from knowledge_server.models import DataMigration
 
 def forwards_func(apps, schema_editor):
     org_ks={
@@ -26,7 +27,7 @@ class Migration(migrations.Migration):
 
     operations = [
         migrations.RunPython(
-            forwards_func,
+            DataMigration.after_migrate(forwards_func),
         ),
     ]
 
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Subject to the terms of the GNU AFFERO GENERAL PUBLIC LICENSE, v. 3.0. If a copy of the AGPL was not
+# distributed with this file, You can obtain one at http://www.gnu.org/licenses/agpl.txt
+#
+# Author: Davide Galletti                davide   ( at )   c4k.it
+
+'''
+The UKCL of an instance contains its id, so it could be generated only after the INSERT and the
+instance had to be saved again (see model_post_save). Here the primary keys of the ShareableModels
+are allocated before the INSERT (HiLo): a process reserves a block of ids at a time on a row of
+Generation named "pk <db_table>" and then hands them out without querying the database.
+Blocks are reserved with a connection of their own, committed at once, so a block is never given
+twice even if the transaction that asked for it is rolled back (those ids are just not used).
+Once a table is allocated this way its rows must not get an id from AUTO_INCREMENT: MySQL moves it
+past the highest id inserted, which is in a block of this process, so the database would hand out ids
+in the block of another one; hence when a block can't be reserved the error is raised.
+The connections are closed like Django's: at the end of a request if they are obsolete (CONN_MAX_AGE)
+and when the thread that opened them exits.
+'''
+
+import logging
+import threading
+import weakref
+
+from django.core import signals
+from django.db import connections
+from django.db.models import AutoField
+
+import knowledge_server.models
+
+logger = logging.getLogger(__name__)
+
+
+class PkAllocator():
+    block_size = 100
+    # ( db_alias, db_table ) -> [ next id, last id of the block ]
+    _blocks = {}
+    _lock = threading.Lock( )
+    # a connection for each database alias, for each thread
+    _local = threading.local( )
+
+    @staticmethod
+    def usable(model, db_alias):
+        '''
+        the pk must be an AutoField (not the pointer to the parent in multi table inheritance); a second
+        connection to an in memory sqlite database would be a different database
+        '''
+        return isinstance( model._meta.pk, AutoField ) and connections[ db_alias ].vendor != 'sqlite'
+
+    @staticmethod
+    def assign(instances, db_alias):
+        '''
+        it sets the pk of the instances (all of the same class, without pk); False if the class is not usable
+        and the database will assign them when inserting as usual; if a block can't be reserved it raises
+        (see the module documentation)
+        '''
+        if len( instances ) == 0:
+            return True
+        model = instances[ 0 ].__class__
+        if not PkAllocator.usable( model, db_alias ):
+            return False
+        try:
+            ids = PkAllocator.reserve( model, db_alias, len( instances ) )
+        except Exception as ex:
+            logger.error( "PkAllocator.assign " + model.__name__ + ": " + str( ex ) )
+            raise ex
+        for instance, pk in zip( instances, ids ):
+            instance.pk = pk
+        return True
+
+    @staticmethod
+    def reserve(model, db_alias, count):
+        '''
+        count ids for model on db_alias; _lock is held only while the ids are taken from the block in memory,
+        not while a new block is reserved on the database
+        '''
+        key = ( db_alias, model._meta.db_table )
+        ids = [ ]
+        while len( ids ) < count:
+            with PkAllocator._lock:
+                block = PkAllocator._blocks.get( key )
+                if block is not None and block[ 0 ] <= block[ 1 ]:
+                    PkAllocator.take( block, ids, count )
+                    continue
+            size = max( PkAllocator.block_size, count - len( ids ) )
+            last = PkAllocator.reserve_block( model, db_alias, size )
+            new_block = [ last - size + 1, last ]
+            with PkAllocator._lock:
+                PkAllocator.take( new_block, ids, count )
+                block = PkAllocator._blocks.get( key )
+                # another thread might have reserved a block at the same time; the one left in memory is used first
+                # and the ids remaining in the other one are not used
+                if block is None or block[ 0 ] > block[ 1 ]:
+                    PkAllocator._blocks[ key ] = new_block
+        return ids
+
+    @staticmethod
+    def take(block, ids, count):
+        '''
+        it moves ids from block (that is not empty) to ids, up to count; to be invoked holding _lock
+        '''
+        taken = min( count - len( ids ), block[ 1 ] - block[ 0 ] + 1 )
+        ids.extend( range( block[ 0 ], block[ 0 ] + taken ) )
+        block[ 0 ] += taken
+
+    @staticmethod
+    def connection(db_alias):
+        '''
+        a connection to the same database as db_alias, in autocommit, outside of any transaction of the caller
+        '''
+        if not hasattr( PkAllocator._local, "connections" ):
+            PkAllocator._local.connections = {}
+            # closed when the thread is gone
+            weakref.finalize( threading.current_thread( ), PkAllocator.close_all, PkAllocator._local.connections )
+        if not db_alias in PkAllocator._local.connections:
+            wrapper = connections[ db_alias ]
+            PkAllocator._local.connections[ db_alias ] = wrapper.__class__( dict( wrapper.settings_dict ),
+                                                                           db_alias + "_pk_allocator" )
+        return PkAllocator._local.connections[ db_alias ]
+
+    @staticmethod
+    def reserve_block(model, db_alias, size):
+        '''
+        it returns the last id of a block of size ids reserved for model on db_alias
+        the first block starts after the highest id in the table
+        '''
+        connection = PkAllocator.connection( db_alias )
+        generation_table = connection.ops.quote_name( knowledge_server.models.Generation._meta.db_table )
+        name = "pk " + model._meta.db_table
+        # a second attempt if another process has created the row at the same time
+        for attempt in range( 2 ):
+            connection.set_autocommit( False )
+            try:
+                with connection.cursor( ) as cursor:
+                    cursor.execute( "UPDATE " + generation_table + " SET value = value + %s WHERE name = %s",
+                                    [ size, name ] )
+                    if cursor.rowcount == 0:
+                        cursor.execute( "SELECT MAX(" + connection.ops.quote_name( model._meta.pk.column ) + ") FROM " +
+                                        connection.ops.quote_name( model._meta.db_table ) )
+                        max_pk = cursor.fetchone( )[ 0 ] or 0
+                        cursor.execute( "INSERT INTO " + generation_table + " (name, value) VALUES (%s, %s)",
+                                        [ name, max_pk + size ] )
+                    cursor.execute( "SELECT value FROM " + generation_table + " WHERE name = %s", [ name ] )
+                    last = cursor.fetchone( )[ 0 ]
+                connection.commit( )
+                return last
+            except Exception as ex:
+                connection.rollback( )
+                if attempt > 0:
+                    raise ex
+            finally:
+                connection.set_autocommit( True )
+
+    @staticmethod
+    def close_all(thread_connections):
+        '''
+        it closes the connections opened by a thread that has exited; it runs in whichever thread collects it
+        '''
+        for connection in thread_connections.values( ):
+            try:
+                connection.allow_thread_sharing = True
+                connection.close( )
+            except Exception as ex:
+                logger.warning( "PkAllocator.close_all: " + str( ex ) )
+        thread_connections.clear( )
+
+    @staticmethod
+    def close_old_connections(**kwargs):
+        '''
+        request_finished: like django.db.close_old_connections for the connections of this thread
+        '''
+        for connection in getattr( PkAllocator._local, "connections", {} ).values( ):
+            connection.close_if_unusable_or_obsolete( )
+
+    @staticmethod
+    def clear():
+        with PkAllocator._lock:
+            PkAllocator._blocks.clear( )
+
+
+signals.request_finished.connect( PkAllocator.close_old_connections )
@@ -4,6 +4,7 @@
 #
 # Author: Davide Galletti                davide   ( at )   c4k.it
 
+import itertools
 import logging
 import socket
 import urllib
@@ -11,7 +12,7 @@ import urllib
 from datetime import datetime
 from xml.dom import minidom
 
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render, render_to_response
 from django.template import RequestContext
 from django.views.decorators.cache import cache_page, never_cache
@@ -19,13 +20,56 @@ from django.views.decorators.csrf import csrf_exempt
 
 from knowledge_server.models import ApiResponse, DataSetStructure, DataSet, KnowledgeServer, SubscriptionToThis
 from knowledge_server.models import SubscriptionToOther, NotificationReceived
+from knowledge_server.artifacts import datasets_chunks, dataset_info_chunks, ExportArtifacts
+from knowledge_server.caches import cache_page_per_release, conditional_get, dataset_etag
+from knowledge_server.diff import DataSetDiff
 from knowledge_server.orm_wrapper import OrmWrapper
 from knowledge_server.utils import KsUrl
 
 logger = logging.getLogger(__name__)
 
 
-@cache_page(60 * 600)
+def failure_response(request, ar, ex):
+    '''
+    ar rendered as a failure with status 500 (which cache_page doesn't store)
+    '''
+    logger.error(request.get_full_path() + ": " + str(ex))
+    ar.status = ApiResponse.failure
+    ar.message = str(ex)
+    if ar.response_format == 'JSON':
+        return render(request, 'knowledge_server/export.json', {'json': ar.json()}, content_type="application/json", status=500)
+    return render(request, 'knowledge_server/export.xml', {'xml': ar.xml()}, content_type="application/xhtml+xml", status=500)
+
+
+def streamed_response(request, ar, content_chunks):
+    '''
+    The chunks are streamed but the first block (see ApiResponse.blocks) is rendered before the status
+    line is sent, so most exports fail with a proper failure response; an error after the first block
+    can only be logged and it ends the stream, which is marked as truncated so that it is not cached
+    (see caches.cached_in_artifacts)
+    '''
+    if ar.response_format == 'JSON':
+        blocks, content_type = ar.json_chunks(content_chunks), "application/json"
+    else:
+        blocks, content_type = ar.xml_chunks(content_chunks), "application/xhtml+xml"
+    try:
+        first_block = next(blocks, "")
+    except Exception as ex:
+        return failure_response(request, ar, ex)
+
+    def remaining_blocks():
+        try:
+            yield from blocks
+        except Exception as ex:
+            logger.error("streamed_response " + request.get_full_path() + " truncated: " + str(ex))
+            response.truncated = True
+
+    response = StreamingHttpResponse(itertools.chain([first_block], remaining_blocks()), content_type=content_type)
+    response.truncated = False
+    return response
+
+
+@cache_page_per_release(60 * 60 * 24 * 30)
 def api_ks_info(request):
     '''
         #80
@@ -44,7 +88,7 @@ def api_ks_info(request):
     return api_dataset(request, UKCL=dataset.UKCL)
 
 
-@cache_page(60 * 600)
+@cache_page_per_release(60 * 60 * 24 * 30)
 def api_dataset_view(request):
     '''
         it returns the data of the istance with pk=root_id in the dataset (which is a view)
@@ -67,21 +111,38 @@ def api_dataset_view(request):
     
     if ar.response_format == 'HTML' or ar.response_format == 'BROWSE':
         actual_instance_json = '{' + actual_instance.serialize(dataset.dataset_structure.root_node, export_format='json', exported_instances = []) + '}'
-    if ar.response_format == 'JSON':
-        ar.content = { "DataSet": dataset.export(export_format = 'DICT') }
-        ar.status = ApiResponse.success
-        return render(request, 'knowledge_server/export.json', {'json': ar.json()}, content_type="application/json")
-    if ar.response_format == 'XML':
+    if ar.response_format in ('JSON', 'XML'):
         ar.status = ApiResponse.success
-        ar.content = dataset.export(export_format = ar.response_format)
-        return render(request, 'knowledge_server/export.xml', {'xml': ar.xml()}, content_type="application/xhtml+xml")
+        return streamed_response(request, ar, datasets_chunks([dataset], ar.response_format, None))
     if ar.response_format == 'HTML' or ar.response_format == 'BROWSE':
         this_ks = KnowledgeServer.this_knowledge_server()
         cont = RequestContext(request, {'dataset': dataset, 'actual_instance': actual_instance, 'actual_instance_json': actual_instance_json, 'sn': dataset.dataset_structure.root_node, 'DataSet_UKCL': DataSet_UKCL, 'this_ks':this_ks, 'this_ks_encoded_url':this_ks.url(True)})
         return render_to_response('knowledge_server/browse_dataset.html', context_instance=cont)
 
 
+def dataset_validators(request, UKCL=None):
+    '''
+    ETag and Last-Modified of api_dataset; see conditional_get
+    '''
+    ar = ApiResponse(request=request)
+    if not ar.response_format in ('XML', 'JSON'):
+        return None, None
+    url = KsUrl(UKCL if UKCL else request.GET['UKCL'])
+    url.search_on_db()
+    if not url.actual_instance:
+        return None, None
+    if isinstance(url.actual_instance, DataSet):
+        dataset = url.actual_instance
+    else:
+        dataset = url.actual_instance.dataset_I_belong_to
+    if dataset is None:
+        return None, None
+    etag = dataset_etag(dataset, ar.response_format)
+    return etag, (dataset.version_date if etag else None)
+
+
 # @cache_page(60 * 600)
+@conditional_get(dataset_validators)
 def api_dataset(request, UKCL=None):
     '''
         #36
@@ -120,17 +181,18 @@ def api_dataset(request, UKCL=None):
             return render(request, 'knowledge_server/export.xml', {'xml': ar.xml()}, content_type="application/xhtml+xml")
 
     actual_instance_json = ""
+    # a released dataset has been rendered when released; see ExportArtifacts
+    if dataset.version_released and ar.response_format in (ExportArtifacts.XML, ExportArtifacts.JSON):
+        response = ExportArtifacts.response(dataset.UKCL, ar.response_format)
+        if response:
+            return response
     #this dataset is not a view; if not dataset.dataset_structure.is_a_view:
     actual_instance = dataset.root
 
-    if ar.response_format == 'JSON':
-        ar.content = { "DataSet": dataset.export(export_format = 'DICT') }
-        ar.status = ApiResponse.success
-        return render(request, 'knowledge_server/export.json', {'json': ar.json()}, content_type="application/json")
-    if ar.response_format == 'XML':
+    if ar.response_format in ('JSON', 'XML'):
         ar.status = ApiResponse.success
-        ar.content = dataset.export(export_format = ar.response_format)
-        return render(request, 'knowledge_server/export.xml', {'xml': ar.xml()}, content_type="application/xhtml+xml")
+        content = datasets_chunks([dataset], ar.response_format, None)
+        return streamed_response(request, ar, content)
     if ar.response_format == 'HTML' or ar.response_format == 'BROWSE':
         actual_instance_json = '{' + actual_instance.serialize(dataset.dataset_structure.root_node, export_format='json', exported_instances = []) + '}'
         this_ks = KnowledgeServer.this_knowledge_server()
@@ -138,6 +200,39 @@ def api_dataset(request, UKCL=None):
         return render_to_response('knowledge_server/browse_dataset.html', context_instance=cont)
         
 
+def catch_all_request(uri_instance):
+    '''
+    it returns ( uri_instance, response_format ) removing the trailing string for the response_format
+    '''
+    response_format = 'XML' #default
+    if uri_instance[-1:] == "/":
+        #I remove a trailing slash
+        uri_instance = uri_instance[:-1]
+    if uri_instance[-3:].lower() == "xml":
+        uri_instance = uri_instance[:-4]
+    if uri_instance[-4:].lower() == "json":
+        response_format = 'JSON'
+        uri_instance = uri_instance[:-5]
+    return uri_instance, response_format
+
+
+def catch_all_validators(request, uri_instance):
+    '''
+    ETag and Last-Modified of api_catch_all; see conditional_get
+    '''
+    uri_instance, response_format = catch_all_request(uri_instance)
+    split_path = uri_instance.split('/')
+    if len(split_path) != 3:
+        return None, None
+    this_ks = KnowledgeServer.this_knowledge_server()
+    actual_class = OrmWrapper.load_class(this_ks.netloc, split_path[0], split_path[1])
+    instance = actual_class.retrieve_locally(this_ks.url() + "/" + uri_instance)
+    dataset = instance if isinstance(instance, DataSet) else instance.dataset_I_belong_to
+    etag = dataset_etag(dataset, response_format, instance.UKCL)
+    return etag, (dataset.version_date if etag else None)
+
+
+@conditional_get(catch_all_validators)
 @cache_page(60 * 600)
 def api_catch_all(request, uri_instance):
     '''
@@ -154,15 +249,7 @@ def api_catch_all(request, uri_instance):
         CAN BE CACHED
     '''
     # I search for a response_format string, a UKCL has no trailing slash
-    response_format = 'XML' #default
-    if uri_instance[-1:] == "/":
-        #I remove a trailing slash
-        uri_instance = uri_instance[:-1]
-    if uri_instance[-3:].lower() == "xml":
-        uri_instance = uri_instance[:-4]
-    if uri_instance[-4:].lower() == "json":
-        response_format = 'JSON'
-        uri_instance = uri_instance[:-5]
+    uri_instance, response_format = catch_all_request(uri_instance)
         
     try:
         split_path = uri_instance.split('/')
@@ -193,7 +280,7 @@ def api_catch_all(request, uri_instance):
             return render(request, 'knowledge_server/export.xml', {'xml': exported_pretty_xml}, content_type="application/xhtml+xml")
 
 
-@cache_page(60 * 600)
+@cache_page_per_release(60 * 60 * 24 * 30)
 def api_dataset_types(request):
     '''
         parameters:
@@ -205,11 +292,27 @@ def api_dataset_types(request):
         CAN BE CACHED
     '''
     ar = ApiResponse( request=request )
-    dss = DataSetStructure.objects.using('materialized').get(name=DataSetStructure.dataset_structure_DSN)
+    dss = DataSetStructure.get_current(name=DataSetStructure.dataset_structure_DSN)
     return api_datasets(request, DataSetStructure_UKCL = dss.UKCL, response_format=ar.response_format)
 
 
-@cache_page(60 * 600)
+def dataset_info_validators(request):
+    '''
+    ETag and Last-Modified of api_dataset_info; the response lists all the versions so it is validated
+    only when it has been rendered (see ExportArtifacts) and the ETag is the hash of the rendered content
+    '''
+    ar = ApiResponse(request=request)
+    if not ar.response_format in ('XML', 'JSON'):
+        return None, None
+    DataSet_UKCL_unquoted = urllib.parse.unquote(request.GET['UKCL']).replace("%2F","/")
+    artifact = ExportArtifacts.current(DataSet_UKCL_unquoted, 'INFO_' + ar.response_format)
+    if artifact is None:
+        return None, None
+    return artifact.content_hash, artifact.created
+
+
+@conditional_get(dataset_info_validators)
+@cache_page_per_release(60 * 60 * 24 * 30)
 def api_dataset_info(request):
     '''
         #52 
@@ -234,24 +337,14 @@ def api_dataset_info(request):
     DataSet_UKCL_unquoted = urllib.parse.unquote(DataSet_UKCL).replace("%2F","/")
     dataset = DataSet.retrieve_locally(DataSet_UKCL_unquoted)
     all_versions = DataSet.objects.filter(first_version = dataset.first_version)
-    all_versions_serialized = ""
-    all_versions_list = []
-    if ar.response_format != 'HTML' and ar.response_format != 'BROWSE':
-        for v in all_versions:
-            if ar.response_format == 'JSON':
-                # note I am using DICT as a response_format so that I can merge the dict (.update) and then convert it to json
-                all_versions_list.append(v.export(export_format = 'DICT', force_external_reference=True))
-            else:
-                all_versions_serialized += v.export(export_format = ar.response_format, force_external_reference=True)
-    if ar.response_format == 'XML':
+    if ar.response_format in ('XML', 'JSON'):
+        # rendered when the dataset has been released; see ExportArtifacts
+        response = ExportArtifacts.response(dataset.UKCL, 'INFO_' + ar.response_format)
+        if response:
+            return response
+        # e.g. a version that is not released; it is cached like the other responses
         ar.status = ApiResponse.success
-        ar.content = "<DataSet>" + dataset.export(export_format = ar.response_format, force_external_reference=True) + "</DataSet><Versions>" + all_versions_serialized + "</Versions>"
-        return render(request, 'knowledge_server/export.xml', {'xml': ar.xml()}, content_type="application/xhtml+xml")
-    if ar.response_format == 'JSON':
-        ar.content = { "DataSet": dataset.export(export_format = "DICT", force_external_reference=True), "Versions": all_versions_list }
-        ar.status = ApiResponse.success
-        return HttpResponse(ar.json(), content_type = "application/json") 
-#         return render(request, 'knowledge_server/export.json', {'json': ar.json()}, content_type="application/json")
+        return streamed_response(request, ar, dataset_info_chunks(dataset, all_versions, ar.response_format))
     if ar.response_format == 'HTML' or ar.response_format == 'BROWSE':
         if dataset.dataset_structure.is_a_view:
             instances = dataset.get_instances()
@@ -274,7 +367,40 @@ def api_dataset_info(request):
         return render_to_response('knowledge_server/api_dataset_info.html', context_instance=cont)
     
     
-@cache_page(60 * 600)
+@cache_page_per_release(60 * 60 * 24 * 30)
+def api_dataset_diff(request):
+    '''
+        What changed from a version of a dataset to another one: the instances added, removed and modified
+        (see DataSetDiff); a subscriber can fetch it instead of the whole new version
+
+        Parameters:
+        * UKCL: UKCL of the DataSet
+        * previous_UKCL: UKCL of the version UKCL has been created from, the only one a diff is computed
+          from (DataSetDelta applies it to that version); if missing that version
+        * format { 'XML' | 'JSON' }
+        CAN BE CACHED
+    '''
+    ar = ApiResponse(request=request)
+    try:
+        dataset = DataSet.retrieve_locally(urllib.parse.unquote(request.GET['UKCL']).replace("%2F","/"))
+        if not dataset.UKCL_previous_version:
+            raise Exception(dataset.UKCL + " is the first version")
+        if 'previous_UKCL' in request.GET.keys():
+            previous_UKCL = urllib.parse.unquote(request.GET['previous_UKCL']).replace("%2F","/")
+            if previous_UKCL != dataset.UKCL_previous_version:
+                raise Exception(dataset.UKCL + " has not been created from " + previous_UKCL +
+                                " but from " + dataset.UKCL_previous_version)
+        previous = DataSet.retrieve_locally(dataset.UKCL_previous_version)
+        if dataset.dataset_structure.is_a_view:
+            raise Exception("the versions of a view can't be compared")
+        diff = DataSetDiff(previous, dataset)
+    except Exception as ex:
+        return failure_response(request, ar, ex)
+    ar.status = ApiResponse.success
+    return streamed_response(request, ar, diff.chunks(ar.response_format))
+
+
+@cache_page_per_release(60 * 60 * 24 * 30)
 def api_datasets(request, DataSetStructure_UKCL = None, response_format = None):
     '''
         http://redmine.davide.galletti.name/issues/64
@@ -304,22 +430,10 @@ def api_datasets(request, DataSetStructure_UKCL = None, response_format = None):
         released_dataset = DataSet.objects.filter(dataset_structure = dss)
     else:
         released_dataset = DataSet.objects.filter(dataset_structure = dss, version_released=True)
-    serialized = ""
-    comma = ""
-    dataset_list = []
-    for dataset in released_dataset:
-        if ar.response_format == 'JSON':
-            dataset_list.append(dataset.export(export_format = "DICT", force_external_reference=True))
-        else:
-            serialized += dataset.export(export_format = ar.response_format, force_external_reference=True)
-    if ar.response_format == 'XML':
+    if ar.response_format in ('XML', 'JSON'):
         ar.status = ApiResponse.success
-        ar.content = "<DataSets>" + serialized + "</DataSets>"
-        return render(request, 'knowledge_server/export.xml', {'xml': ar.xml()}, content_type="application/xhtml+xml")
-    if ar.response_format == 'JSON':
-        ar.content = { "DataSets": dataset_list }
-        ar.status = ApiResponse.success 
-        return render(request, 'knowledge_server/export.json', {'json': ar.json()}, content_type="application/json")
+        content = datasets_chunks(released_dataset, ar.response_format, "DataSets", force_external_reference=True)
+        return streamed_response(request, ar, content)
 
 
 @never_cache
@@ -410,7 +524,7 @@ def api_unsubscribe(request):
                   content_type="application/json")
 
     
-@cache_page(60 * 600)
+@cache_page_per_release(60 * 60 * 24 * 30)
 def api_dataset_structure_code(request):
     '''
         This API is needed just by another OKS and it is not meant to be public
@@ -441,12 +555,16 @@ def api_notify(request):
             URL_structure --> structure_UKCL
         first_version_UKCL: the UKCL of the first version of the DataSet for which the event has happened
         event_type: the URInstance of the EventType
+        previous_UKCL: optional, the UKCL of the previous version of the DataSet
+        URL_diff: optional, api_dataset_diff from the previous version; if we have it we import just the diff
         NEVER CACHED
    '''
     first_version_UKCL = request.POST.get("first_version_UKCL", "")
     URL_dataset = request.POST.get("URL_dataset", "")
     URL_structure = request.POST.get("URL_structure", "")
     event_type = request.POST.get("type", "")
+    previous_UKCL = request.POST.get("previous_UKCL", "")
+    URL_diff = request.POST.get("URL_diff", "")
     # Did I subscribe to this?
     sto = SubscriptionToOther.objects.filter(first_version_UKCL=first_version_UKCL)
     ar = ApiResponse()
@@ -454,6 +572,8 @@ def api_notify(request):
         nr = NotificationReceived()
         nr.URL_dataset = URL_dataset
         nr.URL_structure = URL_structure
+        nr.previous_UKCL = previous_UKCL
+        nr.URL_diff = URL_diff
         nr.save()
         ar.status = ApiResponse.success
     else:
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Subject to the terms of the GNU AFFERO GENERAL PUBLIC LICENSE, v. 3.0. If a copy of the AGPL was not
+# distributed with this file, You can obtain one at http://www.gnu.org/licenses/agpl.txt
+#
+# Author: Davide Galletti                davide   ( at )   c4k.it
+
+'''
+When a DataSet is released the responses of api_dataset (XML and JSON) and of api_dataset_info
+are rendered once and written to disk; the API then serves the files instead of serializing
+the dataset at every request.
+Files are content addressed (their name is the sha256 of the content) and the ExportArtifact
+model tells which file is the current one for a dataset and a type of response.
+Settings (all optional):
+    KS_ARTIFACTS = {
+        'ROOT': '/var/tmp/oks_artifacts',       # where files are written
+        'SERVE_WITH': None,                     # None (Django serves the file), 'X-Accel-Redirect' (nginx), 'X-Sendfile' (apache)
+        'INTERNAL_URL': '/oks_artifacts/',      # the internal location mapped on ROOT, for X-Accel-Redirect
+        'UNREFERENCED_GRACE': 60 * 60 * 24,     # seconds a file of a cached response is kept after its last use
+    }
+The responses cached by caches.cache_page_per_release are written here too.
+'''
+
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+from datetime import datetime
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+
+import knowledge_server.models
+
+logger = logging.getLogger(__name__)
+
+
+def datasets_chunks(datasets, export_format, list_tag, force_external_reference=False):
+    '''
+    the content of an API response with the export of each dataset in datasets, in chunks:
+        XML:  <list_tag> ...each export... </list_tag>
+        JSON: {"list_tag": [ ...each export... ]}
+    a single dataset is passed with list_tag=None:
+        XML:  the export
+        JSON: {"DataSet": export}
+    '''
+    if export_format == 'XML' and list_tag:
+        yield "<" + list_tag + ">"
+    if export_format == 'JSON':
+        yield '{"' + (list_tag if list_tag else "DataSet") + '": '
+        if list_tag:
+            yield "["
+    comma = ""
+    for dataset in datasets:
+        if export_format == 'JSON':
+            yield comma
+            comma = ", "
+        yield from dataset.export_chunks(export_format=export_format, force_external_reference=force_external_reference)
+    if export_format == 'XML' and list_tag:
+        yield "</" + list_tag + ">"
+    if export_format == 'JSON':
+        if list_tag:
+            yield "]"
+        yield "}"
+
+
+def dataset_info_chunks(dataset, all_versions, export_format):
+    '''
+    the content of api_dataset_info, in chunks: the dataset and all its versions
+        XML:  <DataSet> export </DataSet><Versions> ...each export... </Versions>
+        JSON: {"DataSet": export, "Versions": [ ...each export... ]}
+    '''
+    if export_format == 'XML':
+        yield "<DataSet>"
+        yield from dataset.export_chunks(export_format=export_format, force_external_reference=True)
+        yield "</DataSet>"
+        yield from datasets_chunks(all_versions, export_format, "Versions", force_external_reference=True)
+    if export_format == 'JSON':
+        yield '{"DataSet": '
+        yield from dataset.export_chunks(export_format=export_format, force_external_reference=True)
+        yield ', "Versions": ['
+        comma = ""
+        for version in all_versions:
+            yield comma
+            comma = ", "
+            yield from version.export_chunks(export_format=export_format, force_external_reference=True)
+        yield "]}"
+
+
+class ArtifactStore():
+    '''
+    Content addressed files: ROOT/ab/cd/abcd...  where abcd... is the sha256 of the content
+    '''
+
+    @staticmethod
+    def setting(name, default):
+        return getattr(settings, 'KS_ARTIFACTS', {}).get(name, default)
+
+    @staticmethod
+    def root():
+        return ArtifactStore.setting('ROOT', os.path.join(tempfile.gettempdir(), 'oks_artifacts'))
+
+    @staticmethod
+    def relative_path(content_hash):
+        return os.path.join(content_hash[0:2], content_hash[2:4], content_hash)
+
+    @staticmethod
+    def path(content_hash):
+        return os.path.join(ArtifactStore.root(), ArtifactStore.relative_path(content_hash))
+
+    @staticmethod
+    def write(chunks):
+        '''
+        it writes the chunks (strings) to a temporary file and then moves it to its content addressed path
+        returns ( content_hash, size )
+        '''
+        written = []
+        for chunk in ArtifactStore.tee(chunks, lambda content_hash, size: written.append((content_hash, size))):
+            pass
+        return written[0]
+
+    @staticmethod
+    def tee(chunks, written):
+        '''
+        it yields the chunks (strings or bytes) while it writes them like write; written( content_hash, size )
+        is invoked when the last one has been written; if the chunks are not all consumed (e.g. the client
+        of a StreamingHttpResponse disconnected) the temporary file is removed
+        '''
+        os.makedirs(ArtifactStore.root(), exist_ok=True)
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=ArtifactStore.root(), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                    sha256.update(data)
+                    size += len(data)
+                    f.write(data)
+                    yield chunk
+            content_hash = sha256.hexdigest()
+            final_path = ArtifactStore.path(content_hash)
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            # atomic; if the same content is already there it is just replaced by an identical file
+            os.replace(temp_path, final_path)
+        except:
+            os.remove(temp_path)
+            raise
+        written(content_hash, size)
+
+    @staticmethod
+    def response(content_hash, size, content_type):
+        '''
+        the HttpResponse serving the file (see SERVE_WITH), None if the file is missing
+        '''
+        path = ArtifactStore.path(content_hash)
+        if not os.path.exists(path):
+            return None
+        serve_with = ArtifactStore.setting('SERVE_WITH', None)
+        if serve_with == 'X-Accel-Redirect':
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = ArtifactStore.setting('INTERNAL_URL', '/oks_artifacts/') + \
+                                           ArtifactStore.relative_path(content_hash).replace(os.sep, '/')
+        elif serve_with == 'X-Sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = path
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+            response['Content-Length'] = str(size)
+        return response
+
+    @staticmethod
+    def touch(content_hash):
+        '''
+        a file that is not referenced is kept by collect_garbage for UNREFERENCED_GRACE seconds after it
+        has been written or touched
+        '''
+        try:
+            os.utime(ArtifactStore.path(content_hash))
+        except OSError:
+            pass
+
+    @staticmethod
+    def collect_garbage():
+        '''
+        it removes the files no longer referenced by an ExportArtifact or by ApiResponse.urlopen in this process
+        (urlopen of other processes reads the whole response again when its file is missing) and not written
+        or touched in the last UNREFERENCED_GRACE seconds: those of the responses cached by
+        cache_page_per_release (a cached response whose file is missing is rendered again);
+        returns a message for run_cron
+        '''
+        written_before = time.time() - ArtifactStore.setting('UNREFERENCED_GRACE', 60 * 60 * 24)
+        referenced = set(knowledge_server.models.ExportArtifact.objects.values_list('content_hash', flat=True))
+        referenced.update(knowledge_server.models.ApiResponse.received_content_hashes())
+        removed = 0
+        for dir_path, dir_names, file_names in os.walk(ArtifactStore.root()):
+            for file_name in file_names:
+                # temporary files are left to the writer
+                file_path = os.path.join(dir_path, file_name)
+                if not file_name.endswith('.tmp') and not file_name in referenced and \
+                        os.path.getmtime(file_path) < written_before:
+                    os.remove(file_path)
+                    removed += 1
+        return "Removed " + str(removed) + " export artifacts no longer used<br>"
+
+
+class ExportArtifacts():
+    '''
+    The artifacts of a released dataset; see the module documentation
+    '''
+    XML = 'XML'
+    JSON = 'JSON'
+    INFO_XML = 'INFO_XML'
+    INFO_JSON = 'INFO_JSON'
+    content_types = {XML: "application/xhtml+xml", JSON: "application/json",
+                     INFO_XML: "application/xhtml+xml", INFO_JSON: "application/json"}
+
+    @staticmethod
+    def render(dataset, artifact_type):
+        '''
+        the chunks of the API response; it is the same content api_dataset and api_dataset_info produce
+        '''
+        ApiResponse = knowledge_server.models.ApiResponse
+        ar = ApiResponse(status=ApiResponse.success, datetime_generated_utc=datetime.utcnow())
+        export_format = 'JSON' if artifact_type in (ExportArtifacts.JSON, ExportArtifacts.INFO_JSON) else 'XML'
+        if artifact_type in (ExportArtifacts.XML, ExportArtifacts.JSON):
+            content = datasets_chunks([dataset], export_format, None)
+        else:
+            all_versions = knowledge_server.models.DataSet.objects.filter(first_version=dataset.first_version)
+            content = dataset_info_chunks(dataset, all_versions, export_format)
+        if export_format == 'XML':
+            return ar.xml_chunks(content)
+        else:
+            return ar.json_chunks(content)
+
+    @staticmethod
+    def publish(dataset):
+        '''
+        invoked when the dataset has been released (see DataSet.set_released)
+        errors are logged: without artifacts the API serializes the dataset at each request as before
+        '''
+        ExportArtifact = knowledge_server.models.ExportArtifact
+        for artifact_type in ExportArtifacts.content_types.keys():
+            try:
+                content_hash, size = ArtifactStore.write(ExportArtifacts.render(dataset, artifact_type))
+                ExportArtifact.objects.filter(dataset_UKCL=dataset.UKCL, artifact_type=artifact_type).delete()
+                ExportArtifact.objects.create(dataset_UKCL=dataset.UKCL, artifact_type=artifact_type,
+                                              content_hash=content_hash, size=size)
+            except Exception as ex:
+                logger.error("ExportArtifacts.publish " + artifact_type + " of " + dataset.UKCL + ": " + str(ex))
+
+    @staticmethod
+    def invalidate(first_version, changed=()):
+        '''
+        the info of every version of a dataset lists all the versions (with their version_released) so it
+        changes with any new version; the export of a version changes only when its version_released changes:
+        only the exports of the versions in changed are invalidated
+        '''
+        versions_UKCL = knowledge_server.models.DataSet.objects.filter(first_version=first_version).values_list('UKCL', flat=True)
+        ExportArtifact = knowledge_server.models.ExportArtifact
+        ExportArtifact.objects.filter(dataset_UKCL__in=list(versions_UKCL),
+                                      artifact_type__in=[ExportArtifacts.INFO_XML, ExportArtifacts.INFO_JSON]).delete()
+        if len(changed) > 0:
+            ExportArtifact.objects.filter(dataset_UKCL__in=list(version.UKCL for version in changed),
+                                          artifact_type__in=[ExportArtifacts.XML, ExportArtifacts.JSON]).delete()
+
+    @staticmethod
+    def current(dataset_UKCL, artifact_type):
+        '''
+        the ExportArtifact, None if there is no artifact
+        '''
+        return knowledge_server.models.ExportArtifact.objects.filter(dataset_UKCL=dataset_UKCL,
+                                                                     artifact_type=artifact_type).first()
+
+    @staticmethod
+    def response(dataset_UKCL, artifact_type):
+        '''
+        the HttpResponse serving the artifact, None if there is no artifact
+        '''
+        artifact = ExportArtifacts.current(dataset_UKCL, artifact_type)
+        if artifact is None:
+            return None
+        response = ArtifactStore.response(artifact.content_hash, artifact.size, ExportArtifacts.content_types[artifact_type])
+        if response is None:
+            logger.warning("ExportArtifacts.response: missing file " + ArtifactStore.path(artifact.content_hash) +
+                           " for " + dataset_UKCL)
+            artifact.delete()
+        return response
@@ -0,0 +1,671 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Subject to the terms of the GNU AFFERO GENERAL PUBLIC LICENSE, v. 3.0. If a copy of the AGPL was not
+# distributed with this file, You can obtain one at http://www.gnu.org/licenses/agpl.txt
+#
+# Author: Davide Galletti                davide   ( at )   c4k.it
+
+'''
+Writing a graph of instances with bulk_create, a few queries per model class instead of a few
+queries per instance. BulkWriter writes the instances; they are collected by:
+    importer.BulkImport      from the export of a DataSet
+    BulkMaterialization      from the default database, when a DataSet is released
+When default and materialized are on the same MySQL server BulkMaterialization copies the rows
+with SQL instead (see SqlCopy).
+BulkDeletion deletes the instances of a DataSet with a few queries per model class.
+'''
+
+import logging
+
+from collections import OrderedDict
+
+from django.db import connections, transaction
+from django.db.models import Case, IntegerField, Value, When
+
+import knowledge_server.models
+from knowledge_server.allocator import PkAllocator
+from knowledge_server.caches import ExportedInstances, ModelMetadataRegistry
+from knowledge_server.structure_plan import PlanNode, StructurePlan
+
+logger = logging.getLogger(__name__)
+
+
+class BulkNotPossible( Exception ):
+    pass
+
+
+class BulkWriter():
+    '''
+    The instances to be written on db_alias are identified by their UKCL:
+        instances       UKCL -> unsaved instance, in the order they are found
+        links           UKCL -> { field: UKCL of the instance it refers to }
+        many_to_many    ( UKCL, attribute, UKCL ) of the ManyToMany
+        on_db           UKCL -> instance already on db_alias that is referred to
+    Instances are written in waves: an instance is in the wave after the instances its ForeignKeys
+    (and the field pointing at its parent) refer to; each wave is written with a bulk_create for each
+    model class and the pks are allocated up front (see PkAllocator) or read back with a query on the
+    UKCLs. The ManyToMany rows are written at the end, with a bulk_create for each through model.
+    A cycle between instances raises BulkNotPossible before anything is written
+    '''
+    batch_size = 1000
+
+    def __init__(self, db_alias):
+        self.db_alias = db_alias
+        self.instances = OrderedDict( )
+        self.links = { }
+        self.many_to_many = [ ]
+        self.on_db = { }
+
+    def waves(self):
+        '''
+        lists of UKCLs; the instances in a wave refer only to instances in the previous waves or on the database
+        '''
+        wave_of = { }
+        for UKCL in self.instances.keys( ):
+            if UKCL in wave_of:
+                continue
+            # depth first without recursion; on_path detects cycles
+            to_do = [ UKCL ]
+            on_path = set( )
+            while len( to_do ) > 0:
+                current = to_do[ -1 ]
+                on_path.add( current )
+                pending = [ target for target in self.links[ current ].values( ) if
+                            target in self.instances and not target in wave_of ]
+                for target in pending:
+                    if target in on_path:
+                        raise BulkNotPossible( "a cycle between " + current + " and " + target )
+                if len( pending ) > 0:
+                    to_do.append( pending[ 0 ] )
+                    continue
+                to_do.pop( )
+                on_path.discard( current )
+                wave_of[ current ] = 1 + max( [ wave_of[ target ] for target in self.links[ current ].values( ) if
+                                                target in self.instances ] + [ -1 ] )
+        waves = [ [ ] for i in range( 1 + max( list( wave_of.values( ) ) + [ -1 ] ) ) ]
+        for UKCL in self.instances.keys( ):
+            waves[ wave_of[ UKCL ] ].append( UKCL )
+        return waves
+
+    def saved(self, UKCL):
+        if UKCL in self.instances:
+            return self.instances[ UKCL ]
+        return self.on_db[ UKCL ]
+
+    def write_instances(self, waves):
+        '''
+        to be invoked within a transaction on db_alias
+        '''
+        for wave in waves:
+            self.write( wave )
+        self.write_many_to_many( )
+        structure_nodes = list( instance for instance in self.instances.values( ) if
+                                isinstance( instance, knowledge_server.models.StructureNode ) )
+        if len( structure_nodes ) > 0:
+            # what model_post_save does for each StructureNode
+            StructurePlan.nodes_changed( structure_nodes )
+        if any( isinstance( instance, knowledge_server.models.ModelMetadata ) for instance in self.instances.values( ) ):
+            # what ModelMetadata.save does
+            ModelMetadataRegistry.changed( self.db_alias )
+
+    def write(self, wave):
+        by_class = OrderedDict( )
+        for UKCL in wave:
+            instance = self.instances[ UKCL ]
+            for field_name, target_UKCL in self.links[ UKCL ].items( ):
+                setattr( instance, field_name, self.saved( target_UKCL ) )
+            # bulk_create doesn't invoke save (see ShareableModel.save)
+            if not instance.content_hash:
+                instance.content_hash = instance.own_content_hash( )
+            by_class.setdefault( instance.__class__, [ ] ).append( instance )
+        for actual_class, instances in by_class.items( ):
+            for start in range( 0, len( instances ), self.batch_size ):
+                batch = instances[ start:start + self.batch_size ]
+                # with the pks allocated beforehand they don't have to be read back
+                PkAllocator.assign( batch, self.db_alias )
+                actual_class.objects.using( self.db_alias ).bulk_create( batch )
+                without_pk = dict( ( instance.UKCL, instance ) for instance in batch if instance.pk is None )
+                if len( without_pk ) > 0:
+                    pks = actual_class.objects.using( self.db_alias ).filter(
+                        UKCL__in=list( without_pk.keys( ) ) ).values_list( 'UKCL', 'pk' )
+                    for UKCL, pk in pks:
+                        # the UKCL could already be on the database; the new record has the highest pk
+                        if UKCL in without_pk and (without_pk[ UKCL ].pk is None or without_pk[ UKCL ].pk < pk):
+                            without_pk[ UKCL ].pk = pk
+                for instance in batch:
+                    instance._state.adding = False
+                    instance._state.db = self.db_alias
+
+    def write_many_to_many(self):
+        rows = OrderedDict( )
+        for UKCL, attribute, target_UKCL in self.many_to_many:
+            instance = self.saved( UKCL )
+            descriptor = getattr( instance.__class__, attribute )
+            if descriptor.reverse:
+                source_name, target_name = descriptor.field.m2m_reverse_field_name( ), descriptor.field.m2m_field_name( )
+            else:
+                source_name, target_name = descriptor.field.m2m_field_name( ), descriptor.field.m2m_reverse_field_name( )
+            through = descriptor.through
+            key = ( through, instance.pk, self.saved( target_UKCL ).pk )
+            if not key in rows:
+                rows[ key ] = through( **{source_name + "_id": instance.pk, target_name + "_id": key[ 2 ]} )
+        by_through = OrderedDict( )
+        for key, row in rows.items( ):
+            by_through.setdefault( key[ 0 ], [ ] ).append( row )
+        for through, through_rows in by_through.items( ):
+            through.objects.using( self.db_alias ).bulk_create( through_rows, batch_size=self.batch_size )
+
+
+class BulkMaterialization( BulkWriter ):
+    '''
+    It copies an instance of the default database, and everything below it in the structure, to the
+    materialized database; it does what ShareableModel.materialize does one instance at a time:
+    - the instances, loaded with StructurePlan.prefetched, are walked once and an unsaved copy is created
+      for each; relationships are recorded with the UKCL, that remains the same on the materialized database
+    - external references and processed_instances (the instances already materialized) are loaded from the
+      materialized database with a query per model class; a ForeignKey to an external reference that is not
+      there points at a placeholder and a DanglingReference is created, as in materialize
+    - the DanglingReferences to the copied instances are resolved in one pass
+    What bulk_create can't do raises BulkNotPossible before anything is written: DataSets, multi table
+    inheritance, instances without UKCL, cycles between instances, other relationships than ForeignKey,
+    GenericForeignKey, ManyToMany and the field pointing at the parent
+    '''
+
+    def __init__(self, processed_instances=None, sql=True):
+        '''
+        sql: False to write the rows with bulk_create even when they can be copied with SqlCopy
+        (see SqlCopy.not_possible)
+        '''
+        super( BulkMaterialization, self ).__init__( 'materialized' )
+        self.processed_instances = processed_instances if processed_instances is not None else ExportedInstances( )
+        # True if the rows can be copied with SqlCopy, see run
+        self.sql = sql
+        # UKCL -> pk on the default database of the instances being copied
+        self.source_pks = { }
+        # UKCL -> class of the instances that must be found on the materialized database
+        self.wanted = { }
+        # ( UKCL, attribute, UKCL of the external reference, UKCL of the structure node ) of the ForeignKeys
+        self.external_references = [ ]
+        # ( UKCL, attribute ) of the ForeignKeys of an instance that point at the instance itself
+        self.self_links = [ ]
+        # the external_references that are not on the materialized database, see load_on_db
+        self.missing = [ ]
+
+    def run(self, instance, structure_node):
+        '''
+        it materializes instance and returns its copy on the materialized database
+        '''
+        try:
+            plan = PlanNode.compile( structure_node )
+            if plan.external_reference:
+                raise BulkNotPossible( "external reference " + instance.UKCL )
+            UKCL = self.collect( StructurePlan.prefetched( instance, plan ), plan )
+            missing = self.load_on_db( )
+            waves = self.waves( )
+        except BulkNotPossible:
+            raise
+        except Exception as ex:
+            raise BulkNotPossible( str( ex ) )
+        with transaction.atomic( using=self.db_alias ):
+            if not (self.sql and self.copy_with_sql( waves )):
+                self.write_instances( waves )
+            for self_UKCL, attribute in self.self_links:
+                instance = self.saved( self_UKCL )
+                setattr( instance, attribute, instance )
+                instance.save( using=self.db_alias )
+            self.resolve_dangling_references( )
+            self.create_dangling_references( missing )
+        self.processed_instances.extend( self.instances.keys( ) )
+        if self.sql and UKCL in self.instances:
+            # the copies in memory do not have the ForeignKeys that SqlCopy has set
+            new_instance = self.instances[ UKCL ]
+            return new_instance.__class__.objects.using( self.db_alias ).get( pk=new_instance.pk )
+        return self.saved( UKCL )
+
+    def copy_with_sql(self, waves):
+        '''
+        the instances are copied with SqlCopy within a savepoint; False if it is not possible, then nothing has
+        been written: the rows are then written with write_instances
+        '''
+        sql_copy = SqlCopy( 'default', self.db_alias )
+        reason = sql_copy.not_possible( self )
+        if reason:
+            logger.info( "BulkMaterialization: SqlCopy not possible, " + reason )
+            self.sql = False
+            return False
+        try:
+            with transaction.atomic( using=self.db_alias ):
+                pks = { }
+                for wave in waves:
+                    # the instances of a class with the same ForeignKeys are copied with a statement
+                    shapes = OrderedDict( )
+                    for UKCL in wave:
+                        key = ( self.instances[ UKCL ].__class__, frozenset( self.links[ UKCL ].keys( ) ) )
+                        shapes.setdefault( key, [ ] ).append( UKCL )
+                    for ( actual_class, field_names ), UKCLs in shapes.items( ):
+                        for start in range( 0, len( UKCLs ), self.batch_size ):
+                            batch = UKCLs[ start:start + self.batch_size ]
+                            new_pks = PkAllocator.reserve( actual_class, self.db_alias, len( batch ) )
+                            sql_copy.copy( actual_class, [ ( self.source_pks[ UKCL ], new_pk ) for UKCL, new_pk in
+                                                           zip( batch, new_pks ) ], field_names )
+                            pks.update( zip( batch, new_pks ) )
+                by_attribute = OrderedDict( )
+                for UKCL, attribute, target_UKCL in self.many_to_many:
+                    by_attribute.setdefault( ( self.instances[ UKCL ].__class__, attribute ), set( ) ).add(
+                        self.source_pks[ UKCL ] )
+                for ( actual_class, attribute ), source_pks in by_attribute.items( ):
+                    sql_copy.copy_many_to_many( getattr( actual_class, attribute ), list( source_pks ) )
+        except Exception as ex:
+            logger.warning( "BulkMaterialization: SqlCopy failed, " + str( ex ) )
+            self.sql = False
+            return False
+        for UKCL, pk in pks.items( ):
+            new_instance = self.instances[ UKCL ]
+            new_instance.pk = pk
+            new_instance._state.adding = False
+            new_instance._state.db = self.db_alias
+        structure_nodes = list( instance for instance in self.instances.values( ) if
+                                isinstance( instance, knowledge_server.models.StructureNode ) )
+        if len( structure_nodes ) > 0:
+            # what model_post_save does for each StructureNode
+            StructurePlan.nodes_changed( structure_nodes )
+        if any( isinstance( instance, knowledge_server.models.ModelMetadata ) for instance in self.instances.values( ) ):
+            # what ModelMetadata.save does
+            ModelMetadataRegistry.changed( self.db_alias )
+        return True
+
+    def collect(self, instance, structure_node, parent_UKCL=None, parent_field_name=""):
+        '''
+        it creates the (unsaved) copy of instance and of its children; it returns its UKCL
+        '''
+        UKCL = instance.UKCL
+        if not UKCL:
+            raise BulkNotPossible( "an instance of " + instance.__class__.__name__ + " has no UKCL" )
+        if UKCL in self.instances or UKCL in self.wanted:
+            # already reached; as in materialize, it is not materialized again
+            return UKCL
+        if UKCL in self.processed_instances:
+            self.wanted[ UKCL ] = instance.__class__
+            return UKCL
+        actual_class = instance.__class__
+        if issubclass( actual_class, knowledge_server.models.DataSet ) or len( actual_class._meta.parents ) > 0:
+            raise BulkNotPossible( actual_class.__name__ + " can't be created with bulk_create" )
+        new_instance = actual_class( )
+        for key in instance._meta.fields:
+            if key.__class__.__name__ != "ForeignKey" and instance._meta.pk != key:
+                setattr( new_instance, key.attname, getattr( instance, key.attname ) )
+        # bulk_create doesn't invoke save (see ShareableModel.save)
+        new_instance.materialized_build = knowledge_server.models.MaterializedBuild.written( actual_class )
+        self.instances[ UKCL ] = new_instance
+        self.source_pks[ UKCL ] = instance.pk
+        self.links[ UKCL ] = { }
+        if parent_field_name:
+            self.links[ UKCL ][ parent_field_name ] = parent_UKCL
+        FK_attributes = instance.foreign_key_attributes( ) + instance.virtual_field_attributes( )
+        for child_structure_node in structure_node.children:
+            attribute = child_structure_node.attribute
+            if not attribute:
+                continue
+            if attribute in FK_attributes:
+                child_instance = getattr( instance, attribute )
+                if child_instance is None:
+                    continue
+                if child_instance.UKCL == UKCL:
+                    self.self_links.append( ( UKCL, attribute ) )
+                elif child_structure_node.external_reference:
+                    self.wanted[ child_instance.UKCL ] = child_instance.__class__
+                    self.links[ UKCL ][ attribute ] = child_instance.UKCL
+                    self.external_references.append( ( UKCL, attribute, child_instance.UKCL, child_structure_node.UKCL ) )
+                else:
+                    self.links[ UKCL ][ attribute ] = self.collect( child_instance, child_structure_node )
+            elif child_structure_node.is_many:
+                if child_structure_node.method_to_retrieve:
+                    continue
+                field_name = knowledge_server.models.ShareableModel.get_parent_field_name( instance, attribute )
+                for child_instance in getattr( instance, attribute ).all( ):
+                    if child_instance.__class__.__name__ == actual_class.__name__ and instance.pk == child_structure_node.pk:
+                        # see the self relationships in materialize
+                        raise BulkNotPossible( "self relationship " + attribute + " of " + UKCL )
+                    if child_structure_node.external_reference:
+                        if field_name:
+                            raise BulkNotPossible( "external reference " + attribute + " of " + UKCL )
+                        child_UKCL = child_instance.UKCL
+                        self.wanted[ child_UKCL ] = child_instance.__class__
+                    else:
+                        child_UKCL = self.collect( child_instance, child_structure_node, UKCL, field_name )
+                    if not field_name:
+                        self.many_to_many.append( ( UKCL, attribute, child_UKCL ) )
+            else:
+                raise BulkNotPossible( attribute + " of " + UKCL )
+        return UKCL
+
+    def load_on_db(self):
+        '''
+        it loads the instances that must be on the materialized database; a missing ForeignKey to an external
+        reference is replaced by a placeholder; it returns the external references missing
+        '''
+        by_class = { }
+        for UKCL, actual_class in self.wanted.items( ):
+            if not UKCL in self.instances:
+                by_class.setdefault( actual_class, [ ] ).append( UKCL )
+        # those written by the release being materialized are not visible yet but can be referred to
+        builds = [ 0, knowledge_server.models.MaterializedBuild.current( ) ]
+        for actual_class, UKCLs in by_class.items( ):
+            for start in range( 0, len( UKCLs ), self.batch_size ):
+                for instance in actual_class.objects.using( self.db_alias ).filter(
+                        UKCL__in=UKCLs[ start:start + self.batch_size ], materialized_build__in=builds ):
+                    self.on_db[ instance.UKCL ] = instance
+        missing = [ ]
+        for reference in self.external_references:
+            target_UKCL = reference[ 2 ]
+            if not target_UKCL in self.instances and not target_UKCL in self.on_db:
+                missing.append( reference )
+        for UKCL, attribute, target_UKCL, node_UKCL in missing:
+            if not target_UKCL in self.on_db:
+                self.on_db[ target_UKCL ] = self.wanted[ target_UKCL ].placeholder( self.db_alias )
+        for UKCL in self.wanted.keys( ):
+            if not UKCL in self.instances and not UKCL in self.on_db:
+                raise BulkNotPossible( UKCL + " is not on the materialized database" )
+        self.missing = missing
+        return missing
+
+    def resolve_dangling_references(self):
+        '''
+        the DanglingReferences to the instances just materialized
+        '''
+        DanglingReference = knowledge_server.models.DanglingReference
+        UKCLs = list( self.instances.keys( ) )
+        for start in range( 0, len( UKCLs ), self.batch_size ):
+            drs = DanglingReference.objects.using( self.db_alias ).filter(
+                UKCL_actual_instance__in=UKCLs[ start:start + self.batch_size ] ).select_related( 'structure_node' )
+            for dr in drs:
+                new_instance = self.instances[ dr.UKCL_actual_instance ]
+                try:
+                    if dr.structure_node.is_many:
+                        getattr( dr.object_with_dangling, dr.structure_node.attribute ).add( new_instance )
+                    else:
+                        setattr( dr.object_with_dangling, dr.structure_node.attribute, new_instance )
+                    dr.object_with_dangling.save( using=self.db_alias )
+                    dr.delete( )
+                except:
+                    logger.warn( "Couldn't resolve a dangling reference from " + dr.UKCL_actual_instance + " to " +
+                                 dr.object_with_dangling.UKCL )
+
+    def create_dangling_references(self, missing):
+        DanglingReference = knowledge_server.models.DanglingReference
+        StructureNode = knowledge_server.models.StructureNode
+        node_UKCLs = set( reference[ 3 ] for reference in missing )
+        structure_nodes = dict( ( node.UKCL, node ) for node in
+                                StructureNode.objects.using( self.db_alias ).filter( UKCL__in=list( node_UKCLs ) ) )
+        for UKCL, attribute, target_UKCL, node_UKCL in missing:
+            dr = DanglingReference( )
+            dr.UKCL_actual_instance = target_UKCL
+            # the structure node is from default; we can't have a rel with dr on materialized
+            dr.structure_node = structure_nodes[ node_UKCL ]
+            dr.object_with_dangling = self.saved( UKCL )
+            dr.save( using=self.db_alias )
+
+
+class SqlCopy():
+    '''
+    In our deployment default and materialized are two schemas on the same MySQL server; rows are then copied
+    with INSERT ... SELECT across schemas without loading them in Django:
+    - the pks are allocated with PkAllocator and assigned with a CASE on the pk of the source row
+    - a ForeignKey is remapped with a subquery that finds, on the target schema, the row with the same UKCL
+      of the row it refers to on the source schema; the other ForeignKeys are NULL as in materialize
+    - the rows of the through table of a ManyToMany are remapped in the same way
+    The rows must be committed on the source and not locked by the caller (see source_committed)
+    '''
+
+    def __init__(self, source_alias, target_alias):
+        self.source_alias = source_alias
+        self.target_alias = target_alias
+
+    def source_committed(self):
+        '''
+        the statements run on the target connection, which does not see what the source connection has
+        not committed yet and waits for the rows it has locked: the source connection must not be in a
+        transaction (e.g. set_released materializes within its own, hence without SqlCopy)
+        '''
+        return not connections[ self.source_alias ].in_atomic_block
+
+    def same_server(self):
+        source = connections[ self.source_alias ]
+        target = connections[ self.target_alias ]
+        return source.vendor == 'mysql' and target.vendor == 'mysql' and \
+               all( source.settings_dict.get( key ) == target.settings_dict.get( key ) for key in
+                    ( 'HOST', 'PORT', 'USER' ) ) and source.settings_dict[ 'NAME' ] != target.settings_dict[ 'NAME' ]
+
+    def not_possible(self, materialization):
+        '''
+        why the instances collected by materialization can't be copied; None if they can
+        '''
+        if not self.same_server( ):
+            return "default and materialized are not schemas on the same MySQL server"
+        if not self.source_committed( ):
+            return "the rows might not be committed on " + self.source_alias
+        if len( materialization.self_links ) > 0:
+            return "a ForeignKey points at its own instance"
+        if len( materialization.missing ) > 0:
+            return "a dangling reference"
+        for actual_class in set( instance.__class__ for instance in materialization.instances.values( ) ):
+            if not PkAllocator.usable( actual_class, self.target_alias ):
+                return "the pks of " + actual_class.__name__ + " can't be allocated"
+        for UKCL, links in materialization.links.items( ):
+            actual_class = materialization.instances[ UKCL ].__class__
+            for field_name in links.keys( ):
+                reason = self.not_remappable( actual_class, field_name )
+                if reason:
+                    return reason
+        for UKCL, attribute, target_UKCL in materialization.many_to_many:
+            through = getattr( materialization.instances[ UKCL ].__class__, attribute ).through
+            for field in through._meta.concrete_fields:
+                if not field.primary_key:
+                    reason = self.not_remappable( through, field.name )
+                    if reason:
+                        return reason
+        return None
+
+    def not_remappable(self, model, field_name):
+        try:
+            field = model._meta.get_field( field_name )
+        except Exception:
+            return model.__name__ + "." + field_name + " is not a field"
+        if field.__class__.__name__ != "ForeignKey" or not field.target_field.primary_key:
+            return model.__name__ + "." + field_name + " is not a ForeignKey to a primary key"
+        related_model = field.related_model
+        if not any( related_field.name == "UKCL" for related_field in related_model._meta.concrete_fields ):
+            return model.__name__ + "." + field_name + " refers to a model without UKCL"
+        if issubclass( related_model, knowledge_server.models.DataSet ):
+            # the DataSet being released is locked by set_released
+            return model.__name__ + "." + field_name + " refers to a DataSet"
+        return None
+
+    def table(self, db_alias, model):
+        connection = connections[ db_alias ]
+        return connection.ops.quote_name( connection.settings_dict[ 'NAME' ] ) + "." + \
+               connection.ops.quote_name( model._meta.db_table )
+
+    def remapped(self, field, column):
+        '''
+        the pk on the target of the row with the UKCL of the row that column refers to on the source
+        '''
+        quote_name = connections[ self.target_alias ].ops.quote_name
+        related_model = field.related_model
+        pk_column = quote_name( related_model._meta.pk.column )
+        return "(SELECT MAX(t." + pk_column + ") FROM " + self.table( self.target_alias, related_model ) + \
+               " t WHERE t.UKCL = (SELECT s.UKCL FROM " + self.table( self.source_alias, related_model ) + \
+               " s WHERE s." + pk_column + " = " + column + "))"
+
+    def copy(self, model, pks, field_names):
+        '''
+        it copies the rows of model whose pk on the source is in pks, a list of ( source pk, target pk );
+        the ForeignKeys in field_names are remapped; the rows are written with the current MaterializedBuild
+        '''
+        quote_name = connections[ self.target_alias ].ops.quote_name
+        pk_column = quote_name( model._meta.pk.column )
+        columns = [ ]
+        values = [ ]
+        params = [ ]
+        for field in model._meta.concrete_fields:
+            column = quote_name( field.column )
+            columns.append( column )
+            if field.primary_key:
+                values.append( "CASE src." + pk_column + " " + " ".join( "WHEN %s THEN %s" for pk in pks ) + " END" )
+                for source_pk, target_pk in pks:
+                    params += [ source_pk, target_pk ]
+            elif field.__class__.__name__ == "ForeignKey":
+                values.append( self.remapped( field, "src." + column ) if field.name in field_names else "NULL" )
+            elif field.attname == 'materialized_build':
+                # see MaterializedBuild
+                values.append( "%s" )
+                params.append( knowledge_server.models.MaterializedBuild.written( model ) )
+            else:
+                values.append( "src." + column )
+        params += [ source_pk for source_pk, target_pk in pks ]
+        sql = "INSERT INTO " + self.table( self.target_alias, model ) + " (" + ", ".join( columns ) + ") SELECT " + \
+              ", ".join( values ) + " FROM " + self.table( self.source_alias, model ) + " src WHERE src." + \
+              pk_column + " IN (" + ", ".join( "%s" for pk in pks ) + ")"
+        with connections[ self.target_alias ].cursor( ) as cursor:
+            cursor.execute( sql, params )
+            if cursor.rowcount != len( pks ):
+                raise Exception( model.__name__ + ": " + str( cursor.rowcount ) + " rows copied instead of " +
+                                 str( len( pks ) ) + ", the rows on the source must be committed" )
+
+    def copy_many_to_many(self, descriptor, source_pks):
+        '''
+        the rows of the through table of the ManyToMany descriptor of the instances with source_pks
+        '''
+        quote_name = connections[ self.target_alias ].ops.quote_name
+        if descriptor.reverse:
+            source_name, target_name = descriptor.field.m2m_reverse_field_name( ), descriptor.field.m2m_field_name( )
+        else:
+            source_name, target_name = descriptor.field.m2m_field_name( ), descriptor.field.m2m_reverse_field_name( )
+        through = descriptor.through
+        source_field = through._meta.get_field( source_name )
+        target_field = through._meta.get_field( target_name )
+        source_column = quote_name( source_field.column )
+        target_column = quote_name( target_field.column )
+        for start in range( 0, len( source_pks ), BulkWriter.batch_size ):
+            batch = source_pks[ start:start + BulkWriter.batch_size ]
+            sql = "INSERT INTO " + self.table( self.target_alias, through ) + " (" + source_column + ", " + \
+                  target_column + ") SELECT " + self.remapped( source_field, "r." + source_column ) + ", " + \
+                  self.remapped( target_field, "r." + target_column ) + " FROM " + \
+                  self.table( self.source_alias, through ) + " r WHERE r." + source_column + " IN (" + \
+                  ", ".join( "%s" for pk in batch ) + ")"
+            with connections[ self.target_alias ].cursor( ) as cursor:
+                cursor.execute( sql, batch )
+
+
+class BulkDeletion():
+    '''
+    It deletes the instances of a dataset (not the dataset), on the database where the dataset is; it does
+    what ShareableModel.delete_children does one instance at a time:
+    - the instances, loaded with StructurePlan.prefetched, are walked once and their pks collected per model
+      class; external references and the instances shared with another version (see DataSet.writable and
+      ShareableModel.is_shared) are not deleted
+    - the instance that replaces each of them (the one whose UKCL_previous_version is its UKCL) is found with
+      a query per model class on the database of the dataset
+    - the ForeignKeys pointing at the deleted instances are remapped to the ones that replace them with an
+      UPDATE for each related model and ForeignKey, on the database of the dataset only: when a release is
+      deleted from materialized its instances are still on default, where the previous versions point at them
+    - then the instances are deleted with a DELETE for each model class
+    '''
+    batch_size = 1000
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.db_alias = dataset._state.db
+        # class -> { pk: UKCL } of the instances to delete, in the order they are found
+        self.to_delete = OrderedDict( )
+        self.sharing_versions = dataset.sharing_versions( )
+
+    def run(self):
+        plan = self.dataset.dataset_structure.serialization_plan( )
+        root = StructurePlan.prefetched( self.dataset.root, plan )
+        if root is not None and not root.is_shared( self.dataset, self.sharing_versions ):
+            self.collect( root, plan )
+        with transaction.atomic( using=self.db_alias ):
+            for model, instances in self.to_delete.items( ):
+                self.remap( model, instances )
+            # the children first
+            for model in reversed( list( self.to_delete.keys( ) ) ):
+                pks = list( self.to_delete[ model ].keys( ) )
+                for start in range( 0, len( pks ), self.batch_size ):
+                    model.objects.using( self.db_alias ).filter( pk__in=pks[ start:start + self.batch_size ] ).delete( )
+
+    def collect(self, instance, structure_node):
+        self.to_delete.setdefault( instance.__class__, OrderedDict( ) )[ instance.pk ] = instance.UKCL
+        for child_structure_node in structure_node.children:
+            if child_structure_node.external_reference or not child_structure_node.attribute or \
+                    child_structure_node.method_to_retrieve:
+                continue
+            if child_structure_node.is_many:
+                child_instances = getattr( instance, child_structure_node.attribute ).all( )
+            else:
+                child_instance = getattr( instance, child_structure_node.attribute )
+                child_instances = [ child_instance ] if child_instance is not None else [ ]
+            for child_instance in child_instances:
+                if not child_instance.pk in self.to_delete.get( child_instance.__class__, { } ) and \
+                        not child_instance.is_shared( self.dataset, self.sharing_versions ):
+                    self.collect( child_instance, child_structure_node )
+
+    def successors(self, model, db_alias, UKCLs):
+        '''
+        UKCL -> pk on db_alias of the instance that replaces it; None if there are more than one
+        '''
+        successors = { }
+        for start in range( 0, len( UKCLs ), self.batch_size ):
+            for UKCL_previous_version, pk in model.objects.using( db_alias ).filter(
+                    UKCL_previous_version__in=UKCLs[ start:start + self.batch_size ] ).values_list(
+                    'UKCL_previous_version', 'pk' ):
+                successors[ UKCL_previous_version ] = None if UKCL_previous_version in successors else pk
+        return successors
+
+    def remap(self, model, instances):
+        '''
+        instances: { pk: UKCL } of model on db_alias
+        '''
+        UKCLs = list( set( instances.values( ) ) )
+        successors = self.successors( model, self.db_alias, UKCLs )
+        # pk to be replaced -> pk that replaces it
+        mapping = { }
+        for pk, UKCL in instances.items( ):
+            if successors.get( UKCL ):
+                mapping[ pk ] = successors[ UKCL ]
+        for UKCL in UKCLs:
+            if successors.get( UKCL, 0 ) is None:
+                logger.error( 'NOT IMPLEMENTED in BulkDeletion: mapping between different versions: UKCL "' + UKCL +
+                              '" has more than one record that has it as UKCL_previous_version.' )
+        for rel in model._meta.fields_map.values( ):
+            if rel.__class__.__name__ != 'ManyToOneRel':
+                continue
+            self.update( rel.related_model, rel.field, self.db_alias, mapping )
+
+    def update(self, related_model, field, db_alias, mapping):
+        '''
+        the field of related_model pointing at a key of mapping is set to its value; the children being
+        deleted are updated as well, it makes no difference as they are deleted by pk
+        '''
+        old_pks = list( mapping.keys( ) )
+        for start in range( 0, len( old_pks ), self.batch_size ):
+            batch = old_pks[ start:start + self.batch_size ]
+            related = related_model.objects.using( db_alias ).filter( **{field.attname + "__in": batch} )
+            related.update( **{field.attname: Case(
+                *[ When( **{field.attname: old_pk, "then": Value( mapping[ old_pk ] )} ) for old_pk in batch ],
+                output_field=IntegerField( ) )} )
+
+
+def bulk_materialize(instance, structure_node, processed_instances=None, sql=True):
+    '''
+    it materializes instance with BulkMaterialization; what can't be done in bulk is materialized
+    one instance at a time with ShareableModel.materialize
+    sql: see BulkMaterialization
+    '''
+    if processed_instances is None:
+        processed_instances = ExportedInstances( )
+    try:
+        return BulkMaterialization( processed_instances, sql ).run( instance, structure_node )
+    except BulkNotPossible as ex:
+        logger.info( "bulk_materialize " + instance.UKCL + ": materializing one instance at a time, " + str( ex ) )
+        return instance.materialize( structure_node, processed_instances=processed_instances )
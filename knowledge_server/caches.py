@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Subject to the terms of the GNU AFFERO GENERAL PUBLIC LICENSE, v. 3.0. If a copy of the AGPL was not
+# distributed with this file, You can obtain one at http://www.gnu.org/licenses/agpl.txt
+#
+# Author: Davide Galletti                davide   ( at )   c4k.it
+
+'''
+A UKCL identifies released content that does not change (see DataSet.import_dataset) hence
+the serialization of an instance with a node of a structure can be reused every time the
+same instance is exported with the same node; FragmentCache keeps those fragments.
+Settings (all optional):
+    KS_FRAGMENT_CACHE = {
+        'CACHE_ALIAS': 'default',          # shared tier, one of settings.CACHES; None to disable it
+        'MAX_ENTRIES': 10000,              # in process LRU tier
+        'MAX_FRAGMENT_SIZE': 1024 * 1024,  # larger fragments are not cached
+        'TIMEOUT': 60 * 60 * 24 * 7,       # seconds a fragment is kept in the shared tier
+    }
+ModelMetadataRegistry keeps the ModelMetadata of each class, needed for each element serialized.
+'''
+
+import hashlib
+import logging
+import threading
+
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.http import FileResponse
+from django.views.decorators.cache import cache_page
+from django.views.decorators.http import condition
+
+import knowledge_server.models
+
+from knowledge_server.artifacts import ArtifactStore
+from knowledge_server.orm_wrapper import OrmWrapper
+from knowledge_server.utils import KsUrl
+
+logger = logging.getLogger(__name__)
+
+
+class ExportedInstances( list ):
+    '''
+    The list of the UKCLs already exported within a file (see ShareableModel.serialize); membership
+    is checked on a dictionary that also remembers the position where each UKCL has been added first
+    '''
+
+    def __init__(self, iterable=[ ]):
+        super( ExportedInstances, self ).__init__( )
+        self.first_position = {}
+        self.extend( iterable )
+
+    def append(self, UKCL):
+        if not UKCL in self.first_position:
+            self.first_position[ UKCL ] = len( self )
+        super( ExportedInstances, self ).append( UKCL )
+
+    def extend(self, iterable):
+        for UKCL in iterable:
+            self.append( UKCL )
+
+    def __contains__(self, UKCL):
+        return UKCL in self.first_position
+
+
+class FragmentCache():
+    '''
+    Two tiers: an LRU in this process and the django cache in settings (shared among processes).
+    A fragment is the serialization of an instance with a node; it depends on which instances have
+    already been exported in the same file as they are serialized with REFERENCE_IN_THIS_FILE. So with
+    the text I store:
+        exported:   the UKCLs added to exported_instances while producing it
+        references: those, among them, that had already been exported before it
+    and the fragment is reused only if none of exported has been exported yet and all of references have.
+    Only the instances of released datasets are cached (see DataSet.export_chunks).
+    '''
+    _local = OrderedDict( )
+    _lock = threading.Lock( )
+    _stats = {"local_hits": 0, "shared_hits": 0, "misses": 0, "not_reusable": 0, "stored": 0, "too_big": 0}
+
+    @staticmethod
+    def setting(name, default):
+        return getattr( settings, 'KS_FRAGMENT_CACHE', {} ).get( name, default )
+
+    @staticmethod
+    def count(name):
+        with FragmentCache._lock:
+            FragmentCache._stats[ name ] += 1
+
+    @staticmethod
+    def shared_cache():
+        alias = FragmentCache.setting( 'CACHE_ALIAS', 'default' )
+        return caches[ alias ] if alias else None
+
+    @staticmethod
+    def key(instance, structure_node, export_format):
+        '''
+        None if the fragment can't be cached (e.g. temporary nodes have no UKCL)
+        the pk is serialized for external references and it is different on default and materialized
+        '''
+        if not (instance.UKCL and structure_node.UKCL):
+            return None
+        return hashlib.sha1( "|".join(
+            [ instance.UKCL, structure_node.UKCL, str( structure_node.external_reference ), export_format,
+              str( instance._state.db ) ] ).encode( "utf-8" ) ).hexdigest( )
+
+    @staticmethod
+    def get(key, exported_instances):
+        fragment = None
+        with FragmentCache._lock:
+            if key in FragmentCache._local:
+                FragmentCache._local.move_to_end( key )
+                fragment = FragmentCache._local[ key ]
+                FragmentCache._stats[ "local_hits" ] += 1
+        if fragment is None:
+            shared_cache = FragmentCache.shared_cache( )
+            if shared_cache:
+                fragment = shared_cache.get( "ks_fragment_" + key )
+            if fragment is None:
+                FragmentCache.count( "misses" )
+                return None
+            FragmentCache.count( "shared_hits" )
+            FragmentCache.store_locally( key, fragment )
+        if any( UKCL in exported_instances for UKCL in fragment[ "exported" ] ) or \
+                not all( UKCL in exported_instances for UKCL in fragment[ "references" ] ):
+            FragmentCache.count( "not_reusable" )
+            return None
+        return fragment
+
+    @staticmethod
+    def store_locally(key, fragment):
+        with FragmentCache._lock:
+            FragmentCache._local[ key ] = fragment
+            FragmentCache._local.move_to_end( key )
+            while len( FragmentCache._local ) > FragmentCache.setting( 'MAX_ENTRIES', 10000 ):
+                FragmentCache._local.popitem( last=False )
+
+    @staticmethod
+    def store(key, fragment):
+        FragmentCache.store_locally( key, fragment )
+        shared_cache = FragmentCache.shared_cache( )
+        if shared_cache:
+            shared_cache.set( "ks_fragment_" + key, fragment, FragmentCache.setting( 'TIMEOUT', 60 * 60 * 24 * 7 ) )
+        FragmentCache.count( "stored" )
+
+    @staticmethod
+    def chunks(instance, structure_node, export_format, exported_instances, generate):
+        '''
+        Generator: it yields the cached fragment if there is a usable one, otherwise the chunks
+        of generate( ) (e.g. ShareableModel._xml_chunks) storing them
+        exported_instances must be an ExportedInstances
+        '''
+        key = FragmentCache.key( instance, structure_node, export_format )
+        if key is None:
+            yield from generate( )
+            return
+        fragment = FragmentCache.get( key, exported_instances )
+        if fragment:
+            exported_instances.extend( fragment[ "exported" ] + fragment[ "references" ] )
+            yield fragment[ "text" ]
+            return
+        max_size = FragmentCache.setting( 'MAX_FRAGMENT_SIZE', 1024 * 1024 )
+        start = len( exported_instances )
+        text = [ ]
+        size = 0
+        for chunk in generate( ):
+            if text is not None:
+                text.append( chunk )
+                size += len( chunk )
+                if size > max_size:
+                    # too big; I don't keep it in memory as it wouldn't be cached anyway
+                    text = None
+                    FragmentCache.count( "too_big" )
+            yield chunk
+        if text is not None:
+            added = exported_instances[ start: ]
+            references = list( set( UKCL for UKCL in added if exported_instances.first_position[ UKCL ] < start ) )
+            exported = list( set( added ) - set( references ) )
+            FragmentCache.store( key, {"text": "".join( text ), "exported": exported, "references": references} )
+
+    @staticmethod
+    def stats():
+        '''
+        counters to tune the cache: hits on each tier, misses, fragments found but not reusable within the file,
+        stored fragments and fragments too big to be stored; local_entries is the size of the in process LRU
+        '''
+        with FragmentCache._lock:
+            stats = dict( FragmentCache._stats )
+            stats[ "local_entries" ] = len( FragmentCache._local )
+        return stats
+
+    @staticmethod
+    def clear():
+        with FragmentCache._lock:
+            FragmentCache._local.clear( )
+
+
+class ModelMetadataRegistry():
+    '''
+    The ModelMetadata of each class (see ShareableModel.get_model_metadata) for each database: all the
+    ModelMetadata of a database are read with a single query the first time one is needed and they are read
+    again when Generation.MODEL_METADATA (a ModelMetadata saved or written in bulk) or Generation.RELEASE
+    (e.g. a dataset of ModelMetadata released or deleted) change; a class that is not found is looked for
+    once more on the database (e.g. its ModelMetadata has been saved within a transaction not committed yet)
+    '''
+    # db_alias -> { "generations": ( MODEL_METADATA, RELEASE ),
+    #               "by_name": { ( module, name ): [ ( netloc of the UKCL, ModelMetadata ) ] },
+    #               "resolved": { ( app_label, class name ): ModelMetadata } }
+    _registries = {}
+
+    @staticmethod
+    def registry(db_alias, reload=False):
+        Generation = knowledge_server.models.Generation
+        generations = ( Generation.current( Generation.MODEL_METADATA ), Generation.current( Generation.RELEASE ) )
+        registry = ModelMetadataRegistry._registries.get( db_alias )
+        if reload or registry is None or registry[ "generations" ] != generations:
+            by_name = {}
+            for mm in knowledge_server.models.ModelMetadata.objects.using( db_alias ).order_by( 'pk' ):
+                by_name.setdefault( ( mm.module, mm.name ), [ ] ).append( ( KsUrl( mm.UKCL ).netloc, mm ) )
+            registry = {"generations": generations, "by_name": by_name, "resolved": {}}
+            ModelMetadataRegistry._registries[ db_alias ] = registry
+        return registry
+
+    @staticmethod
+    def get(model_class, db_alias):
+        '''
+        the ModelMetadata of model_class on db_alias; ObjectDoesNotExist if there is none
+        '''
+        key = ( model_class._meta.app_label, model_class.__name__ )
+        registry = ModelMetadataRegistry.registry( db_alias )
+        if not key in registry[ "resolved" ]:
+            model_metadata = ModelMetadataRegistry.find( registry, key )
+            if model_metadata is None:
+                registry = ModelMetadataRegistry.registry( db_alias, reload=True )
+                model_metadata = ModelMetadataRegistry.find( registry, key )
+            if model_metadata is None:
+                raise ObjectDoesNotExist( "ModelMetadata not found. content_type.app_label=" + key[ 0 ] )
+            registry[ "resolved" ][ key ] = model_metadata
+        return registry[ "resolved" ][ key ]
+
+    @staticmethod
+    def find(registry, key):
+        # the netloc and the bare module of the ModelMetadata are reverse engineered from the app_label
+        # (see OrmWrapper.get_model_metadata_netloc and get_model_metadata_module)
+        mm_netloc = OrmWrapper.get_model_metadata_netloc( key[ 0 ] )
+        mm_module = OrmWrapper.get_model_metadata_module( key[ 0 ] )
+        for netloc, model_metadata in registry[ "by_name" ].get( ( mm_module, key[ 1 ] ), [ ] ):
+            if netloc == mm_netloc:
+                return model_metadata
+        return None
+
+    @staticmethod
+    def changed(db_alias='default'):
+        '''
+        to be invoked when ModelMetadata are written on db_alias; the registries of this process are dropped at
+        once, Generation.MODEL_METADATA is increased when the transaction is committed, once for each transaction,
+        and the other processes see it at the next one
+        '''
+        ModelMetadataRegistry._registries = {}
+        # once for each transaction; the callbacks of a transaction rolled back are discarded by django
+        if not any( getattr( callback, "model_metadata_registry", False ) for savepoints, callback in
+                    transaction.get_connection( db_alias ).run_on_commit ):
+            callback = lambda: ModelMetadataRegistry.bump_changed( )
+            callback.model_metadata_registry = True
+            transaction.on_commit( callback, using=db_alias )
+
+    @staticmethod
+    def bump_changed():
+        # what this process has read before the commit might be stale
+        ModelMetadataRegistry._registries = {}
+        knowledge_server.models.Generation.bump( knowledge_server.models.Generation.MODEL_METADATA )
+
+
+def cached_in_artifacts(view, timeout, key_prefix):
+    '''
+    cache_page doesn't store a StreamingHttpResponse: one returned by view (GET, status 200) is written to
+    the ArtifactStore while it is sent (see ArtifactStore.tee) and, once it has been sent completely, the cache
+    maps the request on the file; the next requests are served from the file (see ArtifactStore.response).
+    A stream truncated by an error (see api.streamed_response) is not stored
+    '''
+    cache = caches[ getattr( settings, 'CACHE_MIDDLEWARE_ALIAS', 'default' ) ]
+
+    @wraps( view )
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return view( request, *args, **kwargs )
+        cache_key = key_prefix + "_artifact_" + hashlib.md5( request.build_absolute_uri( ).encode( "utf-8" ) ).hexdigest( )
+        stored = cache.get( cache_key )
+        if stored:
+            response = ArtifactStore.response( stored[ 'content_hash' ], stored[ 'size' ], stored[ 'content_type' ] )
+            if response is not None:
+                ArtifactStore.touch( stored[ 'content_hash' ] )
+                return response
+            # removed by ArtifactStore.collect_garbage; it is rendered again
+        response = view( request, *args, **kwargs )
+        if not response.streaming or isinstance( response, FileResponse ) or response.status_code != 200:
+            return response
+
+        def written(content_hash, size):
+            if not getattr( response, 'truncated', False ):
+                cache.set( cache_key, { 'content_hash': content_hash, 'size': size,
+                                        'content_type': response[ 'Content-Type' ] }, timeout )
+
+        response.streaming_content = ArtifactStore.tee( response.streaming_content, written )
+        return response
+
+    return wrapper
+
+
+def cache_page_per_release(timeout):
+    '''
+    Decorator: like django cache_page but the cache key contains the current Generation.RELEASE,
+    so when a dataset is released (or deleted) the responses cached before are no longer used
+    and they are left to expire; hence the timeout can be long.
+    A StreamingHttpResponse is cached through the artifacts (see cached_in_artifacts)
+    '''
+    def decorator(view):
+        # the view decorated with cache_page for the current generation
+        decorated = {}
+
+        @wraps( view )
+        def wrapper(request, *args, **kwargs):
+            Generation = knowledge_server.models.Generation
+            key_prefix = "ks_release_" + str( Generation.current( Generation.RELEASE ) )
+            cached_view = decorated.get( key_prefix )
+            if cached_view is None:
+                cached_view = cached_in_artifacts( cache_page( timeout, key_prefix=key_prefix )( view ), timeout, key_prefix )
+                decorated.clear( )
+                decorated[ key_prefix ] = cached_view
+            return cached_view( request, *args, **kwargs )
+
+        return wrapper
+
+    return decorator
+
+
+def dataset_etag(dataset, response_format, UKCL=None):
+    '''
+    a strong ETag for the export in response_format of a released dataset, or of the instance UKCL in it;
+    what has a UKCL and has been released does not change, so the UKCL and the version identify the content.
+    None if the dataset is not released: its content can still change
+    '''
+    if dataset is None or not dataset.version_released:
+        return None
+    version = ".".join( str( n ) for n in ( dataset.version_major, dataset.version_minor, dataset.version_patch ) )
+    return hashlib.sha1( "|".join( [ dataset.UKCL, UKCL or dataset.UKCL, version, response_format ] ).encode(
+        "utf-8" ) ).hexdigest( )
+
+
+def conditional_get(validators):
+    '''
+    Decorator: django condition on ETag and Last-Modified; validators( request, *args, **kwargs ) returns
+    ( etag, last_modified ), either can be None when the response can't be validated. It is invoked once per
+    request and it must not serialize anything: If-None-Match and If-Modified-Since are answered with a 304
+    before the view is invoked
+    '''
+    def request_validators(request, *args, **kwargs):
+        if not hasattr( request, 'ks_validators' ):
+            try:
+                request.ks_validators = validators( request, *args, **kwargs )
+            except Exception as ex:
+                logger.warning( "conditional_get " + request.path + ": " + str( ex ) )
+                request.ks_validators = ( None, None )
+        return request.ks_validators
+
+    def etag(request, *args, **kwargs):
+        return request_validators( request, *args, **kwargs )[ 0 ]
+
+    def last_modified(request, *args, **kwargs):
+        return request_validators( request, *args, **kwargs )[ 1 ]
+
+    return condition( etag_func=etag, last_modified_func=last_modified )
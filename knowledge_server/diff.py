@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Subject to the terms of the GNU AFFERO GENERAL PUBLIC LICENSE, v. 3.0. If a copy of the AGPL was not
+# distributed with this file, You can obtain one at http://www.gnu.org/licenses/agpl.txt
+#
+# Author: Davide Galletti                davide   ( at )   c4k.it
+
+'''
+What changed between two versions of a dataset (see api_dataset_diff): both versions are loaded following
+their DataSetStructure with StructurePlan (a query per node of the structure, not per instance) and their
+instances are paired:
+    the same UKCL (shared, see DataSet.new_version with copy_on_write): unchanged
+    the UKCL_previous_version of the newer one is the UKCL of the older one: modified if their content_hash
+    differs, unchanged otherwise (but with a new UKCL)
+those of the newer version left are added, those of the older one are removed
+A subscriber that has the older version applies the diff (DataSetDelta) instead of importing the newer one
+'''
+
+import logging
+
+from collections import OrderedDict
+from lxml import etree
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+
+import knowledge_server.models
+
+from knowledge_server.orm_wrapper import OrmWrapper
+from knowledge_server.structure_plan import StructurePlan
+from knowledge_server.utils import KsUrl
+
+logger = logging.getLogger(__name__)
+
+
+class DataSetDiff():
+    def __init__(self, previous, current):
+        '''
+        previous and current are two versions (not views) of the same dataset
+        '''
+        self.previous = previous
+        self.current = current
+        previous_instances = DataSetDiff.instances( previous )
+        current_instances = DataSetDiff.instances( current )
+        self.added = [ ]
+        self.modified = [ ]
+        # unchanged, but with a new UKCL
+        self.renamed = [ ]
+        paired = set( )
+        for UKCL, instance in current_instances.items( ):
+            if UKCL in previous_instances:
+                paired.add( UKCL )
+            elif instance.UKCL_previous_version in previous_instances:
+                paired.add( instance.UKCL_previous_version )
+                if knowledge_server.models.ShareableModel.compare(
+                        instance, previous_instances[ instance.UKCL_previous_version ] ):
+                    self.renamed.append( instance )
+                else:
+                    self.modified.append( instance )
+            else:
+                self.added.append( instance )
+        self.removed = list( instance for UKCL, instance in previous_instances.items( ) if not UKCL in paired )
+
+    @staticmethod
+    def instances(dataset):
+        '''
+        UKCL -> instance for each instance in the dataset, external references excluded, sorted by UKCL
+        '''
+        plan = dataset.dataset_structure.serialization_plan( )
+        instances = { }
+        DataSetDiff.collect( StructurePlan.prefetched( dataset.root, plan ), plan, instances )
+        return OrderedDict( sorted( instances.items( ) ) )
+
+    @staticmethod
+    def collect(instance, structure_node, instances):
+        if instance.UKCL in instances:
+            return
+        instances[ instance.UKCL ] = instance
+        for child_structure_node in structure_node.children:
+            if child_structure_node.external_reference or not child_structure_node.attribute or \
+                    child_structure_node.method_to_retrieve:
+                continue
+            if child_structure_node.is_many:
+                child_instances = getattr( instance, child_structure_node.attribute ).all( )
+            else:
+                child_instance = getattr( instance, child_structure_node.attribute )
+                child_instances = [ child_instance ] if child_instance is not None else [ ]
+            for child_instance in child_instances:
+                DataSetDiff.collect( child_instance, child_structure_node, instances )
+
+    def chunks(self, export_format):
+        '''
+        the content of api_dataset_diff; the newer DataSet and each instance are exported without their
+        children (shallow)
+            XML:  <Diff from="..." to="..." content_hash="..."><DataSet .../><Added>...</Added><Removed>...</Removed>
+                  <Modified>...</Modified><Unchanged>...</Unchanged></Diff>
+            JSON: {"from": "...", "to": "...", "content_hash": "...", "DataSet": {...}, "Added": [ ... ],
+                   "Removed": [ ... ], "Modified": [ ... ], "Unchanged": [ ... ]}
+        a removed instance is exported as a reference: its class and UKCL; an unchanged one with the
+        UKCL it has in the previous version too; content_hash is the one of the newer version (see
+        DataSet.compute_content_hash), DataSetDelta checks the version it creates against it
+        '''
+        content_hash = self.current.content_hash or self.current.compute_content_hash( )
+        groups = ( ( "Added", self.added, False ), ( "Removed", self.removed, True ),
+                   ( "Modified", self.modified, False ), ( "Unchanged", self.renamed, True ) )
+        if export_format == 'XML':
+            yield '<Diff from="' + self.previous.UKCL + '" to="' + self.current.UKCL + '" content_hash="' + \
+                  content_hash + '">'
+            yield self.current.serialize( export_format='XML', exported_instances=[ ] )
+            for tag, instances, reference in groups:
+                yield "<" + tag + ">"
+                for instance in instances:
+                    if reference:
+                        yield '<' + instance.__class__.__name__ + ' UKCL="' + instance.UKCL + '" UKCL_previous_version="' + \
+                              ( instance.UKCL_previous_version or "" ) + '"/>'
+                    else:
+                        yield instance.serialize( export_format='XML', exported_instances=[ ] )
+                yield "</" + tag + ">"
+            yield "</Diff>"
+        if export_format == 'JSON':
+            yield '{"from": "' + self.previous.UKCL + '", "to": "' + self.current.UKCL + '", "content_hash": "' + \
+                  content_hash + '", '
+            yield self.current.serialize( export_format='JSON', exported_instances=[ ] )
+            for tag, instances, reference in groups:
+                yield ', "' + tag + '": ['
+                comma = ""
+                for instance in instances:
+                    yield comma
+                    comma = ", "
+                    if reference:
+                        yield '{"' + instance.__class__.__name__ + '": {"UKCL": "' + instance.UKCL + \
+                              '", "UKCL_previous_version": "' + ( instance.UKCL_previous_version or "" ) + '"}}'
+                    else:
+                        yield "{" + instance.serialize( export_format='JSON', exported_instances=[ ] ) + "}"
+                yield "]"
+            yield "}"
+
+
+class DeltaNotApplicable( Exception ):
+    pass
+
+
+class DataSetDelta():
+    '''
+    It creates here the version described by the XML of api_dataset_diff starting from the previous version,
+    that must be here: a new version of it is created (DataSet.new_version), the instances removed are deleted,
+    those modified are updated, the others get the UKCL they have in the new version and the instances added are
+    created. DeltaNotApplicable if it can't be done or if the version created doesn't have the content_hash
+    of the diff; the caller imports the whole dataset instead
+    Of a modified instance the attributes that are not relationships and the ForeignKeys are updated, those are
+    what DataSetDiff compares (see ShareableModel.content_hash)
+    '''
+
+    def __init__(self, previous, delta_xml):
+        self.previous = previous
+        self.delta_xml = delta_xml
+        self.structure_netloc = KsUrl( previous.dataset_structure.UKCL ).netloc
+
+    def apply(self):
+        '''
+        it returns the new version; it is not materialized
+        '''
+        root = etree.fromstring( self.delta_xml )
+        diff = root if root.tag == "Diff" else root.find( "Diff" )
+        if diff is None or diff.attrib.get( "from" ) != self.previous.UKCL:
+            raise DeltaNotApplicable( "it is not a diff from " + self.previous.UKCL )
+        content_hash = diff.attrib.get( "content_hash" )
+        if not content_hash:
+            raise DeltaNotApplicable( "the diff from " + self.previous.UKCL + " has no content_hash" )
+        with transaction.atomic( ):
+            new_dataset = self.previous.new_version( )
+            if new_dataset.pk is None:
+                raise DeltaNotApplicable( "the new version of " + self.previous.UKCL + " has not been created" )
+            # the copies of the instances of previous, by the UKCL in previous
+            self.copies = dict( ( instance.UKCL_previous_version, instance ) for instance in
+                                DataSetDiff.instances( new_dataset ).values( ) )
+            for element in self.group( diff, "Unchanged" ):
+                copy = self.copy_of( element.attrib[ "UKCL_previous_version" ] )
+                copy.UKCL = element.attrib[ "UKCL" ]
+                copy.save( )
+            modified = [ ]
+            for element in self.group( diff, "Modified" ):
+                copy = self.copy_of( element.attrib[ "UKCL_previous_version" ] )
+                DataSetDelta.update_from_xml( copy, element )
+                copy.save( )
+                modified.append( ( copy, element ) )
+            for element in self.group( diff, "Removed" ):
+                self.copy_of( element.attrib[ "UKCL" ] ).delete( )
+            if len( self.copies ) > 0:
+                # e.g. instances shared by the two versions (copy_on_write) have been copied here
+                raise DeltaNotApplicable( str( len( self.copies ) ) + " instances of " + self.previous.UKCL +
+                                          " are not in the diff" )
+            DataSetDelta.update_from_xml( new_dataset, diff.find( "DataSet" ) )
+            new_dataset.knowledge_server = self.previous.knowledge_server
+            new_dataset.save( )
+            self.create( self.group( diff, "Added" ) )
+            # the instances they refer to might have been added
+            for copy, element in modified:
+                if not DataSetDelta.set_foreign_keys( copy, element ):
+                    raise DeltaNotApplicable( "an instance " + copy.UKCL + " refers to is missing" )
+                copy.save( )
+            new_dataset.set_dataset_on_instances( )
+            # the transaction is rolled back if the version created is not the one the diff describes
+            if new_dataset.compute_content_hash( ) != content_hash:
+                raise DeltaNotApplicable( "the version created from " + self.previous.UKCL + " and the diff to " +
+                                          diff.attrib.get( "to", "" ) + " have different content" )
+        return new_dataset
+
+    @staticmethod
+    def group(diff, tag):
+        elements = diff.find( tag )
+        return list( elements ) if elements is not None else [ ]
+
+    def copy_of(self, UKCL):
+        if not UKCL in self.copies:
+            raise DeltaNotApplicable( UKCL + " is not in " + self.previous.UKCL )
+        return self.copies.pop( UKCL )
+
+    @staticmethod
+    def update_from_xml(instance, element):
+        '''
+        attributes_from_xml but the pk and the ids of the GenericForeignKeys which are local
+        '''
+        if element is None:
+            raise DeltaNotApplicable( "an element is missing in the diff" )
+        kept = [ instance._meta.pk.attname ] + list(
+            field.fk_field for field in instance._meta.virtual_fields if hasattr( field, 'fk_field' ) )
+        values = dict( ( name, getattr( instance, name ) ) for name in kept )
+        instance.attributes_from_xml( element )
+        for name, value in values.items( ):
+            setattr( instance, name, value )
+
+    def create(self, elements):
+        '''
+        the instances added; an instance is created once the instances it refers to with its ForeignKeys are here
+        '''
+        while len( elements ) > 0:
+            left = list( element for element in elements if not self.created( element ) )
+            if len( left ) == len( elements ):
+                raise DeltaNotApplicable( str( len( left ) ) + " instances added can't be created" )
+            elements = left
+
+    def created(self, element):
+        model_metadata = knowledge_server.models.ShareableModel.model_metadata_from_xml_tag( element )
+        actual_class = OrmWrapper.load_class( self.structure_netloc, model_metadata.module, model_metadata.name )
+        instance = actual_class( )
+        instance.attributes_from_xml( element )
+        if not DataSetDelta.set_foreign_keys( instance, element ):
+            return False
+        instance.save( )
+        return True
+
+    @staticmethod
+    def set_foreign_keys(instance, element):
+        '''
+        the ForeignKeys of instance as referenced in element; False if an instance referred to is not here
+        '''
+        for field_name in instance.foreign_key_attributes( ):
+            references = [ child for child in element if child.tag == field_name ]
+            # dataset_I_belong_to is set by set_dataset_on_instances
+            if field_name == 'dataset_I_belong_to' or len( references ) == 0:
+                continue
+            try:
+                target = instance._meta.get_field( field_name ).related_model.objects.get(
+                    UKCL=references[ 0 ].attrib[ "UKCL" ] )
+            except ObjectDoesNotExist:
+                return False
+            setattr( instance, field_name, target )
+        return True
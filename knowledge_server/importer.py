@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Subject to the terms of the GNU AFFERO GENERAL PUBLIC LICENSE, v. 3.0. If a copy of the AGPL was not
+# distributed with this file, You can obtain one at http://www.gnu.org/licenses/agpl.txt
+#
+# Author: Davide Galletti                davide   ( at )   c4k.it
+
+'''
+The import of the export of a DataSet (see DataSet.export_chunks and DataSet.import_dataset).
+The file is read with lxml iterparse in a single pass: elements are imported while the file is
+being parsed, following the structure of the DataSet, and removed from the tree once saved so
+that the memory used depends on the depth of the structure and not on the size of the file.
+
+An instance is imported in two steps (see ShareableModel.save_from_xml):
+    save_head_from_xml  attributes and foreign keys; then the instance is saved
+    children_from_xml   the other children, that need the instance saved as their parent
+The first step is done as soon as the first child that needs a parent starts; from then on each
+child is imported as soon as its end tag is parsed. If a ForeignKey that can't be null has not
+been found yet the instance can't be saved: its whole element is kept and imported at its end tag.
+
+In bulk mode (see BulkImport) each ActualInstance is kept in memory and its instances are written
+with bulk_create, a few queries per model class instead of a few queries per instance.
+'''
+
+import io
+import logging
+
+from lxml import etree
+
+from django.db import transaction
+
+import knowledge_server.models
+from knowledge_server.bulk import BulkNotPossible, BulkWriter
+from knowledge_server.orm_wrapper import OrmWrapper
+from knowledge_server.structure_plan import StructurePlan
+from knowledge_server.utils import KsUrl
+
+logger = logging.getLogger(__name__)
+
+
+class ImportFrame():
+    '''
+    An element being parsed
+    '''
+    OTHER = "other"                  # e.g. the tags of the attributes; left to its parent
+    SKIP = "skip"                    # in an ActualInstance already in the database
+    DATASET = "dataset"
+    ACTUAL_INSTANCE = "actual_instance"
+    INSTANCE = "instance"
+    MANY = "many"                    # the tag with the list of the instances of an is_many node
+
+    def __init__(self, kind, element, structure_node=None, owner=None):
+        self.kind = kind
+        self.element = element
+        self.structure_node = structure_node
+        # the INSTANCE frame this is a child of
+        self.owner = owner
+        # the instance, once saved
+        self.instance = None
+        # False when the instance will be imported at its end tag, see the module documentation
+        self.streaming = owner is None or owner.instance is not None
+        # True if it is a ForeignKey or a GenericForeignKey of the owner
+        self.before_owner = False
+        # the class of the instance, see DataSetImport.instance_class
+        self.actual_class = None
+        self.class_known = False
+        self._foreign_keys = None
+
+
+class DataSetImport():
+    '''
+    It imports a DataSet from an XML source: bytes, a string or a file like object (e.g. the response of urlopen)
+    bulk: see BulkImport
+    '''
+
+    def __init__(self, dataset, bulk=False):
+        self.dataset = dataset
+        self.bulk = bulk
+        self.stack = [ ]
+        self.dataset_element = None
+        self.dataset_structure = None
+        self.structure_netloc = None
+        self.root_node = None
+        self.actual_class = None
+        self.actual_instance = None
+        self.result = None
+
+    def run(self, source):
+        if isinstance( source, str ):
+            source = source.encode( "utf-8" )
+        if isinstance( source, bytes ):
+            source = io.BytesIO( source )
+        # http://stackoverflow.com/questions/3310614/remove-whitespaces-in-xml-string
+        events = etree.iterparse( source, events=( "start", "end" ), remove_blank_text=True )
+        # the dataset_structure tag is before the ActualInstance; the structure is prepared outside of the transaction
+        for event, element in events:
+            self.parsed( event, element )
+            if self.dataset_structure:
+                break
+        if self.dataset_structure is None:
+            raise Exception( "DataSetImport: there is no dataset_structure in the file" )
+        try:
+            with transaction.atomic( ):
+                for event, element in events:
+                    self.parsed( event, element )
+        except Exception as ex:
+            logger.error( "import_dataset: " + str( ex ) )
+            raise ex
+        return self.result
+
+    def parsed(self, event, element):
+        if event == "start":
+            self.stack.append( self.frame( element ) )
+        else:
+            self.end( self.stack.pop( ) )
+
+    def frame(self, element):
+        if len( self.stack ) == 0:
+            # Export
+            return ImportFrame( ImportFrame.OTHER, element )
+        parent = self.stack[ -1 ]
+        if len( self.stack ) == 1:
+            self.dataset_element = element
+            return ImportFrame( ImportFrame.DATASET, element )
+        if element.tag == "ActualInstance" and (parent.kind == ImportFrame.DATASET or parent.element.tag == "ActualInstances"):
+            return ImportFrame( ImportFrame.ACTUAL_INSTANCE, element )
+        if parent.kind == ImportFrame.ACTUAL_INSTANCE:
+            # already imported ?
+            try:
+                self.actual_instance = self.actual_class.retrieve_locally( element.attrib[ "UKCL" ] )
+                # it is already in this database; no need to import it again; UKCL is a persistent unique
+                # identifier so changing the data it identifies would be an error
+                return ImportFrame( ImportFrame.SKIP, element )
+            except:  # I didn't find it on this db, no problem
+                frame = ImportFrame( ImportFrame.INSTANCE, element, self.root_node )
+                frame.actual_class = self.actual_class
+                frame.class_known = True
+                # in bulk mode the whole ActualInstance is imported at its end tag
+                frame.streaming = not self.bulk
+                return frame
+        if parent.kind == ImportFrame.SKIP:
+            return ImportFrame( ImportFrame.SKIP, element )
+        if parent.kind == ImportFrame.MANY:
+            return ImportFrame( ImportFrame.INSTANCE, element, parent.structure_node, parent.owner )
+        # what is below an instance that is not streaming is imported with it
+        if parent.kind == ImportFrame.INSTANCE and parent.streaming and not parent.structure_node.external_reference:
+            for child_structure_node in parent.structure_node.children:
+                if child_structure_node.attribute == element.tag and not child_structure_node.method_to_retrieve:
+                    break
+            else:
+                return ImportFrame( ImportFrame.OTHER, element )
+            before_owner = child_structure_node.attribute in self.foreign_keys( parent )
+            if not before_owner:
+                self.save_head( parent )
+            if child_structure_node.is_many:
+                return ImportFrame( ImportFrame.MANY, element, child_structure_node, parent )
+            frame = ImportFrame( ImportFrame.INSTANCE, element, child_structure_node, parent )
+            frame.before_owner = before_owner
+            if before_owner:
+                # it is imported with foreign_key_from_xml before saving the owner
+                frame.streaming = False
+            return frame
+        return ImportFrame( ImportFrame.OTHER, element )
+
+    def instance_class(self, frame):
+        '''
+        the class of the instance of frame; None if it can't be known before the owner is saved (GenericForeignKey)
+        it is needed only if the instance is saved while parsing its children
+        '''
+        if not frame.class_known:
+            if frame.structure_node.model_metadata or frame.owner.instance:
+                frame.actual_class = knowledge_server.models.ShareableModel.class_from_xml(
+                    self.structure_netloc, frame.element, frame.structure_node, frame.owner.instance )
+            frame.class_known = True
+        return frame.actual_class
+
+    def end(self, frame):
+        element = frame.element
+        if frame.kind == ImportFrame.SKIP:
+            self.remove( element )
+        elif frame.kind == ImportFrame.ACTUAL_INSTANCE:
+            self.remove( element )
+        elif frame.kind == ImportFrame.DATASET:
+            self.import_dataset_record( )
+        elif frame.kind == ImportFrame.OTHER and element.tag == "dataset_structure" and \
+                self.stack[ -1 ].kind == ImportFrame.DATASET:
+            self.prepare_structure( )
+        elif frame.kind == ImportFrame.INSTANCE:
+            owner = frame.owner
+            if owner is None:
+                self.actual_instance = self.import_instance( frame, None )
+                self.remove( element )
+            elif owner.instance is not None:
+                # the owner has been saved, the instance can be imported now
+                if frame.before_owner:
+                    owner.instance.foreign_key_from_xml( self.structure_netloc, element, frame.structure_node )
+                    owner.instance.save( )
+                else:
+                    self.import_instance( frame, owner )
+                self.remove( element )
+            # otherwise it will be imported with its owner
+
+    def import_instance(self, frame, owner):
+        '''
+        the instance in the element of frame, a child of owner (or the actual instance if owner is None)
+        '''
+        if frame.instance is None:
+            if owner is None:
+                if self.bulk:
+                    try:
+                        return BulkImport( self.structure_netloc ).run( frame.element, self.root_node,
+                                                                        self.actual_class )
+                    except BulkNotPossible as ex:
+                        logger.info( "DataSetImport: importing one instance at a time, " + str( ex ) )
+                instance = self.actual_class( )
+                instance.save_from_xml( self.structure_netloc, frame.element, self.root_node )
+                return instance
+            owner.instance.child_from_xml( self.structure_netloc, frame.element, frame.structure_node )
+            return None
+        # its head has already been saved; its children have been imported while parsing, if not they are still there
+        frame.instance.children_from_xml( self.structure_netloc, frame.element, frame.structure_node )
+        if owner is not None:
+            owner.instance.add_imported_child( frame.structure_node, frame.instance )
+        return frame.instance
+
+    def save_head(self, frame):
+        '''
+        it saves the instance of frame (see ShareableModel.save_head_from_xml) if it can be done now
+        '''
+        if frame.instance is not None or not frame.streaming:
+            return
+        element = frame.element
+        structure_node = frame.structure_node
+        if "REFERENCE_IN_THIS_FILE" in element.attrib or structure_node.external_reference or \
+                self.instance_class( frame ) is None:
+            frame.streaming = False
+            return
+        instance = frame.actual_class( )
+        # a ForeignKey that can't be null must be there before saving
+        for attribute in self.foreign_keys( frame ):
+            if len( knowledge_server.models.xml_children( element, attribute ) ) == 0:
+                try:
+                    null = getattr( instance._meta.get_field( attribute ), "null", False )
+                except Exception:
+                    null = False
+                if not null:
+                    frame.streaming = False
+                    return
+        instance.save_head_from_xml( self.structure_netloc, element, structure_node,
+                                     frame.owner.instance if frame.owner else None )
+        frame.instance = instance
+        # the foreign keys have been imported, their elements can be removed
+        for child in list( element ):
+            if child.tag in self.foreign_keys( frame ):
+                self.remove( child )
+
+    def foreign_keys(self, frame):
+        '''
+        the attributes of the children of the instance of frame that are set before saving it
+        '''
+        if frame._foreign_keys is None:
+            frame._foreign_keys = set( )
+            if self.instance_class( frame ):
+                instance = frame.actual_class( )
+                for child_structure_node in frame.structure_node.children:
+                    if instance.is_set_before_saving( child_structure_node ):
+                        frame._foreign_keys.add( child_structure_node.attribute )
+        return frame._foreign_keys
+
+    def prepare_structure(self):
+        '''
+        the DataSetStructure of the DataSet, from the dataset_structure tag that is before the ActualInstance
+        '''
+        if self.dataset_structure:
+            return
+        tags = knowledge_server.models.xml_children( self.dataset_element, "dataset_structure" )
+        DataSetStructureURI = tags[ 0 ].attrib[ "UKCL" ]
+        # The structure netloc tells me the OKS that created the structure and the models for the nodes
+        # so I will pass it to load_class in this method and in from_xml too
+        self.structure_netloc = KsUrl( DataSetStructureURI ).netloc
+
+        # the structure is present locally because when I receive a dataset I import the structure before importing the dataset itself
+        es = knowledge_server.models.DataSetStructure.retrieve_locally( DataSetStructureURI )
+        es.make_persistable( )
+        self.dataset.dataset_structure = es
+        self.root_node = StructurePlan.for_structure( es )
+        self.actual_class = OrmWrapper.load_class( self.structure_netloc, es.root_node.model_metadata.module,
+                                                   es.root_node.model_metadata.name )
+        self.dataset_structure = es
+
+    def import_dataset_record(self):
+        '''
+        finished importing the data contained in the dataset
+        let's create the record for the DataSet if not already imported
+        '''
+        DataSet = knowledge_server.models.DataSet
+        es = self.dataset_structure
+        dataset_UKCL = self.dataset_element.attrib[ "UKCL" ]
+        try:
+            dataset_on_db = DataSet.retrieve_locally( dataset_UKCL )
+            logger.warning(
+                "DataSet.import_dataset - I am importing a DataSet that is already in this database; it seems it doesn't not make sense; take a look at it: " + dataset_UKCL )
+            if not es.is_a_view:
+                dataset_on_db.root = self.actual_instance
+                dataset_on_db.save( )
+            self.result = dataset_on_db
+        except:  # I didn't find it on this db, no problem
+            # In the next call the KnowledgeServer owner of this DataSet must exist
+            # because it was imported while subscribing; it is imported by this very same method
+            # since it is in the actual instance the next method will find it
+            # netloc is "root.beta.thekoa.org" as I am importing a dataset (whose structure is
+            # owned by root)
+            self.dataset.save_from_xml( "root.beta.thekoa.org", self.dataset_element,
+                                        self.dataset.shallow_structure( ).root_node )
+            if not es.is_a_view:
+                self.dataset.root = self.actual_instance
+                self.dataset.save( )
+            self.result = self.dataset
+
+    @staticmethod
+    def remove(element):
+        '''
+        the element has been imported; I free the memory
+        '''
+        element.clear( )
+        parent = element.getparent( )
+        if parent is not None:
+            parent.remove( element )
+
+
+class BulkImport( BulkWriter ):
+    '''
+    It imports an instance and everything below it in the structure with bulk_create (see BulkWriter):
+    the element is walked once and an unsaved instance is created for each tag; the relationships
+    are recorded using the UKCL found in the file (the UKCL is assigned up front, model_post_save
+    has nothing to do)
+    What bulk_create can't do raises BulkNotPossible before anything is written and the caller
+    imports the element with save_from_xml: GenericForeignKeys, DataSets, multi table inheritance,
+    instances without UKCL or defined twice, cycles between instances
+    '''
+
+    def __init__(self, structure_netloc):
+        super( BulkImport, self ).__init__( 'default' )
+        self.structure_netloc = structure_netloc
+        # UKCL -> ( class, { field: UKCL of the parent } ) of the instances on the database referenced in the file
+        self.on_db_links = { }
+        # the ModelMetadata already checked: ( structure node pk, URIModelMetadata )
+        self.checked = set( )
+
+    def run(self, element, structure_node, actual_class):
+        '''
+        it imports element and returns the saved instance
+        '''
+        try:
+            UKCL = self.collect( element, structure_node, actual_class )
+            self.load_on_db( )
+            waves = self.waves( )
+        except BulkNotPossible:
+            raise
+        except Exception as ex:
+            raise BulkNotPossible( str( ex ) )
+        with transaction.atomic( ):
+            self.write_instances( waves )
+            self.update_on_db( )
+        return self.instances[ UKCL ]
+
+    def collect(self, element, structure_node, actual_class, parent_UKCL=None, parent_field_name=""):
+        '''
+        it creates the (unsaved) instance in element and in its children; it returns its UKCL
+        '''
+        UKCL = element.attrib.get( "UKCL", "" )
+        if not UKCL:
+            raise BulkNotPossible( "an instance of " + actual_class.__name__ + " has no UKCL" )
+        if "REFERENCE_IN_THIS_FILE" in element.attrib:
+            if parent_field_name:
+                self.link( UKCL, actual_class, parent_field_name, parent_UKCL )
+            return UKCL
+        if UKCL in self.instances:
+            raise BulkNotPossible( UKCL + " is in the file twice" )
+        if issubclass( actual_class, knowledge_server.models.DataSet ) or len( actual_class._meta.parents ) > 0:
+            raise BulkNotPossible( actual_class.__name__ + " can't be created with bulk_create" )
+        instance = actual_class( )
+        instance.attributes_from_xml( element, parent_field_name )
+        instance.UKCL = UKCL
+        self.instances[ UKCL ] = instance
+        self.links[ UKCL ] = { }
+        if parent_field_name:
+            self.link( UKCL, actual_class, parent_field_name, parent_UKCL )
+        FK_attributes = instance.foreign_key_attributes( ) + instance.virtual_field_attributes( )
+        for child_structure_node in structure_node.children:
+            if child_structure_node.method_to_retrieve or not child_structure_node.attribute:
+                continue
+            tags = knowledge_server.models.xml_children( element, child_structure_node.attribute )
+            if len( tags ) == 0:
+                continue
+            if child_structure_node.model_metadata is None:
+                raise BulkNotPossible( "GenericForeignKey " + child_structure_node.attribute )
+            if instance.is_set_before_saving( child_structure_node ):
+                child_class = self.child_class( tags[ 0 ], child_structure_node )
+                child_UKCL = tags[ 0 ].attrib[ "UKCL" ]
+                if child_structure_node.external_reference:
+                    self.on_db[ child_UKCL ] = child_class
+                else:
+                    self.collect( tags[ 0 ], child_structure_node, child_class )
+                self.link( UKCL, actual_class, child_structure_node.attribute, child_UKCL )
+            elif not child_structure_node.attribute in FK_attributes:
+                field_name = knowledge_server.models.ShareableModel.get_parent_field_name( instance,
+                                                                                          child_structure_node.attribute )
+                xml_child_nodes = list( tags[ 0 ] ) if child_structure_node.is_many else [ tags[ 0 ] ]
+                for xml_child_node in xml_child_nodes:
+                    child_class = self.child_class( xml_child_node, child_structure_node )
+                    if child_structure_node.external_reference:
+                        if field_name:
+                            raise BulkNotPossible( "external reference " + child_structure_node.attribute )
+                        child_UKCL = xml_child_node.attrib[ "UKCL" ]
+                        self.on_db[ child_UKCL ] = child_class
+                    else:
+                        child_UKCL = self.collect( xml_child_node, child_structure_node, child_class, UKCL, field_name )
+                    if not field_name:
+                        self.many_to_many.append( ( UKCL, child_structure_node.attribute, child_UKCL ) )
+        return UKCL
+
+    def child_class(self, xml_child_node, child_structure_node):
+        '''
+        see ShareableModel.class_from_xml; the ModelMetadata is checked once for each node
+        '''
+        key = ( child_structure_node.pk, xml_child_node.attrib.get( "URIModelMetadata" ) )
+        model_metadata = child_structure_node.model_metadata
+        if not key in self.checked:
+            se = knowledge_server.models.ShareableModel.model_metadata_from_xml_tag( xml_child_node )
+            assert (model_metadata.name == se.name), "child_structure_node.model_metadata.name - se.name: " + \
+                                                     model_metadata.name + ' - ' + se.name
+            self.checked.add( key )
+        return OrmWrapper.load_class( self.structure_netloc, model_metadata.module, model_metadata.name )
+
+    def link(self, UKCL, actual_class, field_name, target_UKCL):
+        '''
+        the field_name of UKCL refers to target_UKCL; if UKCL is not in the file it is on the database
+        (REFERENCE_IN_THIS_FILE) and it will be updated after the import
+        '''
+        if UKCL in self.links:
+            self.links[ UKCL ][ field_name ] = target_UKCL
+        else:
+            self.on_db_links.setdefault( UKCL, ( actual_class, { } ) )[ 1 ][ field_name ] = target_UKCL
+
+    def load_on_db(self):
+        '''
+        the instances referenced in the file that are not in it must be on the database
+        '''
+        for UKCL, ( actual_class, links ) in list( self.on_db_links.items( ) ):
+            if UKCL in self.instances:
+                # referenced before being found in the file; what is found later prevails
+                for field_name, target_UKCL in links.items( ):
+                    self.links[ UKCL ].setdefault( field_name, target_UKCL )
+                del self.on_db_links[ UKCL ]
+            else:
+                self.on_db[ UKCL ] = actual_class
+        missing_in_file = [ UKCL for UKCL in self.on_db.keys( ) if not UKCL in self.instances ]
+        by_class = { }
+        for UKCL in missing_in_file:
+            by_class.setdefault( self.on_db[ UKCL ], [ ] ).append( UKCL )
+        self.on_db = { }
+        for actual_class, UKCLs in by_class.items( ):
+            for instance in actual_class.objects.filter( UKCL__in=UKCLs ):
+                self.on_db[ instance.UKCL ] = instance
+        for UKCL in missing_in_file:
+            if not UKCL in self.on_db:
+                # save_from_xml knows how to deal with it (dangling references, ...)
+                raise BulkNotPossible( UKCL + " is neither in the file nor on the database" )
+        for UKCL, links in self.links.items( ):
+            for target_UKCL in links.values( ):
+                if not target_UKCL in self.instances and not target_UKCL in self.on_db:
+                    raise BulkNotPossible( target_UKCL + " is neither in the file nor on the database" )
+
+    def update_on_db(self):
+        '''
+        the instances on the database referenced in the file whose parent is in the file (see save_head_from_xml)
+        '''
+        for UKCL, ( actual_class, links ) in self.on_db_links.items( ):
+            instance = self.on_db[ UKCL ]
+            for field_name, target_UKCL in links.items( ):
+                setattr( instance, field_name, self.saved( target_UKCL ) )
+            instance.save( )
+
+
+def model_metadata_UKCLs(source):
+    '''
+    the UKCL of all the <model_metadata> tags in the XML (e.g. the export of a DataSetStructure) read with iterparse
+    '''
+    if isinstance( source, str ):
+        source = source.encode( "utf-8" )
+    if isinstance( source, bytes ):
+        source = io.BytesIO( source )
+    UKCLs = set( )
+    for event, element in etree.iterparse( source, events=( "end", ), tag="model_metadata" ):
+        UKCLs.add( element.attrib[ "UKCL" ] )
+        element.clear( )
+    return list( UKCLs )
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Subject to the terms of the GNU AFFERO GENERAL PUBLIC LICENSE, v. 3.0. If a copy of the AGPL was not
+# distributed with this file, You can obtain one at http://www.gnu.org/licenses/agpl.txt
+#
+# Author: Davide Galletti                davide   ( at )   c4k.it
+
+import os
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+
+from knowledge_server.models import ReleaseJob
+
+
+class Command(BaseCommand):
+    help = 'Runs the releases queued by the release_dataset view (see ReleaseJob)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='run the jobs queued and exit instead of waiting for new ones')
+        parser.add_argument('--sleep', type=float, default=5,
+                            help='seconds to wait when there are no jobs')
+
+    def handle(self, *args, **options):
+        worker = socket.gethostname() + ":" + str(os.getpid())
+        while True:
+            count = ReleaseJob.run_pending(worker)
+            if count > 0:
+                self.stdout.write("Run " + str(count) + " release jobs")
+            if options['once']:
+                break
+            time.sleep(options['sleep'])
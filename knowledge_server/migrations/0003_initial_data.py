@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 import logging
 from django.db import migrations
 from knowledge_server.models import Organization, KnowledgeServer, ModelMetadata, StructureNode, DataSetStructure, DataSet
+from knowledge_server.models import DataMigration
 from ap.models import Workflow, WorkflowStatus
 from licenses.models import License
 
@@ -1143,9 +1144,10 @@ class Migration(migrations.Migration):
         ('ap', '0001_initial'),
     ]
 
+    # forwards_func writes with the current models: it is run once the later migrations have been applied
     operations = [
         migrations.RunPython(
-            forwards_func,
+            DataMigration.after_migrate(forwards_func),
         ),
     ]
 
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_server', '0006_dataset_copy_on_write'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='superseded',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_server', '0007_dataset_superseded'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflow',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='workflowstatus',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='dataset',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='datasetstructure',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='knowledgeserver',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='modelmetadata',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='notificationreceived',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='structurenode',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='subscriptiontoother',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='subscriptiontothis',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_server', '0008_materialized_build'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReleaseJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dataset_UKCL', models.CharField(max_length=750)),
+                ('status', models.CharField(db_index=True, default='pending', max_length=20)),
+                ('phase', models.CharField(blank=True, default='', max_length=20)),
+                ('message', models.TextField(blank=True, default='')),
+                ('worker', models.CharField(blank=True, default='', max_length=200)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
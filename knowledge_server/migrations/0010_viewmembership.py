@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_server', '0009_releasejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ViewMembership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('instance_UKCL', models.CharField(blank=True, db_index=True, default='', max_length=750)),
+                ('dataset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='knowledge_server.DataSet')),
+            ],
+        ),
+    ]
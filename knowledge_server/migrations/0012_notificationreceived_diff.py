@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('knowledge_server', '0011_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationreceived',
+            name='previous_UKCL',
+            field=models.CharField(blank=True, default='', max_length=750),
+        ),
+        migrations.AddField(
+            model_name='notificationreceived',
+            name='URL_diff',
+            field=models.CharField(blank=True, default='', max_length=2000),
+        ),
+    ]
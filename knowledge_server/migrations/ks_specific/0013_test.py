@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 
 from django.db import models, migrations
 from knowledge_server.models import Organization, KnowledgeServer, DataSet, DataSetStructure
+from knowledge_server.models import DataMigration
 
 def forwards_func(apps, schema_editor):
     org_ks={
@@ -20,12 +21,12 @@ def forwards_func(apps, schema_editor):
 class Migration(migrations.Migration):
 
     dependencies = [
-        ('knowledge_server', '0003_initial_data'),
+        ('knowledge_server', '0012_notificationreceived_diff'),
     ]
 
     operations = [
         migrations.RunPython(
-            forwards_func,
+            DataMigration.after_migrate(forwards_func),
         ),
     ]
 
@@ -11,17 +11,22 @@ Whatever is not related to persistence should be moved to the Domain or
 Business Layer
 '''
 
+import contextlib
+import copy
+import hashlib
 import importlib
 import inspect
 import json
 import logging
 import os
+import threading
+import time
 import urllib
+from urllib.error import HTTPError
 from urllib.request import urlopen, Request
 
 from collections import OrderedDict
-from datetime import datetime
-from lxml import etree
+from datetime import datetime, timedelta
 from xml.dom import minidom
 
 from django.apps.registry import apps as global_apps
@@ -33,16 +38,24 @@ from django.core.urlresolvers import reverse
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models, transaction
+from django.db import connections, models, router, transaction
 from django.db.migrations.autodetector import MigrationAutodetector
 from django.db.migrations.graph import MigrationGraph
 from django.db.migrations.state import ModelState, ProjectState
-from django.db.models import Max, Q
+from django.db.models import AutoField, Case, F, Max, Q, Value, When
 from django.db.models.fields import NOT_PROVIDED
 from django.db.models.manager import ManagerDescriptor
-
+from django.utils import timezone
+
+from knowledge_server.allocator import PkAllocator
+from knowledge_server.artifacts import ArtifactStore, ExportArtifacts
+from knowledge_server.bulk import BulkDeletion, bulk_materialize
+from knowledge_server.caches import ExportedInstances, FragmentCache, ModelMetadataRegistry
+from knowledge_server.importer import DataSetImport, model_metadata_UKCLs
+from knowledge_server.diff import DataSetDelta
 from knowledge_server.utils import KsUrl
 from knowledge_server.orm_wrapper import OrmWrapper
+from knowledge_server.structure_plan import PlanNode, StructurePlan
 from serializable.models import SerializableModel
 
 logger = logging.getLogger( __name__ )
@@ -79,6 +92,12 @@ def model_post_save(sender, **kwargs):
                 kwargs[ 'instance' ].save( )
         except Exception as e:
             logger.error( "model_post_save kwargs['instance'].UKCL: " + kwargs[ 'instance' ].UKCL + "  -  " + str( e ) )
+    if isinstance( kwargs[ 'instance' ], StructureNode ):
+        # a structure is being changed; the plans compiled from it could be stale
+        StructurePlan.nodes_changed( [ kwargs[ 'instance' ] ] )
+    if isinstance( kwargs[ 'instance' ], ( KnowledgeServer, ModelMetadata ) ):
+        # the UKCL prefixes depend on the netloc of this_ks and on the model metadata
+        ShareableModel.UKCL_prefixes.clear( )
     if isinstance( kwargs[ 'instance' ], DataSet ):
         if kwargs[ 'instance' ].first_version_id == None:
             kwargs[ 'instance' ].first_version_id = kwargs[ 'instance' ].pk
@@ -107,6 +126,121 @@ class ShareableModel( SerializableModel ):
     e.g. has version information. DataSet.set_released sets this attribute for each instance in the dataset
     '''
     dataset_I_belong_to = models.ForeignKey( "DataSet", null=True, blank=True, related_name='+' )
+    '''
+    sha256 of the values of the fields that are not relationships, UKCLs and pk excluded (see own_content_hash);
+    two versions of an instance have the same content_hash if they have the same content, the instances they
+    refer to are compared by compare. It is computed on save;
+    on a released DataSet it is the hash of its whole content instead (see DataSet.compute_content_hash)
+    '''
+    content_hash = models.CharField( max_length=64, default="", blank=True )
+    '''
+    Only on the materialized database: the build of the release that has written the record (see MaterializedBuild)
+    until swap_materialized makes it visible setting it to 0; readers skip the records of a build (see swapped)
+    '''
+    materialized_build = models.BigIntegerField( default=0, db_index=True, db_column='oks_internals_build' )
+    '''
+    Fields that are not exported (see serializable_fields): content_hash is computed from the other fields,
+    the others are internal to this knowledge server
+    '''
+    internal_fields = ( 'content_hash', 'materialized_build' )
+    '''
+    ( class, db_alias ) -> ( UKCL prefix, id_field ); the UKCL of an instance is the prefix followed by its id_field
+    '''
+    UKCL_prefixes = {}
+
+    def save(self, *args, **kwargs):
+        '''
+        A new instance gets its pk from PkAllocator, hence its UKCL (and first_version for a DataSet), before
+        the INSERT so that model_post_save does not have to save it again; when the pk can't be allocated
+        (e.g. sqlite) model_post_save does it as before. It is allocated also when the arguments are positional:
+        an id given by AUTO_INCREMENT could be in a block of another process (see PkAllocator)
+        '''
+        kwargs.update( zip( ( 'force_insert', 'force_update', 'using', 'update_fields' ), args ) )
+        args = ( )
+        db_alias = kwargs.get( 'using' ) or router.db_for_write( self.__class__, instance=self )
+        if self._state.adding and db_alias == 'materialized':
+            self.materialized_build = MaterializedBuild.written( self.__class__ )
+        if self.pk is None and not kwargs.get( 'update_fields' ) and not kwargs.get( 'force_update' ):
+            if PkAllocator.assign( [ self ], db_alias ):
+                if self.UKCL == "":
+                    self.UKCL = self.generate_UKCL( db_alias=db_alias )
+                if isinstance( self, DataSet ) and self.first_version_id is None:
+                    self.first_version_id = self.pk
+                kwargs[ 'force_insert' ] = True
+        if not isinstance( self, DataSet ):
+            self.content_hash = self.own_content_hash( )
+        super( ShareableModel, self ).save( *args, **kwargs )
+
+    def serializable_fields(self, parent_class=None):
+        # the internal_fields are not exported
+        return list( self._memoized( ( "shareable_serializable_fields", parent_class ), lambda: list(
+            field for field in super( ShareableModel, self ).serializable_fields( parent_class ) if
+            not field[ 0 ] in self.internal_fields ) ) )
+
+    def own_content_hash(self):
+        excluded = ( self._meta.pk.name, 'UKCL', 'UKCL_previous_version' )
+        sha256 = hashlib.sha256( self.__class__.__name__.encode( 'utf-8' ) )
+        for name, as_tag in self.serializable_fields( ):
+            if not name in excluded:
+                sha256.update( ( "|" + name + "=" + str( getattr( self, name ) ) ).encode( 'utf-8' ) )
+        return sha256.hexdigest( )
+
+    @staticmethod
+    def compare(first, second):
+        '''
+        True if first, a version of second (or second itself), has the same content: the same content_hash (computed
+        if missing) instead of serializing them, and ForeignKeys referring to the same instances (see same_references)
+        '''
+        return ( first.content_hash or first.own_content_hash( ) ) == (
+            second.content_hash or second.own_content_hash( ) ) and ShareableModel.same_references( first, second )
+
+    @staticmethod
+    def same_references(first, second):
+        '''
+        the instance a ForeignKey of first refers to is the one of second or a version of it: a new version of a
+        dataset gives a new UKCL to each instance it copies, hence the UKCLs are resolved through
+        UKCL_previous_version; the targets are read only when the ids differ (e.g. not when they are shared)
+        '''
+        for name in first.foreign_key_attributes( ):
+            # the dataset is not part of the content
+            if name == 'dataset_I_belong_to':
+                continue
+            field = first._meta.get_field( name )
+            first_id, second_id = getattr( first, field.attname ), getattr( second, field.attname )
+            if first_id == second_id:
+                continue
+            if first_id is None or second_id is None or not issubclass( field.related_model, ShareableModel ):
+                return False
+            first_target, second_target = getattr( first, name ), getattr( second, name )
+            if not second_target.UKCL in ( first_target.UKCL, first_target.UKCL_previous_version ):
+                return False
+        return True
+
+    def merkle_hash(self, structure_node, hashed=None):
+        '''
+        content_hash combined with the merkle_hash of the children following structure_node (a PlanNode);
+        external references and instances already hashed contribute just their UKCL
+        '''
+        if hashed is None:
+            hashed = set( )
+        hashed.add( self.UKCL )
+        sha256 = hashlib.sha256( ( self.content_hash or self.own_content_hash( ) ).encode( 'utf-8' ) )
+        for child_structure_node in structure_node.children:
+            if not child_structure_node.attribute or child_structure_node.method_to_retrieve:
+                continue
+            if child_structure_node.is_many:
+                child_instances = sorted( getattr( self, child_structure_node.attribute ).all( ),
+                                          key=lambda i: i.UKCL )
+            else:
+                child_instance = getattr( self, child_structure_node.attribute )
+                child_instances = [ child_instance ] if child_instance is not None else [ ]
+            sha256.update( ( "|" + child_structure_node.attribute ).encode( 'utf-8' ) )
+            for child_instance in child_instances:
+                if child_structure_node.external_reference or child_instance.UKCL in hashed:
+                    sha256.update( ( "|" + child_instance.UKCL ).encode( 'utf-8' ) )
+                else:
+                    sha256.update( ( "|" + child_instance.merkle_hash( child_structure_node, hashed ) ).encode( 'utf-8' ) )
+        return sha256.hexdigest( )
 
     @property
     def q_UKCL(self):
@@ -118,21 +252,25 @@ class ShareableModel( SerializableModel ):
         mm = self.get_model_metadata( )
         return getattr( self, mm.name_field )
 
-    def generate_UKCL(self):
+    def generate_UKCL(self, db_alias=None):
         '''
-        *** method that works on the same database where self is saved ***
+        *** method that works on the same database where self is saved (or db_alias if it is not saved yet) ***
         UKCL is generated on records owned by this_ks
+        the prefix is computed once for each class (see UKCL_prefixes)
         '''
         try:
             # http://stackoverflow.com/questions/10375019/get-database-django-model-object-was-queried-from
-            db_alias = self._state.db
-            this_ks = KnowledgeServer.this_knowledge_server( )
-
-            mm = self.get_model_metadata( db_alias=db_alias )
-            name = mm.name
-            id_field = mm.id_field
-            namespace = OrmWrapper.get_model_container_name( this_ks.netloc, mm.module )
-            return this_ks.url( ) + "/" + namespace + "/" + name + "/" + str( getattr( self, id_field ) )
+            if db_alias is None:
+                db_alias = self._state.db
+            key = ( self.__class__, db_alias )
+            if not key in ShareableModel.UKCL_prefixes:
+                this_ks = KnowledgeServer.this_knowledge_server( )
+                mm = self.get_model_metadata( db_alias=db_alias )
+                namespace = OrmWrapper.get_model_container_name( this_ks.netloc, mm.module )
+                ShareableModel.UKCL_prefixes[ key ] = ( this_ks.url( ) + "/" + namespace + "/" + mm.name + "/",
+                                                        mm.id_field )
+            prefix, id_field = ShareableModel.UKCL_prefixes[ key ]
+            return prefix + str( getattr( self, id_field ) )
         except Exception as es:
             logger.error(
                 "Exception 'generate_UKCL' " + self.__class__.__name__ + "." + str( self.pk ) + ":" + str( es ) )
@@ -158,6 +296,7 @@ class ShareableModel( SerializableModel ):
         There can be more than one class with the same name in different apps e.g. coming from different
         OKSs; we need to find the app name as well so that we check if it matches the model metadata UKCL
         finds the instance of class ModelMetadata where the name corresponds to the name of the class of self
+        It is found in ModelMetadataRegistry, without queries once the registry of db_alias has been read
         TODO: should we make it work by default on db_alias=self._state.db ?
         '''
         try:
@@ -166,11 +305,8 @@ class ShareableModel( SerializableModel ):
                 # I reverse engineer the netloc of the model_metadata from the app_label/model_container
                 # example: this_ks is http://client.thekoa.org and self has "__license__licenses" as app_label
                 # then the ModelMetadata is from  http://license.thekoa.org
-                mm_netloc = OrmWrapper.get_model_metadata_netloc( self.__class__._meta.app_label )
                 # I reverse engineer the bare module of the model_metadata from the app_label/model_container
                 # example: self has "__license__licenses" as app_label, the module is "licenses"
-                mm_module = OrmWrapper.get_model_metadata_module( self.__class__._meta.app_label )
-                mms = ModelMetadata.objects.using( db_alias ).filter( name=self.__class__.__name__, module=mm_module )
                 # there could be many ModelMetadata with same class name and module name
                 # example I have License in app/container licenses on servers:
                 # http://license.thekoa.org
@@ -185,11 +321,7 @@ class ShareableModel( SerializableModel ):
                 # __license__licenses
                 # ___license__licenses
                 # _creativecommons_oks__licenses
-                for mm in mms.all( ):
-                    tmp_url = KsUrl( mm.UKCL )
-                    if mm_netloc == tmp_url.netloc:
-                        return mm
-                raise ("ModelMetadata not found. content_type.app_label=" + self.__class__._meta.app_label)
+                return ModelMetadataRegistry.get( self.__class__, db_alias )
             else:
                 # TBC we don't have a way to check the app yet so THIS COULD RAISE AN EXCEPTION
                 return ModelMetadata.objects.using( db_alias ).get( name=class_name )
@@ -204,13 +336,18 @@ class ShareableModel( SerializableModel ):
         '''
         return DataSetStructure.objects.filter( root_node__model_metadata=self.get_model_metadata( ) )
 
-    def serialized_URI_MM(self, export_format='XML'):
+    def serialized_URI_MM(self, export_format='XML', model_metadata=None):
+        '''
+        model_metadata, when the caller already has it (e.g. from the structure node), saves the query
+        '''
+        if model_metadata is None:
+            model_metadata = self.get_model_metadata( )
         if export_format == 'XML':
-            return ' URIModelMetadata="' + self.get_model_metadata( ).UKCL + '" '
+            return ' URIModelMetadata="' + model_metadata.UKCL + '" '
         if export_format == 'JSON':
-            return ' "URIModelMetadata" : "' + self.get_model_metadata( ).UKCL + '" '
+            return ' "URIModelMetadata" : "' + model_metadata.UKCL + '" '
         if export_format == 'DICT':
-            return {"URIModelMetadata": self.get_model_metadata( ).UKCL}
+            return {"URIModelMetadata": model_metadata.UKCL}
 
     def shallow_structure(self, db_alias='default'):
         '''
@@ -292,43 +429,42 @@ class ShareableModel( SerializableModel ):
             its details are somewhere else in the file
             <..... URIModelMetadata="....." UKCL="...." attribute="...." REFERENCE_IN_THIS_FILE=""
             the TAG "REFERENCE_IN_THIS_FILE" is used to mark the fact that attributes values are somewhere else in the file
+        structure_node can be either a StructureNode or a PlanNode; a StructureNode is compiled into a PlanNode
+        so that the recursion does not query the structure again (see DataSetStructure.serialization_plan)
+        XML is produced joining the chunks of serialize_chunks
         '''
         export_format = export_format.upper( )
+        if export_format == 'XML':
+            return "".join( self.serialize_chunks( structure_node, exported_instances=exported_instances,
+                                                   export_format=export_format, parent=parent ) )
         serialized = ""
         tmp_dict = {}
         export_dict = {}
         # if there is no structure_node I export just this object creating a shallow DataSetStructure 
         if structure_node is None:
-            structure_node = self.shallow_structure( ).root_node
+            structure_node = StructurePlan.for_shallow( self )
+        else:
+            structure_node = PlanNode.compile( structure_node )
+        model_metadata = structure_node.sn_model_metadata( parent )
         if structure_node.is_many:
             # the attribute corresponds to a list of instances of the model_metadata 
-            tag_name = structure_node.sn_model_metadata( parent ).name
+            tag_name = model_metadata.name
         else:
             tag_name = self.__class__.__name__ if structure_node.attribute == "" else structure_node.attribute
         # already exported, I just export a short reference with the UKCL
-        if self.UKCL and self.UKCL in exported_instances and structure_node.sn_model_metadata( parent ).name_field:
-            if export_format == 'XML':
-                xml_name = " " + structure_node.sn_model_metadata( parent ).name_field + "=\"" + getattr( self,
-                                                                                                          structure_node.sn_model_metadata(
-                                                                                                              parent ).name_field ) + "\""
-                return '<' + tag_name + ' REFERENCE_IN_THIS_FILE=\"\"' + self.serialized_URI_MM(
-                    export_format ) + xml_name + ' UKCL="' + self.UKCL + '"/>'
+        if self.UKCL and self.UKCL in exported_instances and model_metadata.name_field:
             if export_format == 'JSON':
-                json_name = ' "' + structure_node.sn_model_metadata( parent ).name_field + '" : "' + getattr( self,
-                                                                                                              structure_node.sn_model_metadata(
-                                                                                                                  parent ).name_field ) + '"'
+                json_name = ' "' + model_metadata.name_field + '" : "' + getattr( self, model_metadata.name_field ) + '"'
                 if structure_node.is_many:
                     return ' { "REFERENCE_IN_THIS_FILE" : \"\", ' + self.serialized_URI_MM(
-                        export_format ) + ", " + json_name + ', "UKCL": "' + self.UKCL + '"} '
+                        export_format, model_metadata ) + ", " + json_name + ', "UKCL": "' + self.UKCL + '"} '
                 else:
                     return '"' + tag_name + '" : { "REFERENCE_IN_THIS_FILE" : \"\", ' + self.serialized_URI_MM(
-                        export_format ) + ", " + json_name + ', "UKCL": "' + self.UKCL + '"}'
+                        export_format, model_metadata ) + ", " + json_name + ', "UKCL": "' + self.UKCL + '"}'
             if export_format == 'DICT':
-                tmp_dict[ structure_node.sn_model_metadata( parent ).name_field ] = getattr( self,
-                                                                                             structure_node.sn_model_metadata(
-                                                                                                 parent ).name_field )
+                tmp_dict[ model_metadata.name_field ] = getattr( self, model_metadata.name_field )
                 tmp_dict[ "REFERENCE_IN_THIS_FILE" ] = ""
-                tmp_dict.update( self.serialized_URI_MM( export_format ) )
+                tmp_dict.update( self.serialized_URI_MM( export_format, model_metadata ) )
                 tmp_dict[ "UKCL" ] = self.UKCL
                 if structure_node.is_many:
                     export_dict = tmp_dict
@@ -339,13 +475,11 @@ class ShareableModel( SerializableModel ):
         if not structure_node.external_reference:
             try:
                 outer_comma = ""
-                for child_structure_node in structure_node.child_nodes.all( ):
+                for child_structure_node in structure_node.children:
                     if child_structure_node.method_to_retrieve:
                         # there is no attribute but a method to access the child(ren)
                         method_to_retrieve = getattr( self, child_structure_node.method_to_retrieve )
                         o = method_to_retrieve( export_format )
-                        if export_format == 'XML':
-                            serialized += o
                         if export_format == 'JSON':
                             serialized += o
                         if export_format == 'DICT':
@@ -354,9 +488,7 @@ class ShareableModel( SerializableModel ):
                         outer_comma = ", "
                     else:
                         if child_structure_node.is_many:
-                            child_instances = eval( "self." + child_structure_node.attribute + ".all()" )
-                            if export_format == 'XML':
-                                serialized += "<" + child_structure_node.attribute + ">"
+                            child_instances = getattr( self, child_structure_node.attribute ).all( )
                             if export_format == 'JSON':
                                 serialized += outer_comma + ' "' + child_structure_node.attribute + '" : ['
                             innner_comma = ''
@@ -378,8 +510,6 @@ class ShareableModel( SerializableModel ):
                                                                                 export_format=export_format,
                                                                                 parent=self )
                                 innner_comma = ", "
-                            if export_format == 'XML':
-                                serialized += "</" + child_structure_node.attribute + ">"
                             if export_format == 'JSON':
                                 serialized += "]"
                             if export_format == 'DICT':
@@ -387,7 +517,7 @@ class ShareableModel( SerializableModel ):
 
                             outer_comma = ", "
                         else:
-                            child_instance = eval( "self." + child_structure_node.attribute )
+                            child_instance = getattr( self, child_structure_node.attribute )
                             if not child_instance is None:
                                 child_serialized = ""
                                 if export_format == 'JSON':
@@ -405,20 +535,16 @@ class ShareableModel( SerializableModel ):
                                 outer_comma = ", "
             except Exception as ex:
                 logger.error( "ShareableModel.serialize: " + str( ex ) )
-            if export_format == 'XML':
-                return '<' + tag_name + self.serialized_URI_MM( export_format ) + self.serialized_attributes(
-                    parent_class=ShareableModel, format=export_format ) + '>' + self.serialized_tags(
-                    parent_class=ShareableModel ) + serialized + '</' + tag_name + '>'
             if export_format == 'JSON':
                 if structure_node.is_many:
-                    return ' { ' + self.serialized_URI_MM( export_format ) + ', ' + self.serialized_attributes(
+                    return ' { ' + self.serialized_URI_MM( export_format, model_metadata ) + ', ' + self.serialized_attributes(
                         format=export_format ) + outer_comma + serialized + ' }'
                 else:
                     return '"' + tag_name + '" : { ' + self.serialized_URI_MM(
-                        export_format ) + ', ' + self.serialized_attributes(
+                        export_format, model_metadata ) + ', ' + self.serialized_attributes(
                         format=export_format ) + outer_comma + serialized + ' }'
             if export_format == 'DICT':
-                tmp_dict.update( self.serialized_URI_MM( export_format ) )
+                tmp_dict.update( self.serialized_URI_MM( export_format, model_metadata ) )
                 tmp_dict.update( self.serialized_attributes( format=export_format ) )
                 if structure_node.is_many:
                     export_dict = tmp_dict
@@ -427,35 +553,23 @@ class ShareableModel( SerializableModel ):
                 return export_dict
         else:
             # structure_node.external_reference = True
-            xml_name = ''
             json_name = ''
-            if structure_node.sn_model_metadata( parent ).name_field != "":
-                if export_format == 'XML':
-                    xml_name = " " + structure_node.sn_model_metadata( parent ).name_field + "=\"" + getattr( self,
-                                                                                                              structure_node.sn_model_metadata(
-                                                                                                                  parent ).name_field ) + "\""
+            if model_metadata.name_field != "":
                 if export_format == 'JSON':
-                    json_name = ', "' + structure_node.sn_model_metadata( parent ).name_field + '": "' + getattr( self,
-                                                                                                                  structure_node.sn_model_metadata(
-                                                                                                                      parent ).name_field ) + '"'
+                    json_name = ', "' + model_metadata.name_field + '": "' + getattr( self, model_metadata.name_field ) + '"'
                 if export_format == 'DICT':
-                    tmp_dict[ structure_node.sn_model_metadata( parent ).name_field ] = getattr( self,
-                                                                                                 structure_node.sn_model_metadata(
-                                                                                                     parent ).name_field )
-            if export_format == 'XML':
-                return '<' + tag_name + self.serialized_URI_MM( ) + 'UKCL="' + self.UKCL + '" ' + self._meta.pk.attname + '="' + str(
-                    self.pk ) + '"' + xml_name + '/>'
+                    tmp_dict[ model_metadata.name_field ] = getattr( self, model_metadata.name_field )
             if export_format == 'JSON':
                 if structure_node.is_many:
                     return '{ ' + self.serialized_URI_MM(
-                        export_format ) + ', "UKCL" : "' + self.UKCL + '", "' + self._meta.pk.attname + '" : "' + str(
+                        export_format, model_metadata ) + ', "UKCL" : "' + self.UKCL + '", "' + self._meta.pk.attname + '" : "' + str(
                         self.pk ) + '"' + json_name + ' }'
                 else:
                     return '"' + tag_name + '" :  { ' + self.serialized_URI_MM(
-                        export_format ) + ', "UKCL" : "' + self.UKCL + '", "' + self._meta.pk.attname + '" : "' + str(
+                        export_format, model_metadata ) + ', "UKCL" : "' + self.UKCL + '", "' + self._meta.pk.attname + '" : "' + str(
                         self.pk ) + '"' + json_name + ' }'
             if export_format == 'DICT':
-                tmp_dict.update( self.serialized_URI_MM( export_format ) )
+                tmp_dict.update( self.serialized_URI_MM( export_format, model_metadata ) )
                 tmp_dict[ "UKCL" ] = self.UKCL
                 tmp_dict[ self._meta.pk.attname ] = self.pk
                 if structure_node.is_many:
@@ -464,6 +578,180 @@ class ShareableModel( SerializableModel ):
                     export_dict[ tag_name ] = tmp_dict
                 return export_dict
 
+    def serialize_chunks(self, structure_node=None, exported_instances=None, export_format='XML', parent=None,
+                         fragment_cache=False):
+        '''
+        Generator: it yields the serialization while walking the structure so that a large export
+        never needs to be entirely in memory; see serialize for the parameters.
+        formats: {'XML' | 'JSON'}
+            XML  is exactly what serialize( export_format='XML' ) returns
+            JSON is the json encoding of serialize( export_format='DICT' ), the one used by the API;
+                 it is NOT the 'JSON' string produced by serialize
+        fragment_cache: if True the serialization of each instance with each node is taken from
+        the FragmentCache when possible; it must be used only for released content
+        '''
+        if exported_instances is None:
+            exported_instances = [ ]
+        # the membership test on exported_instances is done for every instance, ExportedInstances is a list
+        # with a dictionary; the UKCLs added are copied back at the end if the caller gave me a plain list
+        if isinstance( exported_instances, ExportedInstances ):
+            exported = exported_instances
+        else:
+            exported = ExportedInstances( exported_instances )
+        export_format = export_format.upper( )
+        if structure_node is None:
+            structure_node = StructurePlan.for_shallow( self )
+        else:
+            structure_node = PlanNode.compile( structure_node )
+        try:
+            if export_format == 'XML':
+                yield from self._xml_chunks( structure_node, exported, parent, fragment_cache )
+            if export_format == 'JSON':
+                if structure_node.is_many:
+                    yield from self._json_chunks( structure_node, exported, parent, fragment_cache )
+                else:
+                    yield "{"
+                    yield from self._json_chunks( structure_node, exported, parent, fragment_cache )
+                    yield "}"
+        finally:
+            if not exported is exported_instances:
+                exported_instances.extend( exported[ len( exported_instances ): ] )
+
+    def _children_chunks(self, structure_node, export_format):
+        '''
+        used by _xml_chunks and _json_chunks; for each child node it yields ( child_structure_node, children )
+        where children is the output of the method_to_retrieve or the list of child instances
+        '''
+        for child_structure_node in structure_node.children:
+            try:
+                if child_structure_node.method_to_retrieve:
+                    # there is no attribute but a method to access the child(ren)
+                    method_to_retrieve = getattr( self, child_structure_node.method_to_retrieve )
+                    children = method_to_retrieve( 'DICT' if export_format == 'JSON' else export_format )
+                elif child_structure_node.is_many:
+                    children = [ ]
+                    for child_instance in getattr( self, child_structure_node.attribute ).all( ):
+                        # let's prevent infinite loops if self relationships
+                        if (child_instance.__class__.__name__ != self.__class__.__name__) or (
+                                    self.pk != child_structure_node.pk):
+                            children.append( child_instance )
+                else:
+                    child_instance = getattr( self, child_structure_node.attribute )
+                    children = [ ] if child_instance is None else [ child_instance ]
+            except Exception as ex:
+                logger.error( "ShareableModel.serialize_chunks: " + str( ex ) )
+                continue
+            yield child_structure_node, children
+
+    def _xml_chunks(self, structure_node, exported_instances, parent, fragment_cache):
+        if fragment_cache and not structure_node.external_reference and not self.UKCL in exported_instances:
+            yield from FragmentCache.chunks( self, structure_node, 'XML', exported_instances,
+                                             lambda: self._xml_fragment( structure_node, exported_instances, parent,
+                                                                         fragment_cache ) )
+        else:
+            yield from self._xml_fragment( structure_node, exported_instances, parent, fragment_cache )
+
+    def _xml_fragment(self, structure_node, exported_instances, parent, fragment_cache):
+        model_metadata = structure_node.sn_model_metadata( parent )
+        if structure_node.is_many:
+            # the attribute corresponds to a list of instances of the model_metadata 
+            tag_name = model_metadata.name
+        else:
+            tag_name = self.__class__.__name__ if structure_node.attribute == "" else structure_node.attribute
+        xml_name = ""
+        if model_metadata.name_field:
+            xml_name = " " + model_metadata.name_field + "=\"" + getattr( self, model_metadata.name_field ) + "\""
+        # already exported, I just export a short reference with the UKCL
+        if self.UKCL and self.UKCL in exported_instances and model_metadata.name_field:
+            yield '<' + tag_name + ' REFERENCE_IN_THIS_FILE=\"\"' + self.serialized_URI_MM( 'XML',
+                                                                                            model_metadata ) + xml_name + ' UKCL="' + self.UKCL + '"/>'
+            # it is already there; FragmentCache needs to know it has been referenced
+            exported_instances.append( self.UKCL )
+            return
+        exported_instances.append( self.UKCL )
+        if structure_node.external_reference:
+            yield '<' + tag_name + self.serialized_URI_MM(
+                model_metadata=model_metadata ) + 'UKCL="' + self.UKCL + '" ' + self._meta.pk.attname + '="' + str(
+                self.pk ) + '"' + xml_name + '/>'
+            return
+        yield '<' + tag_name + self.serialized_URI_MM( 'XML', model_metadata ) + self.serialized_attributes(
+            parent_class=ShareableModel, format='XML' ) + '>' + self.serialized_tags( parent_class=ShareableModel )
+        for child_structure_node, children in self._children_chunks( structure_node, 'XML' ):
+            if child_structure_node.method_to_retrieve:
+                yield children
+            elif child_structure_node.is_many:
+                yield "<" + child_structure_node.attribute + ">"
+                for child_instance in children:
+                    yield from child_instance._xml_chunks( child_structure_node, exported_instances, self,
+                                                           fragment_cache )
+                yield "</" + child_structure_node.attribute + ">"
+            else:
+                for child_instance in children:
+                    yield from child_instance._xml_chunks( child_structure_node, exported_instances, self,
+                                                           fragment_cache )
+        yield '</' + tag_name + '>'
+
+    def _json_chunks(self, structure_node, exported_instances, parent, fragment_cache):
+        '''
+        it yields a json object if structure_node.is_many, a member "tag_name": { ... } otherwise
+        (e.g. what serialize DICT puts in the parent's dictionary)
+        '''
+        if fragment_cache and not structure_node.external_reference and not self.UKCL in exported_instances:
+            yield from FragmentCache.chunks( self, structure_node, 'JSON', exported_instances,
+                                             lambda: self._json_fragment( structure_node, exported_instances, parent,
+                                                                          fragment_cache ) )
+        else:
+            yield from self._json_fragment( structure_node, exported_instances, parent, fragment_cache )
+
+    def _json_fragment(self, structure_node, exported_instances, parent, fragment_cache):
+        model_metadata = structure_node.sn_model_metadata( parent )
+        if structure_node.is_many:
+            begin = "{"
+        else:
+            tag_name = self.__class__.__name__ if structure_node.attribute == "" else structure_node.attribute
+            begin = json.dumps( tag_name ) + ": {"
+        members = [ ]
+        # already exported, I just export a short reference with the UKCL
+        if self.UKCL and self.UKCL in exported_instances and model_metadata.name_field:
+            members.append( ( model_metadata.name_field, getattr( self, model_metadata.name_field ) ) )
+            members.append( ( "REFERENCE_IN_THIS_FILE", "" ) )
+            members.append( ( "URIModelMetadata", model_metadata.UKCL ) )
+            members.append( ( "UKCL", self.UKCL ) )
+            yield begin + json_members( members ) + "}"
+            # it is already there; FragmentCache needs to know it has been referenced
+            exported_instances.append( self.UKCL )
+            return
+        exported_instances.append( self.UKCL )
+        members.append( ( "URIModelMetadata", model_metadata.UKCL ) )
+        if structure_node.external_reference:
+            members.append( ( "UKCL", self.UKCL ) )
+            members.append( ( self._meta.pk.attname, self.pk ) )
+            if model_metadata.name_field != "":
+                members.append( ( model_metadata.name_field, getattr( self, model_metadata.name_field ) ) )
+            yield begin + json_members( members ) + "}"
+            return
+        members += list( self.serialized_attributes( format='DICT' ).items( ) )
+        yield begin + json_members( members )
+        for child_structure_node, children in self._children_chunks( structure_node, 'JSON' ):
+            if child_structure_node.method_to_retrieve:
+                if children:
+                    yield ", " + json_members( children.items( ) )
+            elif child_structure_node.is_many:
+                yield ", " + json.dumps( child_structure_node.attribute ) + ": ["
+                comma = ""
+                for child_instance in children:
+                    yield comma
+                    yield from child_instance._json_chunks( child_structure_node, exported_instances, self,
+                                                            fragment_cache )
+                    comma = ", "
+                yield "]"
+            else:
+                for child_instance in children:
+                    yield ", "
+                    yield from child_instance._json_chunks( child_structure_node, exported_instances, self,
+                                                            fragment_cache )
+        yield "}"
+
     def save_from_xml(self, structure_netloc, xmldoc, structure_node, parent=None):
         '''
         save_from_xml gets from xmldoc the attributes of self and saves it; it searches for child nodes according
@@ -477,6 +765,18 @@ class ShareableModel( SerializableModel ):
             the first ShareableModel in the XML cannot be marked as an external_reference in the structure_node
             save_from_xml doesn't get called recursively for external_references which are to be found in the database
             or to remain dangling references
+
+        xmldoc is an lxml element; the work is done in two steps, save_head_from_xml and children_from_xml,
+        that knowledge_server.importer invokes separately while the file is still being parsed
+        '''
+        structure_node = PlanNode.compile( structure_node )
+        if self.save_head_from_xml( structure_netloc, xmldoc, structure_node, parent ):
+            self.children_from_xml( structure_netloc, xmldoc, structure_node )
+
+    def save_head_from_xml(self, structure_netloc, xmldoc, structure_node, parent=None):
+        '''
+        It sets the attributes and the foreign keys found in xmldoc and saves self so that it can be
+        the parent of its other children; it returns False when there is nothing else to import
         '''
         field_name = ""
         if parent:
@@ -491,15 +791,13 @@ class ShareableModel( SerializableModel ):
         or
            I have to save this instance but I will find its attribute later in the imported file
         '''
-        try:
-            xmldoc.attributes[ "REFERENCE_IN_THIS_FILE" ]
-            # if the TAG is not there an exception will be raised and the method will continue and expect to find all data
+        if "REFERENCE_IN_THIS_FILE" in xmldoc.attrib:
             module_name = structure_node.sn_model_metadata( parent ).module
 
             actual_class = OrmWrapper.load_class( structure_netloc, module_name,
                                                   structure_node.sn_model_metadata( parent ).name )
             try:
-                instance = actual_class.retrieve_locally( xmldoc.attributes[ "UKCL" ].firstChild.data )
+                instance = actual_class.retrieve_locally( xmldoc.attrib[ "UKCL" ] )
                 # It's in the database; I just need to set its parent; data is either already there or it will be updated later on
                 if parent:
                     field_name = ShareableModel.get_parent_field_name( parent, structure_node.attribute )
@@ -510,106 +808,23 @@ class ShareableModel( SerializableModel ):
                 # I haven't found it in the database; I need to do something only if I have to set the parent
                 if parent:
                     try:
-                        setattr( self, "UKCL", xmldoc.attributes[ "UKCL" ].firstChild.data )
+                        setattr( self, "UKCL", xmldoc.attrib[ "UKCL" ] )
                         self.SetNotNullFields( )
                         self.save( )
                     except:
                         logger.error(
                             "Error in REFERENCE_IN_THIS_FILE TAG setting attribute UKCL for instance of class " + self.__class__.__name__ )
             # let's exit, nothing else to do, it's a REFERENCE_IN_THIS_FILE
-            return
-        except:
-            # nothing to do, there is no REFERENCE_IN_THIS_FILE attribute
-            pass
-        for key in self._meta.fields:
-            '''
-              let's setattr the other attributes
-              that are not ForeignKey as those are treated separately
-              and is not the field_name pointing at the parent as it has been already set
-            '''
-            if key.__class__.__name__ != "ForeignKey" and (not parent or key.name != field_name):
-                try:
-                    if key.__class__.__name__ in SerializableModel.types_serialized_as_tags and (
-                    not key.name in list( key.name for key in ShareableModel._meta.fields )):
-                        child_tag = xmldoc.getElementsByTagName( key.name )[ 0 ]
-                        setattr( self, key.name, child_tag.firstChild.data )
-                    elif key.__class__.__name__ == "BooleanField":
-                        setattr( self, key.name, xmldoc.attributes[ key.name ].firstChild.data.lower( ) == "true" )
-                    elif key.__class__.__name__ == "IntegerField":
-                        setattr( self, key.name, int( xmldoc.attributes[ key.name ].firstChild.data ) )
-                    else:
-                        setattr( self, key.name, xmldoc.attributes[ key.name ].firstChild.data )
-                except Exception as ex:
-                    logger.debug(
-                        "Extracting from xml \"" + key.name + "\" for object of class \"" + self.__class__.__name__ + "\" with PK " + str(
-                            self.pk ) + ". Exception: " + str( ex ) )
-        # in the previous loop I have set the pk too; I must set it to None before saving
-        self.pk = None
+            return False
+        self.attributes_from_xml( xmldoc, field_name )
 
         # I must set foreign_key child nodes BEFORE SAVING self otherwise I get an error for ForeignKeys not being set
-        for child_structure_node in structure_node.child_nodes.all( ):
-            if child_structure_node.attribute == 'first_version':
-                pass
-            # I must skip the import if self is a DataSet and the GenericForeignKey is 'root'
-            # this is because the export of a DataSet is done differently from any other; it
-            # starts from the root with the DataSet.dataset_structure.root_node
-            elif child_structure_node.attribute in self.virtual_field_attributes( ) and isinstance( self,
-                                                                                                    DataSet ) and child_structure_node.attribute == 'root':
-                pass
-            elif child_structure_node.attribute in (self.foreign_key_attributes( ) + self.virtual_field_attributes( )):
-                try:
-                    # ASSERT: in the XML there is exactly at most one child tag
-                    child_tag = [ t for t in xmldoc.getElementsByTagName( child_structure_node.attribute ) if
-                                  t in xmldoc.childNodes ]
-                    if len( child_tag ) == 1:
-                        xml_child_node = child_tag[ 0 ]
-                        # I search for the corresponding ModelMetadata
-
-                        se = ShareableModel.model_metadata_from_xml_tag( xml_child_node )
-                        assert (child_structure_node.sn_model_metadata(
-                            self ).name == se.name), "child_structure_node.sn_model_metadata(self).name - se.name: " + child_structure_node.sn_model_metadata(
-                            self ).name + ' - ' + se.name
-                        module_name = child_structure_node.sn_model_metadata( self ).module
-                        actual_class = OrmWrapper.load_class( structure_netloc, module_name,
-                                                              child_structure_node.sn_model_metadata( self ).name )
-                        instance = None
-                        if child_structure_node.external_reference:
-                            '''
-                            If it is an external reference I must search for it in the database first;  
-                            if it is not there I fetch it using it's URL and then create it in the database
-                            '''
-                            # it can be a self relation; if so instance is self
-                            if self.UKCL == xml_child_node.attributes[ "UKCL" ].firstChild.data:
-                                instance = self
-                            else:
-                                try:
-                                    # let's search it in the database
-                                    instance = actual_class.retrieve_locally(
-                                        xml_child_node.attributes[ "UKCL" ].firstChild.data )
-                                except ObjectDoesNotExist:
-                                    # TODO: if it is not there it is a dangling reference
-                                    logger.warning(
-                                        "\"" + module_name + ".models " + se.name + "\" TODO: dangling reference for UKCL \"" +
-                                        xml_child_node.attributes[ "UKCL" ].firstChild.data )
-                                except Exception as ex:
-                                    logger.error(
-                                        "\"" + module_name + ".models " + se.name + "\" has no instance with UKCL \"" +
-                                        xml_child_node.attributes[ "UKCL" ].firstChild.data + " " + str( ex ) )
-                                    raise Exception(
-                                        "\"" + module_name + ".models " + se.name + "\" has no instance with UKCL \"" +
-                                        xml_child_node.attributes[ "UKCL" ].firstChild.data + " " + str( ex ) )
-                        else:
-                            instance = actual_class( )
-                            # save_from_xml takes care of saving instance with a self.save() at the end
-                            instance.save_from_xml( structure_netloc, xml_child_node,
-                                                    child_structure_node )  # the fourth parameter, "parent" shouldn't be necessary in this case as this is a ForeignKey
-                        if not instance is None:
-                            setattr( self, child_structure_node.attribute, instance )
-                except Exception as ex:
-                    logger.error(
-                        "save_from_xml self=%s child_structure_node.attribute='%s' in (foreign_key + virtual_field):  -- %s" % (
-                        self.UKCL, child_structure_node.attribute, str( ex )) )
-                    raise Exception( "save_from_xml: " + str( ex ) )
+        for child_structure_node in structure_node.children:
+            if self.is_set_before_saving( child_structure_node ):
+                # ASSERT: in the XML there is exactly at most one child tag
+                child_tag = xml_children( xmldoc, child_structure_node.attribute )
+                if len( child_tag ) == 1:
+                    self.foreign_key_from_xml( structure_netloc, child_tag[ 0 ], child_structure_node )
 
         # I have added all attributes corresponding to ForeignKey, I can save it so that I can use it as a parent for the other attributes
         # TODO: UGLY PATCH: see #143
@@ -627,10 +842,9 @@ class ShareableModel( SerializableModel ):
             '''
             self.first_version = self
             try:
-                first_version_tag = [ t for t in xmldoc.getElementsByTagName( 'first_version' ) if
-                                      t in xmldoc.childNodes ]
+                first_version_tag = xml_children( xmldoc, 'first_version' )
                 if len( first_version_tag ) == 1:
-                    first_version_UKCL = first_version_tag[ 0 ].attributes[ "UKCL" ].firstChild.data
+                    first_version_UKCL = first_version_tag[ 0 ].attrib[ "UKCL" ]
                     instance = DataSet.retrieve_locally( first_version_UKCL )
                     self.first_version = instance
             except:
@@ -640,74 +854,165 @@ class ShareableModel( SerializableModel ):
         # save_from_xml can be invoked on an instance retrieved from the database (where UKCL is set)
         # or created on the fly (and UKCL is not set); in the latter case, only now I can generate UKCL
         # as I have just saved it and I have a local ID
+        return True
 
-        for child_structure_node in structure_node.child_nodes.all( ):
+    def attributes_from_xml(self, xmldoc, field_name=""):
+        '''
+        it sets the attributes of self found in xmldoc, but the ForeignKeys and field_name (the one pointing at the parent)
+        '''
+        for key in self._meta.fields:
+            '''
+              let's setattr the other attributes
+              that are not ForeignKey as those are treated separately
+              and is not the field_name pointing at the parent as it has been already set
+            '''
+            if key.__class__.__name__ != "ForeignKey" and (not field_name or key.name != field_name):
+                try:
+                    if key.__class__.__name__ in SerializableModel.types_serialized_as_tags and (
+                    not key.name in list( key.name for key in ShareableModel._meta.fields )):
+                        child_tag = xml_children( xmldoc, key.name )[ 0 ]
+                        if child_tag.text is None:
+                            raise Exception( "empty tag" )
+                        setattr( self, key.name, child_tag.text )
+                    elif key.__class__.__name__ == "BooleanField":
+                        setattr( self, key.name, xmldoc.attrib[ key.name ].lower( ) == "true" )
+                    elif key.__class__.__name__ == "IntegerField":
+                        setattr( self, key.name, int( xmldoc.attrib[ key.name ] ) )
+                    else:
+                        setattr( self, key.name, xmldoc.attrib[ key.name ] )
+                except Exception as ex:
+                    logger.debug(
+                        "Extracting from xml \"" + key.name + "\" for object of class \"" + self.__class__.__name__ + "\" with PK " + str(
+                            self.pk ) + ". Exception: " + str( ex ) )
+        # in the previous loop I have set the pk too; I must set it to None before saving
+        self.pk = None
+
+    def is_set_before_saving(self, child_structure_node):
+        '''
+        True if the child is a ForeignKey or a GenericForeignKey of self (it must be set before saving self)
+        first_version and the root of a DataSet are set separately (see save_head_from_xml and DataSet.import_dataset)
+        '''
+        if child_structure_node.attribute == 'first_version':
+            return False
+        # I must skip the import if self is a DataSet and the GenericForeignKey is 'root'
+        # this is because the export of a DataSet is done differently from any other; it
+        # starts from the root with the DataSet.dataset_structure.root_node
+        if isinstance( self, DataSet ) and child_structure_node.attribute == 'root':
+            return False
+        return child_structure_node.attribute in (self.foreign_key_attributes( ) + self.virtual_field_attributes( ))
+
+    def foreign_key_from_xml(self, structure_netloc, xml_child_node, child_structure_node):
+        '''
+        it imports (or finds in the database) the instance in xml_child_node and sets it in the foreign key
+        (or GenericForeignKey) child_structure_node.attribute of self; self is not saved
+        '''
+        try:
+            # I search for the corresponding ModelMetadata
+            actual_class = ShareableModel.class_from_xml( structure_netloc, xml_child_node, child_structure_node, self )
+            instance = None
+            if child_structure_node.external_reference:
+                '''
+                If it is an external reference I must search for it in the database first;  
+                if it is not there I fetch it using it's URL and then create it in the database
+                '''
+                # it can be a self relation; if so instance is self
+                if self.UKCL == xml_child_node.attrib[ "UKCL" ]:
+                    instance = self
+                else:
+                    module_name = actual_class.__module__
+                    try:
+                        # let's search it in the database
+                        instance = actual_class.retrieve_locally( xml_child_node.attrib[ "UKCL" ] )
+                    except ObjectDoesNotExist:
+                        # TODO: if it is not there it is a dangling reference
+                        logger.warning(
+                            "\"" + module_name + " " + actual_class.__name__ + "\" TODO: dangling reference for UKCL \"" +
+                            xml_child_node.attrib[ "UKCL" ] )
+                    except Exception as ex:
+                        logger.error(
+                            "\"" + module_name + " " + actual_class.__name__ + "\" has no instance with UKCL \"" +
+                            xml_child_node.attrib[ "UKCL" ] + " " + str( ex ) )
+                        raise Exception(
+                            "\"" + module_name + " " + actual_class.__name__ + "\" has no instance with UKCL \"" +
+                            xml_child_node.attrib[ "UKCL" ] + " " + str( ex ) )
+            else:
+                instance = actual_class( )
+                # save_from_xml takes care of saving instance with a self.save() at the end
+                instance.save_from_xml( structure_netloc, xml_child_node,
+                                        child_structure_node )  # the fourth parameter, "parent" shouldn't be necessary in this case as this is a ForeignKey
+            if not instance is None:
+                setattr( self, child_structure_node.attribute, instance )
+        except Exception as ex:
+            logger.error(
+                "save_from_xml self=%s child_structure_node.attribute='%s' in (foreign_key + virtual_field):  -- %s" % (
+                self.UKCL, child_structure_node.attribute, str( ex )) )
+            raise Exception( "save_from_xml: " + str( ex ) )
+
+    def children_from_xml(self, structure_netloc, xmldoc, structure_node):
+        '''
+        the second step of save_from_xml: self has been saved, it imports the children that are not foreign keys
+        '''
+        for child_structure_node in structure_node.children:
             # I have already processed foreign keys and virtual_field (=GenericForeignKey), I skip them now
             if child_structure_node.attribute and (
             not child_structure_node.attribute in (self.foreign_key_attributes( ) + self.virtual_field_attributes( ))):
-                # ASSERT: in the XML there is exactly one child tag
-                xml_attribute_nodes = [ t for t in xmldoc.getElementsByTagName( child_structure_node.attribute ) if
-                                        t in xmldoc.childNodes ]
-                xml_attribute_node = xml_attribute_nodes[ 0 ]
+                # ASSERT: in the XML there is at most one child tag
+                xml_attribute_nodes = xml_children( xmldoc, child_structure_node.attribute )
+                if len( xml_attribute_nodes ) == 0:
+                    continue
                 if child_structure_node.is_many:
-                    for xml_child_node in xml_attribute_node.childNodes:
-                        se = ShareableModel.model_metadata_from_xml_tag( xml_child_node )
-                        module_name = child_structure_node.sn_model_metadata( self ).module
-                        assert (child_structure_node.sn_model_metadata(
-                            self ).name == se.name), "child_structure_node.name - se.name: " + child_structure_node.sn_model_metadata(
-                            self ).name + ' - ' + se.name
-                        actual_class = OrmWrapper.load_class( structure_netloc, module_name,
-                                                              child_structure_node.sn_model_metadata( self ).name )
-                        if child_structure_node.external_reference:
-                            instance = actual_class.retrieve_locally(
-                                xml_child_node.attributes[ "UKCL" ].firstChild.data )
-                            # TODO: il test successivo forse si fa meglio guardando il concrete_model - capire questo test e mettere un commento
-                            if child_structure_node.attribute in self._meta.fields:
-                                setattr( instance, child_structure_node.attribute, self )
-                                instance.save( )
-                            else:
-                                setattr( self, child_structure_node.attribute, instance )
-                                self.save( )
-                        else:
-                            instance = actual_class( )
-                            # is_many = True, I need to add this instance to self
-
-                            tmp_log = getattr( self._meta.concrete_model, child_structure_node.attribute )
-                            logger.debug(
-                                "getattr(self._meta.concrete_model, child_structure_node.attribute) %s" % tmp_log.__class__.__name__ )
-                            logger.debug( "self.UKCL=%s - child_structure_node.attribute='%s'" % (
-                            self.UKCL, child_structure_node.attribute) )
-                            instance.save_from_xml( structure_netloc, xml_child_node, child_structure_node, self )
-                            related_parent = getattr( self._meta.concrete_model, child_structure_node.attribute )
-                            related_list = getattr( self, child_structure_node.attribute )
-                            # if it is a manytomany it is not there yet ... 
-                            if ShareableModel.get_parent_field_name( self, child_structure_node.attribute ) == "":
-                                #                             if instance.id not in [i.id for i in related_list.all()]:
-                                # I add it
-                                related_list.add( instance )
-                                self.save( )
+                    for xml_child_node in xml_attribute_nodes[ 0 ]:
+                        self.child_from_xml( structure_netloc, xml_child_node, child_structure_node )
                 else:
-                    # is_many == False
-                    xml_child_node = xml_attribute_node
-                    se = ShareableModel.model_metadata_from_xml_tag( xml_child_node )
-                    module_name = child_structure_node.sn_model_metadata( self ).module
-                    assert (child_structure_node.sn_model_metadata(
-                        self ).name == se.name), "child_structure_node.name - se.name: " + child_structure_node.sn_model_metadata(
-                        self ).name + ' - ' + se.name
-                    actual_class = OrmWrapper.load_class( structure_netloc, module_name,
-                                                          child_structure_node.sn_model_metadata( self ).name )
-                    if child_structure_node.external_reference:
-                        instance = actual_class.retrieve_locally( xml_child_node.attributes[ "UKCL" ].firstChild.data )
-                        # TODO: il test successivo forse si fa meglio guardando il concrete_model - capire questo test e mettere un commento
-                        if child_structure_node.attribute in self._meta.fields:
-                            setattr( instance, child_structure_node.attribute, self )
-                            instance.save( )
-                        else:
-                            setattr( self, child_structure_node.attribute, instance )
-                            self.save( )
-                    else:
-                        instance = actual_class( )
-                        instance.save_from_xml( structure_netloc, xml_child_node, child_structure_node, self )
+                    self.child_from_xml( structure_netloc, xml_attribute_nodes[ 0 ], child_structure_node )
+
+    def child_from_xml(self, structure_netloc, xml_child_node, child_structure_node):
+        '''
+        it imports the instance in xml_child_node as a child of self (self has been saved)
+        '''
+        actual_class = ShareableModel.class_from_xml( structure_netloc, xml_child_node, child_structure_node, self )
+        if child_structure_node.external_reference:
+            instance = actual_class.retrieve_locally( xml_child_node.attrib[ "UKCL" ] )
+            # TODO: il test successivo forse si fa meglio guardando il concrete_model - capire questo test e mettere un commento
+            if child_structure_node.attribute in self._meta.fields:
+                setattr( instance, child_structure_node.attribute, self )
+                instance.save( )
+            else:
+                setattr( self, child_structure_node.attribute, instance )
+                self.save( )
+        else:
+            instance = actual_class( )
+            if child_structure_node.is_many:
+                tmp_log = getattr( self._meta.concrete_model, child_structure_node.attribute )
+                logger.debug(
+                    "getattr(self._meta.concrete_model, child_structure_node.attribute) %s" % tmp_log.__class__.__name__ )
+                logger.debug( "self.UKCL=%s - child_structure_node.attribute='%s'" % (
+                self.UKCL, child_structure_node.attribute) )
+            instance.save_from_xml( structure_netloc, xml_child_node, child_structure_node, self )
+            self.add_imported_child( child_structure_node, instance )
+
+    def add_imported_child(self, child_structure_node, instance):
+        '''
+        instance has been imported as a child of self; if it is in a ManyToMany it must be added to self
+        (otherwise its field pointing at the parent has been set while importing it)
+        '''
+        if child_structure_node.is_many:
+            # if it is a manytomany it is not there yet ... 
+            if ShareableModel.get_parent_field_name( self, child_structure_node.attribute ) == "":
+                # I add it
+                getattr( self, child_structure_node.attribute ).add( instance )
+                self.save( )
+
+    @staticmethod
+    def class_from_xml(structure_netloc, xml_child_node, child_structure_node, parent):
+        '''
+        the class of the instance in xml_child_node; its ModelMetadata must be the one of child_structure_node
+        '''
+        se = ShareableModel.model_metadata_from_xml_tag( xml_child_node )
+        model_metadata = child_structure_node.sn_model_metadata( parent )
+        assert (model_metadata.name == se.name), "child_structure_node.sn_model_metadata(parent).name - se.name: " + \
+                                                 model_metadata.name + ' - ' + se.name
+        return OrmWrapper.load_class( structure_netloc, model_metadata.module, model_metadata.name )
 
     def new_version(self, structure_node, processed_instances, parent=None):
         '''
@@ -720,6 +1025,7 @@ class ShareableModel( SerializableModel ):
         returns the newly created instance
         '''
 
+        structure_node = PlanNode.compile( structure_node )
         if structure_node.external_reference:
             # if it is an external reference I do not need to create a new instance
             return self
@@ -735,10 +1041,10 @@ class ShareableModel( SerializableModel ):
             if field_name:
                 setattr( new_instance, field_name, parent )
 
-        for child_structure_node in structure_node.child_nodes.all( ):
+        for child_structure_node in structure_node.children:
             if child_structure_node.attribute in self.foreign_key_attributes( ):
                 # not is_many
-                child_instance = eval( "self." + child_structure_node.attribute )
+                child_instance = getattr( self, child_structure_node.attribute )
                 new_child_instance = child_instance.new_version( child_structure_node, processed_instances )
                 setattr( new_instance, child_structure_node.attribute,
                          new_child_instance )  # the parameter "parent" shouldn't be necessary in this case as this is a ForeignKey
@@ -746,28 +1052,30 @@ class ShareableModel( SerializableModel ):
         # I have added all attributes corresponding to ForeignKey, I can save it so that I can use it as a parent for the other attributes
         new_instance.save( )
 
-        for child_structure_node in structure_node.child_nodes.all( ):
+        for child_structure_node in structure_node.children:
             if child_structure_node.is_many:
-                child_instances = eval( "self." + child_structure_node.attribute + ".all()" )
+                child_instances = getattr( self, child_structure_node.attribute ).all( )
                 for child_instance in child_instances:
                     # let's prevent infinite loops if self relationships
                     if (child_instance.__class__.__name__ == self.__class__.__name__) and (
                         self.pk == child_structure_node.pk):
-                        eval( "new_instance." + child_structure_node.attribute + ".add(new_instance)" )
+                        getattr( new_instance, child_structure_node.attribute ).add( new_instance )
                     else:
                         new_child_instance = child_instance.new_version( child_structure_node, processed_instances,
                                                                          new_instance )
             else:
                 # not is_many
-                child_instance = eval( "self." + child_structure_node.attribute )
+                child_instance = getattr( self, child_structure_node.attribute )
                 new_child_instance = child_instance.new_version( child_structure_node, processed_instances, self )
                 setattr( new_instance, child_structure_node.attribute, new_child_instance )
 
+        # the UKCL has been generated by the first save; copying the fields overwrites it
+        new_UKCL = new_instance.UKCL
         for key in self._meta.fields:
             if key.__class__.__name__ != "ForeignKey" and self._meta.pk != key:
                 setattr( new_instance, key.name, eval( "self." + key.name ) )
-        new_instance.UKCL_previous_version = new_instance.UKCL
-        new_instance.UKCL = ""
+        new_instance.UKCL_previous_version = self.UKCL
+        new_instance.UKCL = new_UKCL
         new_instance.save( )
         # after saving
         processed_instances[ str( self.UKCL ) ] = new_instance.UKCL
@@ -786,6 +1094,7 @@ class ShareableModel( SerializableModel ):
         If so shall we move it inside this method?
         '''
 
+        structure_node = PlanNode.compile( structure_node )
         if structure_node.external_reference:
             try:
                 return self.__class__.objects.using( 'materialized' ).get( UKCL=self.UKCL )
@@ -808,7 +1117,7 @@ class ShareableModel( SerializableModel ):
 
         dangling_references = [ ]
         list_of_self_relationships_pointing_to_self = [ ]
-        for child_structure_node in structure_node.child_nodes.all( ):
+        for child_structure_node in structure_node.children:
             if child_structure_node.attribute in (self.foreign_key_attributes( ) + self.virtual_field_attributes( )):
                 # not is_many
                 # if they are nullable I do nothing
@@ -867,30 +1176,29 @@ class ShareableModel( SerializableModel ):
                 setattr( new_instance, attribute, new_instance )
             new_instance.save( using='materialized' )
 
-        for child_structure_node in structure_node.child_nodes.all( ):
+        for child_structure_node in structure_node.children:
             if not (
                 child_structure_node.attribute in (self.foreign_key_attributes( ) + self.virtual_field_attributes( ))):
                 if child_structure_node.is_many:
                     # if we have a method to retrieve the children there is nothing to be materialized
                     if not child_structure_node.method_to_retrieve:
-                        child_instances = eval( "self." + child_structure_node.attribute + ".all()" )
+                        child_instances = getattr( self, child_structure_node.attribute ).all( )
                         for child_instance in child_instances:
                             # let's prevent infinite loops if self relationships
                             if (child_instance.__class__.__name__ == self.__class__.__name__) and (
                                 self.pk == child_structure_node.pk):
-                                eval( "new_instance." + child_structure_node.attribute + ".add(new_instance)" )
+                                getattr( new_instance, child_structure_node.attribute ).add( new_instance )
                             else:
                                 if child_structure_node.attribute in self.many_to_many_attributes( ):
                                     new_child_instance = child_instance.materialize( child_structure_node,
                                                                                      processed_instances )
-                                    eval(
-                                        "new_instance." + child_structure_node.attribute + ".add(new_child_instance)" )
+                                    getattr( new_instance, child_structure_node.attribute ).add( new_child_instance )
                                 else:
                                     new_child_instance = child_instance.materialize( child_structure_node,
                                                                                      processed_instances, new_instance )
                 else:
                     # not is_many ###############################################################################
-                    child_instance = eval( "self." + child_structure_node.attribute )
+                    child_instance = getattr( self, child_structure_node.attribute )
                     new_child_instance = child_instance.materialize( child_structure_node, processed_instances, self )
                     # The child_instance could be a reference so we expect to find it already there
                     setattr( new_instance, child_structure_node.attribute, new_child_instance )
@@ -913,7 +1221,45 @@ class ShareableModel( SerializableModel ):
                     "Couldn't resolve a dangling reference from " + dr.UKCL_actual_instance + " to " + dr.object_with_dangling.UKCL )
         return new_instance
 
-    def delete_children(self, structure_node, parent=None):
+    def clone(self, structure_node, dataset, parent=None, clones=None):
+        '''
+        copy on write (see DataSet.writable): a copy of self that belongs to dataset, with parent as its parent
+        ForeignKey and ManyToMany children are shared with self; the children pointing to self with their
+        parent field can't be shared and they are cloned as well
+        clones maps ( class, pk ) of self and of the cloned children to their clone
+        '''
+        if clones is None:
+            clones = {}
+        new_instance = self.__class__( )
+        for field in self._meta.concrete_fields:
+            if not (field.primary_key or isinstance( field, AutoField )):
+                setattr( new_instance, field.attname, getattr( self, field.attname ) )
+        new_instance.UKCL = ""
+        new_instance.UKCL_previous_version = self.UKCL
+        new_instance.dataset_I_belong_to = dataset
+        if parent:
+            field_name = ShareableModel.get_parent_field_name( parent, structure_node.attribute )
+            if field_name:
+                setattr( new_instance, field_name, parent )
+        new_instance.save( )
+        clones[ ( self.__class__, self.pk ) ] = new_instance
+        for attribute in self.many_to_many_attributes( ):
+            getattr( new_instance, attribute ).add( *getattr( self, attribute ).all( ) )
+        for child_structure_node in structure_node.children:
+            attribute = child_structure_node.attribute
+            if not child_structure_node.is_many or not attribute or child_structure_node.method_to_retrieve or \
+                    attribute in self.many_to_many_attributes( ):
+                continue
+            if ShareableModel.get_parent_field_name( self, attribute ) == "":
+                # the other side of a ManyToMany
+                getattr( new_instance, attribute ).add( *getattr( self, attribute ).all( ) )
+            elif not child_structure_node.external_reference:
+                for child_instance in getattr( self, attribute ).all( ):
+                    if not ( child_instance.__class__, child_instance.pk ) in clones:
+                        child_instance.clone( child_structure_node, dataset, new_instance, clones )
+        return new_instance
+
+    def delete_children(self, structure_node, parent=None, dataset=None):
         '''
         invoked by DataSet.delete_entire_dataset that wraps it in a transaction
         it recursively invokes itself to delete children's children; self is in the 
@@ -922,6 +1268,9 @@ class ShareableModel( SerializableModel ):
         It is invoked only if DataSet.dataset_structure.multiple_releases = False
         Then I also have to remap foreign keys pointing to it in the materialized DB and
         in default DB
+
+        if dataset is given the instances that belong to another version sharing them (see
+        ShareableModel.is_shared) are not deleted, neither their children
         '''
 
         # I delete the children; must do it before remapping foreignkeys otherwise some will escape deletion
@@ -931,15 +1280,16 @@ class ShareableModel( SerializableModel ):
                     child_instances = eval( "self." + child_structure_node.attribute + ".all()" )
                     for child_instance in child_instances:
                         # let's prevent deleting self; self will be deleted by who has invoked this method 
-                        if (child_instance.__class__.__name__ != self.__class__.__name__) or (
-                            self.pk != child_structure_node.pk):
-                            child_instance.delete_children( child_structure_node, self )
+                        if ((child_instance.__class__.__name__ != self.__class__.__name__) or (
+                            self.pk != child_structure_node.pk)) and not child_instance.is_shared( dataset ):
+                            child_instance.delete_children( child_structure_node, self, dataset )
                             child_instance.delete( )
                 else:
                     # not is_many
                     child_instance = eval( "self." + child_structure_node.attribute )
-                    child_instance.delete_children( child_structure_node, self )
-                    child_instance.delete( )
+                    if not child_instance.is_shared( dataset ):
+                        child_instance.delete_children( child_structure_node, self, dataset )
+                        child_instance.delete( )
 
         try:
             # before deleting self I must remap foreignkeys pointing at it to the new instances
@@ -985,15 +1335,60 @@ class ShareableModel( SerializableModel ):
         except Exception as e:
             logger.error( str( e ) )
 
+    def is_shared(self, dataset, sharing_versions=None):
+        '''
+        True if self belongs to another version of dataset that shares its instances (copy on write, see
+        DataSet.writable and DataSet.sharing_versions); an instance that belongs to no dataset is not shared
+        and neither is one that belongs to an unrelated dataset (e.g. a view that has been released after it)
+        sharing_versions: dataset.sharing_versions( ) when the caller already has it
+        '''
+        if dataset is None or self.dataset_I_belong_to_id in ( None, dataset.pk ):
+            return False
+        if sharing_versions is None:
+            sharing_versions = dataset.sharing_versions( )
+        return self.dataset_I_belong_to_id in sharing_versions
+
+    @staticmethod
+    def swapped(queryset):
+        '''
+        the records of queryset, on the materialized database, that readers see: those of the current releases;
+        until DataSet.collect_superseded deletes it, the previous release of a dataset is still on the materialized
+        database and the records of a release not swapped in yet (or failed) are there as well (see MaterializedBuild)
+        unless it is made visible to this thread (see MaterializedBuild.visible)
+        '''
+        return queryset.filter( materialized_build__in=MaterializedBuild.visible_builds( ) ).exclude(
+            dataset_I_belong_to__superseded=True )
+
+    @classmethod
+    def get_current(cls, **kwargs):
+        '''
+        like cls.objects.using( 'materialized' ).get( **kwargs ) for lookups that are unique within a release (e.g.
+        the name of a DataSetStructure); only the records of the current releases are considered (see swapped)
+        '''
+        found = list( ShareableModel.swapped( cls.objects.using( 'materialized' ).filter( **kwargs ) ) )
+        if len( found ) == 0:
+            raise cls.DoesNotExist( cls.__name__ + " matching " + str( kwargs ) + " does not exist." )
+        if len( found ) > 1:
+            raise cls.MultipleObjectsReturned( str( len( found ) ) + " " + cls.__name__ + " match " + str( kwargs ) )
+        return found[ 0 ]
+
     def navigate_helper_set_dataset(self, instance, status):
         if not 'output' in status.keys( ):
             status[ 'output' ] = {}
         instance.dataset_I_belong_to = status[ 'dataset' ]
         instance.save( )
 
+    def navigate_helper_hand_over(self, instance, status):
+        # the instances of status[ 'from' ] that status[ 'dataset' ] shares go to status[ 'dataset' ]
+        if not 'output' in status.keys( ):
+            status[ 'output' ] = {}
+        if instance.dataset_I_belong_to_id == status[ 'from' ].pk:
+            instance.dataset_I_belong_to = status[ 'dataset' ]
+            instance.save( )
+
     @staticmethod
     def model_metadata_from_xml_tag(xml_child_node):
-        UKCL = xml_child_node.attributes[ "URIModelMetadata" ].firstChild.data
+        UKCL = xml_child_node.attrib[ "URIModelMetadata" ]
         try:
             se = ModelMetadata.objects.get( UKCL=UKCL )
         except:
@@ -1013,7 +1408,7 @@ class ShareableModel( SerializableModel ):
 
     @staticmethod
     def intersect_list(first, second):
-        first_UKCLs = list( i.UKCL for i in first )
+        first_UKCLs = set( i.UKCL for i in first )
         return [ item for item in second if item.UKCL in first_UKCLs ]
 
     @classmethod
@@ -1098,14 +1493,18 @@ class ModelMetadata( ShareableModel ):
     '''
     dataset_structure = models.ForeignKey( "DataSetStructure", null=True, blank=True )
 
+    def save(self, *args, **kwargs):
+        super( ModelMetadata, self ).save( *args, **kwargs )
+        ModelMetadataRegistry.changed( self._state.db or 'default' )
+
     def dataset_structures(self, is_shallow=False, is_a_view=False, external_reference=False):
         '''
         returns the list of the structures in which self is present as a node's ModelMetadata
         if only_versioned: skips views and shallow ones and returns at most one 
         '''
         types = [ ]
-        nodes = StructureNode.objects.using( 'materialized' ).filter( model_metadata=self,
-                                                                      external_reference=external_reference )
+        nodes = ShareableModel.swapped( StructureNode.objects.using( 'materialized' ).filter(
+            model_metadata=self, external_reference=external_reference ) )
         try:
             for structure_node in nodes:
                 entry_node = structure_node
@@ -1368,40 +1767,50 @@ class StructureNode( ShareableModel ):
     is_many = models.BooleanField( default=False, db_column='isMany' )
 
     def navigate(self, instance, instance_method_name, node_method_name, status, children_before):
+        # the structure is compiled (see PlanNode) so that it is not read again for each instance
+        StructureNode.navigate_plan( PlanNode.compile( self ), instance, instance_method_name, node_method_name,
+                                     status, children_before )
+
+    @staticmethod
+    def navigate_plan(plan_node, instance, instance_method_name, node_method_name, status, children_before):
+        '''
+        see DataSetStructure.navigate; plan_node is a PlanNode, the method node_method_name of StructureNode is
+        invoked with it as self (it has the same attributes) and the instance of the node
+        '''
         # I invoke the method on the instance and recursively on each children
         if instance_method_name:
             instance_method = getattr( instance, instance_method_name )
         if node_method_name:
-            node_method = getattr( self, node_method_name )
+            node_method = getattr( StructureNode, node_method_name )
         if not children_before and instance_method_name:
             instance_method( instance, status )
         if not children_before and node_method_name:
-            node_method( self, status )
+            node_method( plan_node, instance, status )
         # loop on children
-
-        for child_structure_node in self.child_nodes.all( ):
+        for child_structure_node in plan_node.children:
             # I don't do it to external references, they don't belong to this dataset
             # at the moment I don't do it when attribute is '' as I should use method_to_retrieve
             # to get the child instances and I can't guarantee that they are instances of ShareableModel
             if (not child_structure_node.external_reference) and child_structure_node.attribute:
                 if child_structure_node.is_many:
-                    child_instances = eval( "instance." + child_structure_node.attribute + ".all()" )
+                    # prefetched if instance has been loaded with the plan (see StructurePlan.prefetched)
+                    child_instances = getattr( instance, child_structure_node.attribute ).all( )
                     for child_instance in child_instances:
                         # let's prevent infinite loops if self relationships
                         if (child_instance.__class__.__name__ != instance.__class__.__name__) or (
                             instance.pk != child_structure_node.pk):
-                            child_structure_node.navigate( child_instance, instance_method_name, node_method_name,
-                                                           status, children_before )
+                            StructureNode.navigate_plan( child_structure_node, child_instance, instance_method_name,
+                                                         node_method_name, status, children_before )
                 else:
-                    child_instance = eval( "instance." + child_structure_node.attribute )
+                    child_instance = getattr( instance, child_structure_node.attribute )
                     if not child_instance is None:
-                        child_structure_node.navigate( child_instance, instance_method_name, node_method_name, status,
-                                                       children_before )
+                        StructureNode.navigate_plan( child_structure_node, child_instance, instance_method_name,
+                                                     node_method_name, status, children_before )
                         # else there's a method extracting information from other sources (e.g. Fields information from ORM model)
         if children_before and instance_method_name:
             instance_method( instance, status )
         if children_before and node_method_name:
-            node_method( self, status )
+            node_method( plan_node, instance, status )
 
     def navigate_helper_set_datasetstructure(self, instance, status):
         '''
@@ -1438,7 +1847,11 @@ class StructureNode( ShareableModel ):
             status[ 'output' ] = {}
         if not self.model_metadata in status[ 'output' ].keys( ):
             status[ 'output' ][ self.model_metadata ] = [ ]
-        if not instance in status[ 'output' ][ self.model_metadata ]:
+        # the same instances as the lists, to check for repetitions in O(1)
+        if not 'listed' in status.keys( ):
+            status[ 'listed' ] = set( )
+        if not instance in status[ 'listed' ]:
+            status[ 'listed' ].add( instance )
             status[ 'output' ][ self.model_metadata ].append( instance )
 
     def app_models(self, processed_instances={}, ):
@@ -1509,6 +1922,22 @@ class StructureNode( ShareableModel ):
         self.save( )
 
 
+def structure_node_child_nodes_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # adding or removing child_nodes doesn't save the StructureNode (see model_post_save)
+    if action in ( "post_add", "pre_remove", "pre_clear" ):
+        structure_nodes = [ instance ]
+        if reverse:
+            # instance is the child, the parents are in pk_set (all of them when clearing)
+            if pk_set:
+                structure_nodes += list( StructureNode.objects.using( instance._state.db ).filter( pk__in=pk_set ) )
+            else:
+                structure_nodes += list( instance.parent.all( ) )
+        StructurePlan.nodes_changed( structure_nodes )
+
+
+models.signals.m2m_changed.connect( structure_node_child_nodes_changed, sender=StructureNode.child_nodes.through )
+
+
 class DataSetStructure( ShareableModel ):
     # DSN = DataSet Structure Name
     dataset_structure_DSN = "Dataset structure"
@@ -1572,7 +2001,7 @@ class DataSetStructure( ShareableModel ):
     '''
     multiple_releases = models.BooleanField( default=False )
 
-    def navigate(self, dataset, instance_method_name, node_method_name, children_before=True):
+    def navigate(self, dataset, instance_method_name, node_method_name, children_before=True, status=None):
         '''
         Many methods do things on each node navigating in the structure
         This is a generic method that takes a method as a parameter
@@ -1580,18 +2009,35 @@ class DataSetStructure( ShareableModel ):
             def generic_structure_node_method(self, instance, status)
         each method can add whatever it wants to the status and set its output to status.output
         the instance_method_name must be a method of ModelMetadata so that it is implemented
-        by any instance of any node.
+        by any instance of any node; the node_method_name is a method of StructureNode invoked with
+        the compiled node (see PlanNode) and the instance.
+        The structure is walked through its serialization_plan and the instances are loaded with it, so
+        the number of queries depends on the depth of the structure and not on the number of instances
         If children_before the method is invoked on the children first
+        status can have other keys for the method
         '''
-        status = {"dataset": dataset}
+        status = dict( status or {}, dataset=dataset )
+        # the instances are loaded with all their children; see StructurePlan.prefetch
+        plan = self.serialization_plan( )
         if self.is_a_view:
             # I have to do it on all instances that match the dataset criteria
-            for instance in dataset.get_instances( ):
-                self.root_node.navigate( instance, instance_method_name, node_method_name, status, children_before )
+            for instance in StructurePlan.load( dataset.get_instances( ), plan ):
+                StructureNode.navigate_plan( plan, instance, instance_method_name, node_method_name, status,
+                                             children_before )
         else:
-            instance = dataset.root
-            self.root_node.navigate( instance, instance_method_name, node_method_name, status, children_before )
-        return status[ 'output' ]
+            instance = StructurePlan.prefetched( dataset.root, plan )
+            StructureNode.navigate_plan( plan, instance, instance_method_name, node_method_name, status,
+                                         children_before )
+        # a view might contain no instances
+        return status.get( 'output', {} )
+
+    def serialization_plan(self):
+        '''
+        the root_node compiled in a PlanNode; it is cached per process (see StructurePlan)
+        so that serializing many instances or datasets with this structure does not navigate
+        child_nodes on the database each time
+        '''
+        return StructurePlan.for_structure( self )
 
     def classes_code(self):
         '''
@@ -1643,42 +2089,42 @@ class DataSetStructure( ShareableModel ):
             if ar.status == ApiResponse.success:
                 apps_code = ar.content
                 for app in apps_code:
-                    app_name = OrmWrapper.get_model_container_name( netloc, app )
-                    BASE_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
-                    # is the app missing?
-                    logger.debug( "make_persistable: is %s in app_config.keys=" % app_name )
-                    if not app_name in global_apps.app_configs.keys( ):
-                        logger.debug( "make_persistable: %s NOT in app_config.keys=" % app_name )
-                        # must add it
-                        dmc = DynamicModelContainer( name=app_name )
-                        dmc.save( )
-                        management.call_command( 'startapp', app_name, 'oks/' + app_name, interactive=False )
-                        with open( BASE_DIR + "/" + app_name + "/models.py", "a" ) as myfile:
-                            myfile.write( "from knowledge_server.models import ShareableModel\n\n\n\n" )
-                        settings.INSTALLED_APPS += (app_name,)
-                    module = importlib.import_module( app_name + ".models" )
-                    for model_class in apps_code[ app ]:
-                        # is the class missing?
-                        if not hasattr( module, model_class ):
+                    # another thread doesn't write the same app meanwhile; OrmWrapper.load_module holds the
+                    # apps_lock only while it changes the registry, not while the app is migrated
+                    with OrmWrapper.persist_lock:
+                        app_name = OrmWrapper.get_model_container_name( netloc, app )
+                        BASE_DIR = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+                        # is the app missing?
+                        logger.debug( "make_persistable: is %s in app_config.keys=" % app_name )
+                        new_app = not app_name in global_apps.app_configs.keys( )
+                        if new_app:
+                            logger.debug( "make_persistable: %s NOT in app_config.keys=" % app_name )
                             # must add it
+                            management.call_command( 'startapp', app_name, 'oks/' + app_name, interactive=False )
                             with open( BASE_DIR + "/" + app_name + "/models.py", "a" ) as myfile:
-                                myfile.write( apps_code[ app ][ model_class ] + "\n\n" )
-                    # I need to reload the apps as I modified the files
-                    global_apps.app_configs = OrderedDict( )
-                    global_apps.ready = False
-                    global_apps.populate( settings.INSTALLED_APPS )
-                    # and reload the module
-                    importlib.invalidate_caches( )
-                    module = importlib.reload( module )
-
-                    logger.debug( "make_persistable: makemigrations %s " % app_name )
-                    # eventually I can generate the migrations for the new app
-                    management.call_command( 'makemigrations', app_name, interactive=False )
-                    # and migrate it
-                    logger.debug( "make_persistable: migrate %s " % app_name )
-                    management.call_command( 'migrate', app_name, interactive=False )
-                    logger.debug( "make_persistable: migrate --database=materialized %s " % app_name )
-                    management.call_command( 'migrate', "--database=materialized", app_name, interactive=False )
+                                myfile.write( "from knowledge_server.models import ShareableModel\n\n\n\n" )
+                        module = importlib.import_module( app_name + ".models" )
+                        for model_class in apps_code[ app ]:
+                            # is the class missing?
+                            if not hasattr( module, model_class ):
+                                # must add it
+                                with open( BASE_DIR + "/" + app_name + "/models.py", "a" ) as myfile:
+                                    myfile.write( apps_code[ app ][ model_class ] + "\n\n" )
+                        # I need to load the app and reload the module as I modified the files
+                        OrmWrapper.load_module( app_name, just_do_it=True )
+
+                        logger.debug( "make_persistable: makemigrations %s " % app_name )
+                        # eventually I can generate the migrations for the new app
+                        management.call_command( 'makemigrations', app_name, interactive=False )
+                        # and migrate it
+                        logger.debug( "make_persistable: migrate %s " % app_name )
+                        management.call_command( 'migrate', app_name, interactive=False )
+                        logger.debug( "make_persistable: migrate --database=materialized %s " % app_name )
+                        management.call_command( 'migrate', "--database=materialized", app_name, interactive=False )
+                        # only now that it is complete the other processes load the app at their next request
+                        if new_app:
+                            DynamicModelContainer( name=app_name ).save( )
+                        Generation.bump( Generation.DYNAMIC_APPS )
                 persistable = True
 
         return persistable
@@ -1744,7 +2190,7 @@ class DataSetStructure( ShareableModel ):
 
     @staticmethod
     def get_from_name(model_metadata_name, db_alias='default'):
-        materialized = DataSetStructure.objects.using( 'materialized' ).get( name=model_metadata_name )
+        materialized = DataSetStructure.get_current( name=model_metadata_name )
         if db_alias == 'default':
             return DataSetStructure.objects.using( 'default' ).get( UKCL=materialized.UKCL )
         else:
@@ -1815,7 +2261,8 @@ class DataSet( ShareableModel ):
 
     Relevant methods:
         new version:  create a copy of all instances starting from the root, following the nodes in the   
-                      structure, all but those with external_reference=True
+                      structure, all but those with external_reference=True; with copy_on_write the instances
+                      are shared with the previous version and copied when they are modified (see writable)
         set_released: it sets version_released True and it sets it to False for all the other instances 
                       of the same set; it materializes the dataset
     '''
@@ -1886,6 +2333,16 @@ class DataSet( ShareableModel ):
             has version_released = True
     '''
     version_released = models.BooleanField( default=False, db_index=True )
+    '''
+    True if this version has been created sharing the instances of the previous one (see new_version)
+    '''
+    copy_on_write = models.BooleanField( default=False )
+    '''
+    Only on the materialized database: True if a newer release has replaced this one (see swap_materialized);
+    it is deleted by collect_superseded
+    '''
+    superseded = models.BooleanField( default=False )
+    internal_fields = ShareableModel.internal_fields + ( 'copy_on_write', 'superseded' )
     '''
         http://www.dcc.ac.uk/resources/how-guides/license-research-data 
         "The option to multiply license a dataset is certainly available to you if you hold all the rights 
@@ -1926,104 +2383,58 @@ class DataSet( ShareableModel ):
         it exports, serializing it, a dataset; starting from the root the serialization is based on the dataset structure
         parameters:
         force_external_reference: if True if will force the root to be serialized like an external reference e.g. only the pk
+        XML is produced joining the chunks of export_chunks
         '''
         export_format = export_format.upper( )
+        if export_format == 'XML':
+            return "".join( self.export_chunks( export_format, force_external_reference ) )
         export_dict = {}
         serialized_head = ''
         comma = ""
 
-        if export_format == 'XML':
-            serialized_head = "<DataSet " + self.serialized_attributes( parent_class=ShareableModel,
-                                                                        format=export_format ) + " >" + self.serialized_tags(
-                parent_class=ShareableModel )
         if export_format == 'JSON':
             serialized_head = ' { ' + self.serialized_attributes( format=export_format )
             comma = ", "
         if export_format == 'DICT':
             export_dict.update( self.serialized_attributes( format=export_format ) )
 
-        e_model_metadata = ModelMetadata.objects.get( name="DataSetStructure" )
-        temp_structure_node = StructureNode( model_metadata=e_model_metadata, external_reference=True, is_many=False,
-                                             attribute="dataset_structure" )
-        tmp = self.dataset_structure.serialize( temp_structure_node, exported_instances=[ ],
-                                                export_format=export_format )
-        if export_format == 'DICT':
-            export_dict.update( tmp )
-        else:
-            serialized_head += comma + tmp
-
-        ks_model_metadata = ModelMetadata.objects.get( name="KnowledgeServer" )
-        temp_structure_node = StructureNode( model_metadata=ks_model_metadata, external_reference=True, is_many=False,
-                                             attribute="knowledge_server" )
-        tmp = self.knowledge_server.serialize( temp_structure_node, exported_instances=[ ],
-                                               export_format=export_format )
-        if export_format == 'DICT':
-            export_dict.update( tmp )
-        else:
-            serialized_head += comma + tmp
-
-        # UGLY PATCH: I have to add licenses
-        # quick and dirty, I export using the shallow and take the licenses from there
-        q_and_d = self.serialize( self.shallow_structure( ).root_node, exported_instances=[ ],
-                                  export_format=export_format )
-        if export_format == 'DICT':
-            export_dict.update( {'licenses': q_and_d[ 'DataSet' ][ 'licenses' ]} )
-        else:
-            end_tag = "</licenses>"
-            serialized_head += comma + q_and_d[ q_and_d.find( "<licenses>" ):q_and_d.find( end_tag ) + len( end_tag ) ]
-
-        if not self.dataset_structure.is_a_view:
-            # if it is a view there is no first_version
-            ei_model_metadata = ModelMetadata.objects.get( name="DataSet" )
-            temp_structure_node = StructureNode( model_metadata=ei_model_metadata, external_reference=True,
-                                                 is_many=False, attribute="first_version" )
-            tmp = self.first_version.serialize( temp_structure_node, exported_instances=[ ],
-                                                export_format=export_format )
+        for tmp in self.export_references( export_format ):
             if export_format == 'DICT':
                 export_dict.update( tmp )
             else:
                 serialized_head += comma + tmp
 
+        root_node = self.dataset_structure.serialization_plan( )
         if force_external_reference:
-            self.dataset_structure.root_node.external_reference = True
+            root_node = root_node.as_external_reference( )
 
         #         if self.root_instance_id:
         if not self.dataset_structure.is_a_view:
-            instance = self.root
-            tmp = instance.serialize( self.dataset_structure.root_node, exported_instances=[ ],
+            instance = StructurePlan.prefetched( self.root, root_node )
+            tmp = instance.serialize( root_node, exported_instances=[ ],
                                       export_format=export_format )
-            if export_format == 'XML':
-                serialized_head += "<ActualInstance>" + tmp + "</ActualInstance>"
             if export_format == 'JSON':
                 serialized_head += ', "ActualInstance" : { ' + tmp + " } "
             if export_format == 'DICT':
                 export_dict[ "ActualInstance" ] = tmp
         elif self.filter_text:
-            instances = self.get_instances( )
-            if export_format == 'XML':
-                serialized_head += "<ActualInstances>"
+            instances = StructurePlan.load( self.get_instances( ), root_node )
             if export_format == 'JSON':
                 serialized_head += ', "ActualInstances" : [ '
             comma = ""
             instance_list = [ ]
             for instance in instances:
-                tmp = instance.serialize( self.dataset_structure.root_node, exported_instances=[ ],
+                tmp = instance.serialize( root_node, exported_instances=[ ],
                                           export_format=export_format )
-                if export_format == 'XML':
-                    serialized_head += "<ActualInstance>" + tmp + "</ActualInstance>"
                 if export_format == 'JSON':
                     serialized_head += comma + ' { ' + tmp + " } "
                     comma = ', '
                 if export_format == 'DICT':
                     instance_list.append( tmp )
-            if export_format == 'XML':
-                serialized_head += "</ActualInstances>"
             if export_format == 'JSON':
                 serialized_head += ' ] '
             if export_format == 'DICT':
                 export_dict[ "ActualInstances" ] = instance_list
-        if export_format == 'XML':
-            serialized_tail = "</DataSet>"
         if export_format == 'JSON':
             serialized_tail = " }"
         if export_format == 'DICT':
@@ -2031,81 +2442,110 @@ class DataSet( ShareableModel ):
         else:
             return serialized_head + serialized_tail
 
-    def import_dataset(self, dataset_xml_stream):
+    def export_references(self, export_format):
         '''
+        the dataset_structure, the knowledge_server, the licenses and the first_version of the dataset
+        serialized as references (in a list), in the format used by export: XML and JSON strings or DICT
         '''
-        # http://stackoverflow.com/questions/3310614/remove-whitespaces-in-xml-string 
-        p = etree.XMLParser( remove_blank_text=True )
-        elem = etree.XML( dataset_xml_stream, parser=p )
-        dataset_xml_stream = etree.tostring( elem )
-        xmldoc = minidom.parseString( dataset_xml_stream )
+        references = [ ]
+        temp_structure_node = StructurePlan.reference_node( DataSetStructure, "dataset_structure",
+                                                          self._state.db or 'default' )
+        references.append( self.dataset_structure.serialize( temp_structure_node, exported_instances=[ ],
+                                                             export_format=export_format ) )
 
-        dataset_xml = xmldoc.childNodes[ 0 ].childNodes[ 0 ]
-        tags = [ t for t in dataset_xml.getElementsByTagName( "dataset_structure" ) if t in dataset_xml.childNodes ]
-        DataSetStructureURI = tags[ 0 ].attributes[ "UKCL" ].firstChild.data
-        # The structure netloc tells me the OKS that created the structure and the models for the nodes
-        # so I will pass it to load_class in this method and in from_xml too
-        dss_url = KsUrl( DataSetStructureURI )
-        structure_netloc = dss_url.netloc
+        temp_structure_node = StructurePlan.reference_node( KnowledgeServer, "knowledge_server",
+                                                          self._state.db or 'default' )
+        references.append( self.knowledge_server.serialize( temp_structure_node, exported_instances=[ ],
+                                                            export_format=export_format ) )
+
+        # UGLY PATCH: I have to add licenses
+        # quick and dirty, I export using the shallow and take the licenses from there
+        q_and_d = self.serialize( StructurePlan.for_shallow( self ), exported_instances=[ ],
+                                  export_format=export_format )
+        if export_format == 'DICT':
+            references.append( {'licenses': q_and_d[ 'DataSet' ][ 'licenses' ]} )
+        else:
+            end_tag = "</licenses>"
+            references.append( q_and_d[ q_and_d.find( "<licenses>" ):q_and_d.find( end_tag ) + len( end_tag ) ] )
 
-        # the structure is present locally because when I receive a dataset I import the structure before importing the dataset itself
-        es = DataSetStructure.retrieve_locally( DataSetStructureURI )
-        es.make_persistable( )
-        self.dataset_structure = es
+        if not self.dataset_structure.is_a_view:
+            # if it is a view there is no first_version
+            temp_structure_node = StructurePlan.reference_node( DataSet, "first_version",
+                                                              self._state.db or 'default' )
+            references.append( self.first_version.serialize( temp_structure_node, exported_instances=[ ],
+                                                             export_format=export_format ) )
+        return references
 
-        try:
-            with transaction.atomic( ):
-                actual_instances_xml = [ ]
-                if es.is_a_view:
-                    # I have a list of actual instances
-                    tags = [ t for t in dataset_xml.getElementsByTagName( "ActualInstances" ) if
-                             t in dataset_xml.childNodes ]
-                    for instance_xml in tags[ 0 ].childNodes:
-                        actual_instances_xml.append( instance_xml.childNodes[ 0 ] )
-                else:
-                    # I create the actual instance
-                    tags = [ t for t in dataset_xml.getElementsByTagName( "ActualInstance" ) if
-                             t in dataset_xml.childNodes ]
-                    actual_instances_xml.append( tags[ 0 ].childNodes[ 0 ] )
-                actual_class = OrmWrapper.load_class( structure_netloc, es.root_node.model_metadata.module,
-                                                      es.root_node.model_metadata.name )
-                for actual_instance_xml in actual_instances_xml:
-                    # already imported ?
-                    actual_instance_UKCL = actual_instance_xml.attributes[ "UKCL" ].firstChild.data
-                    try:
-                        actual_instance = actual_class.retrieve_locally( actual_instance_UKCL )
-                        # it is already in this database; no need to import it again; UKCL is a persistent unique  
-                        # identifier so changing the data it identifies would be an error
-                    except:  # I didn't find it on this db, no problem
-                        actual_instance = actual_class( )
-                        actual_instance.save_from_xml( structure_netloc, actual_instance_xml, es.root_node )
-                        # save_from_xml saves actual_instance on the database
-
-                # finished importing the data contained in the dataset
-                # let's create the record for the DataSet if not already imported
-                dataset_UKCL = dataset_xml.attributes[ "UKCL" ].firstChild.data
-                try:
-                    dataset_on_db = DataSet.retrieve_locally( dataset_UKCL )
-                    logger.warning(
-                        "DataSet.import_dataset - I am importing a DataSet that is already in this database; it seems it doesn't not make sense; take a look at it: " + dataset_UKCL )
-                    if not es.is_a_view:
-                        dataset_on_db.root = actual_instance
-                        dataset_on_db.save( )
-                    return dataset_on_db
-                except:  # I didn't find it on this db, no problem
-                    # In the next call the KnowledgeServer owner of this DataSet must exist
-                    # because it was imported while subscribing; it is imported by this very same method
-                    # since it is in the actual instance the next method will find it
-                    # netloc is "root.beta.thekoa.org" as I am importing a dataset (whose structure is 
-                    # owned by root)
-                    self.save_from_xml( "root.beta.thekoa.org", dataset_xml, self.shallow_structure( ).root_node )
-                    if not es.is_a_view:
-                        self.root = actual_instance
-                        self.save( )
-        except Exception as ex:
-            logger.error( "import_dataset: " + str( ex ) )
-            raise ex
-        return self
+    def export_chunks(self, export_format='XML', force_external_reference=False):
+        '''
+        Generator: it yields the export in chunks while walking the structure (see ShareableModel.serialize_chunks)
+        formats: {'XML' | 'JSON'}
+            XML  is exactly what export( export_format='XML' ) returns
+            JSON is the json encoding of export( export_format='DICT' ), the one used by the API
+        '''
+        export_format = export_format.upper( )
+        if export_format == 'XML':
+            yield "<DataSet " + self.serialized_attributes( parent_class=ShareableModel,
+                                                           format=export_format ) + " >" + self.serialized_tags(
+                parent_class=ShareableModel )
+            for reference in self.export_references( export_format ):
+                yield reference
+        if export_format == 'JSON':
+            yield "{" + json_members( self.serialized_attributes( format='DICT' ).items( ) )
+            for reference in self.export_references( 'DICT' ):
+                if reference:
+                    yield ", " + json_members( reference.items( ) )
+
+        root_node = self.dataset_structure.serialization_plan( )
+        if force_external_reference:
+            root_node = root_node.as_external_reference( )
+
+        if not self.dataset_structure.is_a_view:
+            instance = StructurePlan.prefetched( self.root, root_node )
+            if export_format == 'XML':
+                yield "<ActualInstance>"
+            if export_format == 'JSON':
+                yield ', "ActualInstance": '
+            yield from instance.serialize_chunks( root_node, exported_instances=[ ], export_format=export_format,
+                                                  fragment_cache=self.version_released )
+            if export_format == 'XML':
+                yield "</ActualInstance>"
+        elif self.filter_text:
+            if export_format == 'XML':
+                yield "<ActualInstances>"
+            if export_format == 'JSON':
+                yield ', "ActualInstances": ['
+            comma = ""
+            for instance in StructurePlan.load( self.get_instances( ), root_node ):
+                if export_format == 'XML':
+                    yield "<ActualInstance>"
+                if export_format == 'JSON':
+                    yield comma
+                    comma = ", "
+                yield from instance.serialize_chunks( root_node, exported_instances=[ ], export_format=export_format,
+                                                      fragment_cache=self.version_released )
+                if export_format == 'XML':
+                    yield "</ActualInstance>"
+            if export_format == 'XML':
+                yield "</ActualInstances>"
+            if export_format == 'JSON':
+                yield "]"
+        if export_format == 'XML':
+            yield "</DataSet>"
+        if export_format == 'JSON':
+            yield "}"
+
+    def import_dataset(self, dataset_xml_stream, bulk=None):
+        '''
+        dataset_xml_stream is the export of a DataSet (see export_chunks): bytes, a string or a file like
+        object (e.g. the response of urlopen) that is read while importing (see knowledge_server.importer)
+        bulk: the instances are written with bulk_create (see importer.BulkImport); faster, but each
+              ActualInstance is kept in memory while importing it; None: settings.KS_IMPORT[ 'BULK' ]
+        it returns the DataSet imported, or the one already in this database
+        '''
+        if bulk is None:
+            bulk = getattr( settings, 'KS_IMPORT', {} ).get( 'BULK', False )
+        return DataSetImport( self, bulk ).run( dataset_xml_stream )
 
     def get_instances(self, db_alias='materialized'):
         '''
@@ -2120,7 +2560,11 @@ class DataSet( ShareableModel ):
         structure_netloc = dss_url.netloc
         actual_class = OrmWrapper.load_class( structure_netloc, mm_model_metadata.module, mm_model_metadata.name )
         q = eval( "Q(" + self.filter_text + ")" )
-        return actual_class.objects.using( db_alias ).filter( q )
+        instances = actual_class.objects.using( db_alias ).filter( q )
+        if db_alias == 'materialized':
+            # not those of a release that has been replaced or that is not swapped in yet
+            instances = ShareableModel.swapped( instances )
+        return instances
 
     def get_instances_of_a_type(self, se, db_alias='materialized'):
         '''
@@ -2161,13 +2605,15 @@ class DataSet( ShareableModel ):
         self.version_patch = version_patch
 
     def new_version(self, version_major=None, version_minor=None, version_patch=None, version_description="",
-                    version_date=None):
+                    version_date=None, copy_on_write=False):
         '''
         DATABASE: it works only on default database as record go to the materialized one only
                   via the set_released method
         It creates new records for each record in the whole structure excluding external references
         version_released is set to False
         It creates a new DataSet and returns it
+        With copy_on_write no record is created: the new version shares the instances of self and
+        each instance must be obtained with writable before modifying it
         '''
 
         if version_major == None or version_minor == None or version_patch == None:
@@ -2188,7 +2634,14 @@ class DataSet( ShareableModel ):
                         raise Exception( message )
         try:
             with transaction.atomic( ):
-                instance = self.root.new_version( self.dataset_structure.root_node, processed_instances={} )
+                if copy_on_write:
+                    if self.root.dataset_I_belong_to_id is None:
+                        # the instances that belong to no dataset are not shared (see writable)
+                        self.set_dataset_on_instances( )
+                    instance = self.root
+                else:
+                    plan = self.dataset_structure.serialization_plan( )
+                    instance = StructurePlan.prefetched( self.root, plan ).new_version( plan, processed_instances={} )
                 new_ds = DataSet( )
                 new_ds.version_major = version_major
                 new_ds.version_minor = version_minor
@@ -2202,29 +2655,145 @@ class DataSet( ShareableModel ):
                 new_ds.first_version = self.first_version
                 new_ds.version_description = version_description
                 new_ds.root = instance
+                new_ds.copy_on_write = copy_on_write
                 if version_date:
                     new_ds.version_date = version_date
                 new_ds.save( )
-                new_ds.set_dataset_on_instances( )
+                if not copy_on_write:
+                    new_ds.set_dataset_on_instances( )
+                # the info of each version lists all the versions
+                ExportArtifacts.invalidate( self.first_version )
         except Exception as e:
             logger.error( "new_version: " + str( e ) )
         return new_ds
 
+    def writable(self, instance):
+        '''
+        copy on write (see new_version): it returns the instance to be modified in place of instance which
+        is in this dataset and could be shared with other versions. The first time it is cloned together
+        with the instances on the path from the root (see ShareableModel.clone), all the others remain shared
+        '''
+        sharing_versions = self.sharing_versions( )
+        if not instance.is_shared( self, sharing_versions ):
+            return instance
+        path = self.path_to( instance )
+        if path is None:
+            message = "DataSet.writable: " + instance.UKCL + " is not in " + self.UKCL
+            logger.error( message )
+            raise Exception( message )
+        with transaction.atomic( ):
+            clones = {}
+            parent = None
+            for structure_node, step in path:
+                if ( step.__class__, step.pk ) in clones:
+                    new_step = clones[ ( step.__class__, step.pk ) ]
+                elif not step.is_shared( self, sharing_versions ):
+                    new_step = step
+                else:
+                    new_step = step.clone( structure_node, self, parent, clones )
+                    # the clone takes the place of step in parent (the parent field is set by clone)
+                    if parent is None:
+                        self.root = new_step
+                        self.save( )
+                    elif not structure_node.is_many:
+                        setattr( parent, structure_node.attribute, new_step )
+                        parent.save( )
+                    elif ShareableModel.get_parent_field_name( parent, structure_node.attribute ) == "":
+                        getattr( parent, structure_node.attribute ).remove( step )
+                        getattr( parent, structure_node.attribute ).add( new_step )
+                parent = new_step
+        return parent
+
+    def path_to(self, instance):
+        '''
+        the list of ( node, instance ) from the root of this dataset to instance, where node is the PlanNode
+        of instance in the structure; None if instance is not in this dataset
+        '''
+        def path(structure_node, current, visited):
+            if current.__class__ == instance.__class__ and current.pk == instance.pk:
+                return [ ( structure_node, current ) ]
+            visited.add( ( current.__class__, current.pk ) )
+            for child_structure_node in structure_node.children:
+                if child_structure_node.external_reference or not child_structure_node.attribute or \
+                        child_structure_node.method_to_retrieve:
+                    continue
+                if child_structure_node.is_many:
+                    child_instances = getattr( current, child_structure_node.attribute ).all( )
+                else:
+                    child_instance = getattr( current, child_structure_node.attribute )
+                    child_instances = [ child_instance ] if child_instance is not None else [ ]
+                for child_instance in child_instances:
+                    if not ( child_instance.__class__, child_instance.pk ) in visited:
+                        child_path = path( child_structure_node, child_instance, visited )
+                        if child_path:
+                            return [ ( structure_node, current ) ] + child_path
+            return None
+
+        plan = self.dataset_structure.serialization_plan( )
+        return path( plan, StructurePlan.prefetched( self.root, plan ), set( ) )
+
+    def UKCLs_by_class(self):
+        '''
+        { class: set of the UKCLs } of the instances of this dataset
+        '''
+        by_class = {}
+        for instances in self.dataset_structure.navigate( self, "", "navigate_helper_list_by_type" ).values( ):
+            for instance in instances:
+                by_class.setdefault( instance.__class__, set( ) ).add( instance.UKCL )
+        return by_class
+
+    def materialized_UKCLs(self, by_class=None):
+        '''
+        the UKCLs of the instances of this dataset that are already on the materialized database; with
+        copy_on_write they are shared with a version already released and they are not copied again
+        by_class: UKCLs_by_class( ) when the caller already has it
+        '''
+        UKCLs = [ ]
+        for model, model_UKCLs in ( by_class or self.UKCLs_by_class( ) ).items( ):
+            UKCLs += model.objects.using( 'materialized' ).filter( UKCL__in=list( model_UKCLs ),
+                                                                   materialized_build=0 ).values_list( 'UKCL', flat=True )
+        return UKCLs
+
+    def sharing_versions(self):
+        '''
+        the pks of the versions that can share instances with self (copy on write, see new_version): those with the
+        same first_version and, as on the materialized database a release can be its own first_version (see
+        set_released), those hand_over_shared_instances hands them over to
+        '''
+        sharing = Q( first_version_id=self.first_version_id ) | Q( copy_on_write=True, UKCL_previous_version=self.UKCL )
+        if self.copy_on_write:
+            sharing = sharing | Q( UKCL=self.UKCL_previous_version )
+        return set( DataSet.objects.using( self._state.db ).filter( sharing ).exclude( pk=self.pk ).values_list(
+            'pk', flat=True ) )
+
+    def hand_over_shared_instances(self):
+        '''
+        copy on write: before self is deleted the instances it shares with the versions created from it
+        (or with the version it has been created from) go to them; self is on any database
+        '''
+        sharing = Q( copy_on_write=True, UKCL_previous_version=self.UKCL )
+        if self.copy_on_write:
+            sharing = sharing | Q( UKCL=self.UKCL_previous_version )
+        for version in DataSet.objects.using( self._state.db ).filter( sharing ).exclude( pk=self.pk ):
+            version.dataset_structure.navigate( version, "navigate_helper_hand_over", "", status={"from": self} )
+
     def materialize_dataset(self):
         '''
         if this dataset is a view then I have imported it and need to materialize it with all its instances
         if it is not a view it will have just one instance
         '''
         try:
+            plan = self.dataset_structure.serialization_plan( )
             if self.dataset_structure.is_a_view:
-                instances = self.get_instances( db_alias='default' )
+                instances = StructurePlan.load( self.get_instances( db_alias='default' ), plan )
             else:
                 instances = [ ]
-                instances.append( self.root )
+                instances.append( StructurePlan.prefetched( self.root, plan ) )
+            processed_instances = ExportedInstances( )
             for instance in instances:
                 m_existing = instance.__class__.objects.using( 'materialized' ).filter( UKCL=instance.UKCL )
                 if len( m_existing ) == 0:
-                    instance.materialize( self.dataset_structure.root_node, processed_instances=[ ] )
+                    bulk_materialize( instance, plan, processed_instances )
             m_existing = DataSet.objects.using( 'materialized' ).filter( UKCL=self.UKCL )
             if len( m_existing ) == 0:
                 self.materialize( self.shallow_structure( ).root_node, processed_instances=[ ] )
@@ -2233,22 +2802,35 @@ class DataSet( ShareableModel ):
             logger.error( "materialize_dataset (" + self.description + "): " + str( ex ) )
             raise ex
 
+    def compute_content_hash(self):
+        '''
+        the merkle_hash of the root following the structure; "" for a view (its content depends on the filter)
+        '''
+        if self.dataset_structure.is_a_view:
+            return ""
+        try:
+            plan = self.dataset_structure.serialization_plan( )
+            return StructurePlan.prefetched( self.root, plan ).merkle_hash( plan )
+        except Exception as ex:
+            # without it the datasets are compared instance by instance
+            logger.error( "compute_content_hash DataSet " + str( self.pk ) + ": " + str( ex ) )
+            return ""
+
     def set_dataset_on_instances(self):
         self.dataset_structure.navigate( self, "navigate_helper_set_dataset", "" )
 
-    def set_released(self):
+    def set_released(self, progress=None):
         '''
         Sets this version as the (only) released (one)
-        It materializes data and the DataSet itself
+        It materializes data and the DataSet itself; the materialized release replaces the previous one when
+        the transaction is committed (see swap_materialized)
         It triggers the generation of events so that subscribers to relevant datasets can get the notification
+        progress, if any, is invoked with each of ReleaseJob.phases when it starts (see ReleaseJob.run)
         '''
         try:
             with transaction.atomic( ):
-                # I set for each instance the "dataset" attribute to this dataset
-                # doing so it will be easy to retrieve the dataset in which an instance
-                # is contained; useful to retrieve its version, to make the API forgiving, ...
-                self.set_dataset_on_instances( )
-
+                if progress:
+                    progress( ReleaseJob.VERSIONS )
                 currently_released = None
                 previously_released = None
                 if not self.dataset_structure.multiple_releases:
@@ -2267,38 +2849,68 @@ class DataSet( ShareableModel ):
                         previously_released = None
                 # this one is released now
                 self.version_released = True
+                self.content_hash = self.compute_content_hash( )
                 self.save( )
+                # the artifacts of the versions whose version_released has changed are no longer valid;
+                # the new ones are rendered once the release is committed
+                ExportArtifacts.invalidate( self.first_version, [ self ] + (
+                    [ previously_released ] if previously_released else [ ] ) )
+                transaction.on_commit( lambda: ExportArtifacts.publish( self ) )
+                # cached API responses are stale
+                Generation.bump( Generation.RELEASE )
                 # MATERIALIZATION Now we must copy newly released self to the materialized database
+                if progress:
+                    progress( ReleaseJob.MATERIALIZATION )
                 # I must check whether it is already materialized so that I don't do it twice
-                m_existing = DataSet.objects.using( 'materialized' ).filter( UKCL=self.UKCL )
-                if len( m_existing ) == 0:
-                    instance = self.root
-                    materialized_instance = instance.materialize( self.dataset_structure.root_node,
-                                                                  processed_instances=[ ] )
-                    materialized_self = self.materialize( self.shallow_structure( ).root_node, processed_instances=[ ] )
-                    materialized_self.root = materialized_instance
-                    materialized_self.save( )
-                    if not self.dataset_structure.multiple_releases:
-                        # if there is only a materialized release I must set first_version to self otherwise deleting the 
-                        # previous version will delete this as well
-                        materialized_self.first_version = materialized_self
+                materialized_self = DataSet.objects.using( 'materialized' ).filter( UKCL=self.UKCL ).first( )
+                if materialized_self and not ( materialized_self.version_released or materialized_self.superseded ):
+                    # left over by a release that has failed before the swap; it might be incomplete
+                    materialized_self.delete_entire_dataset( )
+                    materialized_self = None
+                already_materialized = materialized_self is not None
+                # the instances of this release that swap_materialized sets as belonging to it
+                UKCLs_by_class = self.UKCLs_by_class( )
+                build = MaterializedBuild( )
+                if not already_materialized:
+                    # the instances shared with a version already released are on the materialized database
+                    processed_instances = ExportedInstances(
+                        self.materialized_UKCLs( UKCLs_by_class ) if self.copy_on_write else [ ] )
+                    # the records written are not visible until swap_materialized
+                    with build:
+                        materialized_instance = bulk_materialize( self.root,
+                                                                  self.dataset_structure.serialization_plan( ),
+                                                                  processed_instances )
+                        materialized_self = self.materialize( self.shallow_structure( ).root_node,
+                                                              processed_instances=[ ] )
+                        materialized_self.root = materialized_instance
+                        materialized_self.version_released = False
+                        if not self.dataset_structure.multiple_releases:
+                            # if there is only a materialized release I must set first_version to self otherwise
+                            # deleting the previous version will delete this as well
+                            materialized_self.first_version = materialized_self
                         materialized_self.save( )
-                        # now I can delete the old dataset (if any) as I want just one release (multiple_releases == false)
-                        if previously_released:
-                            materialized_previously_released = DataSet.objects.using( 'materialized' ).get(
-                                UKCL=previously_released.UKCL )
-                            materialized_previously_released.delete_entire_dataset( )
-                    # materialization is complete; I need to set the dataset on instances
-                    # it could not be done before because the materialization of the instances happens before
-                    # the materialization of the dataset; if would have generated a dangling reference
-                    materialized_self.set_dataset_on_instances( )
-
+                # the previous release stays on the materialized database, readers keep using it until the
+                # swap; it is deleted later by collect_superseded (see KnowledgeServer.run_cron)
+                materialized_previously_released = None
+                if not self.dataset_structure.multiple_releases:
+                    # the release there of another version; when set_released is invoked again after a failed swap
+                    # self is already the released one on default but not on the materialized database
+                    materialized_previously_released = DataSet.objects.using( 'materialized' ).filter(
+                        UKCL__in=list( self.first_version.versions.exclude( pk=self.pk ).values_list( 'UKCL',
+                                                                                                      flat=True ) ),
+                        version_released=True ).first( )
+                transaction.on_commit(
+                    lambda: materialized_self.swap_materialized( materialized_previously_released, build,
+                                                                 UKCLs_by_class ) )
+                if not already_materialized:
                     # If I own this DataSet then I create the event for notifications
                     # releasing a dataset that I do not own makes no sense; in fact when I create a new version of
                     # a dataset that has a different owner, the owner is set to this oks
                     this_ks = KnowledgeServer.this_knowledge_server( )
                     if self.knowledge_server.UKCL == this_ks.UKCL:
-                        # TODO: in the future this task must be run asynchronously
+                        # it runs asynchronously when the release is a ReleaseJob
+                        if progress:
+                            progress( ReleaseJob.EVENTS )
                         e = Event( )
                         e.dataset = self
                         e.type = "New version"
@@ -2315,84 +2927,129 @@ class DataSet( ShareableModel ):
                         and then compare the lists after applying the criteria of the view
 
                         '''
-                        released_instances_list = self.dataset_structure.navigate( self, "",
-                                                                                   "navigate_helper_list_by_type" )
-                        if not self.dataset_structure.multiple_releases:
-                            previously_released_instances_list = [ ]
-                            if previously_released:
-                                previously_released_instances_list = previously_released.dataset_structure.navigate(
-                                    self, "", "navigate_helper_list_by_type" )
-                        # I assume the list of keys of the above lists is the same, e.g. the dataset_structure has not changed
-                        # keys are ModelMetadata
-                        for se in released_instances_list.keys( ):
-                            '''
-                            '   if multiple_releases all the newly released instances can affect a view
-                            '   else we must compare currently and previously released
-                            '   I must create a list of
-                            '    - all those that are in current but not in previous
-                            '    - all those that are in previous but not in current
-                            '    - all those that are in both but have changed 
-                                        changed means attribute but TODO:also their relationships!!!
-                            '''
+                        if progress:
+                            progress( ReleaseJob.VIEWS )
+                        # the views are read on the materialized database where this release is not swapped in yet
+                        with build.visible( ):
+                            released_instances_list = self.dataset_structure.navigate( self, "",
+                                                                                       "navigate_helper_list_by_type" )
                             if not self.dataset_structure.multiple_releases:
+                                previously_released_instances_list = {}
                                 if previously_released:
+                                    previously_released_instances_list = previously_released.dataset_structure.navigate(
+                                        previously_released, "", "navigate_helper_list_by_type" )
+                            # view pk -> ( view, UKCLs removed, { UKCL: UKCL of its new version }, UKCLs added ): how
+                            # its ViewMembership changes once the release is on the materialized database
+                            membership = OrderedDict( )
+                            # I assume the list of keys of the above lists is the same, e.g. the dataset_structure has not changed
+                            # keys are ModelMetadata
+                            for se in released_instances_list.keys( ):
+                                '''
+                                '   if multiple_releases all the newly released instances can affect a view
+                                '   else we must compare currently and previously released
+                                '   I must create a list of
+                                '    - all those that are in current but not in previous
+                                '    - all those that are in previous but not in current
+                                '    - all those that are in both but have changed 
+                                            changed means attribute but TODO:also their relationships!!!
+                                '   the views containing one of those that were already released are found with
+                                '   ViewMembership; those that are new or have changed might match the filter of a view
+                                '   that didn't contain them
+                                '''
+                                if not self.dataset_structure.multiple_releases:
+                                    previous = previously_released_instances_list.get( se, [ ] )
+                                    # (the instances shared by the two versions, see copy_on_write, are in both)
+                                    previous_UKCLs = set( i.UKCL for i in previous )
+                                    current_UKCLs = set( i.UKCL for i in released_instances_list[ se ] )
+                                    current_previous_UKCLs = set( i.UKCL_previous_version for i in released_instances_list[ se ] )
                                     #     - all those that are in current but not in previous
                                     current_not_previous = list( i for i in released_instances_list[ se ] if
-                                                                 i.UKCL_previous_version not in list( i.UKCL for i in
-                                                                                                      previously_released_instances_list[
-                                                                                                          se ] ) )
+                                                                 i.UKCL_previous_version not in previous_UKCLs and
+                                                                 i.UKCL not in previous_UKCLs )
                                     #    - all those that are in previous but not in current
-                                    previous_not_current = list( i for i in previously_released_instances_list[ se ] if
-                                                                 i.UKCL not in list( i.UKCL_previous_version for i in
-                                                                                     released_instances_list[ se ] ) )
+                                    previous_not_current = list( i for i in previous if
+                                                                 i.UKCL not in current_previous_UKCLs and
+                                                                 i.UKCL not in current_UKCLs )
+                                    # - all those that are in both but have changed
+                                    current_changed = [ ]
+                                    previous_changed = [ ]
+                                    current_by_previous = dict( ( i.UKCL_previous_version, i ) for i in
+                                                                released_instances_list[ se ] if i.UKCL_previous_version )
+                                    for previous_instance in previous:
+                                        current_instance = current_by_previous.get( previous_instance.UKCL )
+                                        if current_instance and not ModelMetadata.compare( current_instance,
+                                                                                           previous_instance ):
+                                            current_changed.append( current_instance )
+                                            previous_changed.append( previous_instance )
+                                    released_UKCLs = list( i.UKCL for i in previous_not_current + previous_changed )
+                                    removed_UKCLs = released_UKCLs
+                                    new_instances = current_not_previous + current_changed
+                                    # the same content with the UKCL of the new version
+                                    changed_UKCLs = set( i.UKCL for i in previous_changed )
+                                    renamed = dict( ( UKCL, i.UKCL ) for UKCL, i in current_by_previous.items( ) if
+                                                    UKCL in previous_UKCLs and UKCL != i.UKCL and
+                                                    not UKCL in changed_UKCLs )
                                 else:
-                                    # previously_released is None
-                                    #     - all those that are in current but not in previous
-                                    current_not_previous = list( i for i in released_instances_list[ se ] )
-                                    previous_not_current = [ ]
-                                # - all those that are in both but have changed
-                                current_changed = [ ]
-                                previous_changed = [ ]
-                                if previously_released:
-                                    previous_and_current = list( i for i in previously_released_instances_list[ se ] if
-                                                                 i.UKCL in list( i.UKCL_previous_version for i in
-                                                                                 released_instances_list[ se ] ) )
-                                else:  # previously_released is None
-                                    previous_and_current = [ ]
-                                for previous_instance in previous_and_current:
-                                    current_instance = list( i for i in released_instances_list[ se ] if
-                                                             i.UKCL_previous_version == previous_instance.UKCL )[ 0 ]
-                                    if not ModelMetadata.compare( current_instance, previous_instance ):
-                                        current_changed.append( current_instance )
-                                        previous_changed.append( previous_instance )
-                            else:
-                                current = released_instances_list[ se ]
-                            # for each simple entity I must find the list of all structures of type view the contain
-                            # at least a node of that type;
-                            structure_views = se.dataset_structures( is_shallow=False, is_a_view=True,
-                                                                     external_reference=False )
-                            for sv in structure_views:
-                                # for each of them I find all the actual datasets
-                                dataset_views = DataSet.objects.filter( dataset_structure=sv )
-                                for dv in dataset_views:
-                                    # instances of type se within the structure of the dataset
-                                    t = dv.get_instances_of_a_type( se )
-                                    generate_event = False
-                                    if self.dataset_structure.multiple_releases:
-                                        generate_event = (len( ModelMetadata.intersect_list( t, current ) ) > 0)
-                                    else:
-                                        generate_event = (len( ModelMetadata.intersect_list( t, (
-                                        current_not_previous + previous_not_current + current_changed + previous_changed) ) ) > 0)
-                                    if generate_event:
-                                        e = Event( )
-                                        e.dataset = dv
-                                        e.type = "New version"
-                                        e.save( )
-                                        # end of transaction
+                                    current = released_instances_list[ se ]
+                                    released_UKCLs = list( i.UKCL for i in current ) + list(
+                                        i.UKCL_previous_version for i in current )
+                                    new_instances = current
+                                    # the previous releases stay
+                                    removed_UKCLs, renamed = [ ], { }
+                                new_UKCLs = list( i.UKCL for i in new_instances )
+                                # for each simple entity I must find the list of all structures of type view the contain
+                                # at least a node of that type;
+                                structure_views = se.dataset_structures( is_shallow=False, is_a_view=True,
+                                                                         external_reference=False )
+                                for sv in structure_views:
+                                    # for each of them I find all the actual datasets
+                                    dataset_views = list( DataSet.objects.filter( dataset_structure=sv ) )
+                                    ViewMembership.ensure_indexed( dataset_views )
+                                    containing = ViewMembership.views_containing( dataset_views, released_UKCLs )
+                                    for dv in dataset_views:
+                                        # the new instances that are in the view
+                                        added = [ ]
+                                        if new_instances:
+                                            if sv.root_node.model_metadata == se:
+                                                # one query: do they match the filter of the view?
+                                                added = list( dv.get_instances( ).filter(
+                                                    UKCL__in=new_UKCLs ).values_list( 'UKCL', flat=True ) )
+                                            else:
+                                                # whether they are in the view depends on the instances they are
+                                                # reachable from; instances of type se within the structure of the dataset
+                                                t = dv.get_instances_of_a_type( se )
+                                                if t is not None:
+                                                    added = list( i.UKCL for i in ModelMetadata.intersect_list(
+                                                        t, new_instances ) )
+                                        changes = membership.setdefault( dv.pk, ( dv, set( ), { }, set( ) ) )
+                                        if dv.pk in containing:
+                                            changes[ 1 ].update( removed_UKCLs )
+                                        changes[ 2 ].update( renamed )
+                                        changes[ 3 ].update( added )
+                                        if dv.pk in containing or len( added ) > 0:
+                                            e = Event( )
+                                            e.dataset = dv
+                                            e.type = "New version"
+                                            e.save( )
+
+                        def update_membership():
+                            for dv, removed, renamed, added in membership.values( ):
+                                ViewMembership.update( dv, removed, renamed, added )
+
+                        # after swap_materialized (the callbacks are run in order)
+                        transaction.on_commit( update_membership )
+                # I set for each instance the "dataset" attribute to this dataset
+                # doing so it will be easy to retrieve the dataset in which an instance
+                # is contained; useful to retrieve its version, to make the API forgiving, ...
+                if progress:
+                    progress( ReleaseJob.INSTANCES )
+                self.set_dataset_on_instances( )
                 if isinstance( self.root, DataSetStructure ):
                     # now that the DataSetStructure is released we can set each ModelMetadata.dataset_structure
                     # attribute; the method takes care of both default and materialized instances.
                     self.dataset_structure.navigate( self, "", "navigate_helper_set_datasetstructure" )
+                    # compiled serialization plans of this structure might be stale
+                    StructurePlan.invalidate( self.root.UKCL )
         except Exception as ex:
             logger.error( "set_released DataSet " + str( self.pk ) + " '" + self.description + "': " + str( ex ) )
             raise (ex)
@@ -2400,12 +3057,69 @@ class DataSet( ShareableModel ):
     def delete_entire_dataset(self):
         '''
         Navigating the structure deletes each record in the entire dataset obviously excluding external references
+        (see bulk.BulkDeletion; ShareableModel.delete_children does the same one record at a time)
         Then it deletes self
         '''
         with transaction.atomic( ):
-            self.root.delete_children( self.dataset_structure.root_node )
-            self.root.delete( )
+            # copy on write: the instances shared with other versions are not deleted
+            self.hand_over_shared_instances( )
+            BulkDeletion( self ).run( )
             self.delete( )
+            # cached API responses are stale
+            Generation.bump( Generation.RELEASE )
+
+    def swap_materialized(self, previous=None, build=None, UKCLs_by_class=None):
+        '''
+        self is a release on the materialized database that set_released has written with version_released=False
+        and with the records of build (see MaterializedBuild); in a single transaction of the materialized database
+        the instances in UKCLs_by_class (see UKCLs_by_class) are set as belonging to it with an UPDATE for each class,
+        the records of build are made visible and one UPDATE makes self the released one and previous (if any)
+        superseded. Readers don't wait for the transaction and see either the previous release or this one, never
+        part of both (see ShareableModel.swapped)
+        invoked when the transaction of set_released is committed; if it fails the error is raised to the caller of
+        set_released (e.g. the ReleaseJob fails): the previous release stays the released one on the materialized
+        database, while on default self is released, until set_released is invoked again and writes it from scratch
+        '''
+        try:
+            with transaction.atomic( using='materialized' ):
+                # it could not be done when materializing because the materialization of the instances happens
+                # before the materialization of the dataset; it would have generated a dangling reference
+                for model, UKCLs in ( UKCLs_by_class or {} ).items( ):
+                    UKCLs = list( UKCLs )
+                    for start in range( 0, len( UKCLs ), ViewMembership.batch_size ):
+                        # the instances shared with a version already released (copy_on_write) and those of build
+                        model.objects.using( 'materialized' ).filter(
+                            UKCL__in=UKCLs[ start:start + ViewMembership.batch_size ],
+                            materialized_build__in=[ 0, build.id if build else 0 ] ).update( dataset_I_belong_to=self )
+                if build:
+                    build.swap( )
+                pks = [ self.pk ] + ( [ previous.pk ] if previous else [ ] )
+                DataSet.objects.using( 'materialized' ).filter( pk__in=pks ).update(
+                    version_released=Case( When( pk=self.pk, then=Value( True ) ), default=Value( False ),
+                                           output_field=models.BooleanField( ) ),
+                    superseded=Case( When( pk=self.pk, then=Value( False ) ), default=Value( True ),
+                                     output_field=models.BooleanField( ) ) )
+            # cached API responses built before the swap are stale
+            Generation.bump( Generation.RELEASE )
+        except Exception as ex:
+            logger.error( "swap_materialized DataSet " + str( self.pk ) + " '" + self.description + "': " + str( ex ) )
+            raise ex
+
+    @staticmethod
+    def collect_superseded():
+        '''
+        it deletes from the materialized database the releases replaced by a newer one (see swap_materialized),
+        each one in its own transaction; returns a message for run_cron
+        '''
+        message = ""
+        for superseded in DataSet.objects.using( 'materialized' ).filter( superseded=True ):
+            try:
+                superseded.delete_entire_dataset( )
+                message += "Deleted superseded release " + superseded.UKCL + "<br>"
+            except Exception as ex:
+                message += "collect_superseded " + superseded.UKCL + " error: " + str( ex ) + "<br>"
+                logger.error( "collect_superseded " + superseded.UKCL + ": " + str( ex ) )
+        return message
 
     def get_latest(self, released=None):
         '''
@@ -2466,6 +3180,18 @@ class KnowledgeServer( ShareableModel ):
     #  html_* can include html tags
     organization = models.ForeignKey( Organization )
 
+    # per process: db_alias -> ( ( Generation.THIS_KS, Generation.RELEASE ), this_ks ); see this_knowledge_server
+    _this_ks = {}
+
+    def save(self, *args, **kwargs):
+        super( KnowledgeServer, self ).save( *args, **kwargs )
+        # it could be this_ks or become it
+        KnowledgeServer.clear_this_ks( )
+
+    @staticmethod
+    def clear_this_ks():
+        KnowledgeServer._this_ks = {}
+
     def url(self, encode=False):
         # "http://root.beta.thekoa.org/"
         tmp_url = self.scheme + "://" + self.netloc
@@ -2481,6 +3207,8 @@ class KnowledgeServer( ShareableModel ):
         response = self.process_events( )
         response += self.send_notifications( )
         response += self.process_received_notifications( )
+        response += ArtifactStore.collect_garbage( )
+        response += DataSet.collect_superseded( )
         return response
 
     def process_events(self):
@@ -2546,8 +3274,7 @@ class KnowledgeServer( ShareableModel ):
             for notification in notifications:
                 message += "send_notifications, found a notification for UKCL " + notification.event.dataset.UKCL + "<br>"
                 message += "about to notify " + notification.remote_url + "<br>"
-                m_es = DataSetStructure.objects.using( 'materialized' ).get(
-                    name=DataSetStructure.dataset_structure_DSN )
+                m_es = DataSetStructure.get_current( name=DataSetStructure.dataset_structure_DSN )
                 es = DataSetStructure.objects.using( 'default' ).get( UKCL=m_es.UKCL )
                 this_es = DataSetStructure.objects.get( UKCL=notification.event.dataset.dataset_structure.UKCL )
                 ei_of_this_es = DataSet.objects.get( root_instance_id=this_es.id, dataset_structure=es )
@@ -2558,6 +3285,12 @@ class KnowledgeServer( ShareableModel ):
                           urllib.parse.urlencode( {'': ei_of_this_es.UKCL} )[ 1: ], "XML",) ),
                           'type': notification.event.type,
                           'timestamp': notification.event.timestamp, }
+                previous_UKCL = notification.event.dataset.UKCL_previous_version
+                if previous_UKCL:
+                    # a subscriber that has the previous version fetches only what has changed
+                    values[ 'previous_UKCL' ] = previous_UKCL
+                    values[ 'URL_diff' ] = this_ks.url( ) + reverse( 'api_dataset_diff' ) + "?" + urllib.parse.urlencode(
+                        {'UKCL': notification.event.dataset.UKCL, 'previous_UKCL': previous_UKCL, 'format': 'XML'} )
                 data = urllib.parse.urlencode( values )
                 binary_data = data.encode( 'utf-8' )
                 req = Request( notification.remote_url, binary_data )
@@ -2582,6 +3315,22 @@ class KnowledgeServer( ShareableModel ):
         notifications = NotificationReceived.objects.filter( processed=False )
         message += "Found " + str( len( notifications ) ) + " notifications<br>"
         for notification in notifications:
+            if notification.previous_UKCL and notification.URL_diff:
+                try:
+                    with transaction.atomic( ):
+                        previous = DataSet.retrieve_locally( notification.previous_UKCL )
+                        response = urlopen( notification.URL_diff )
+                        actual_dataset = DataSetDelta( previous, response.read( ) ).apply( )
+                        actual_dataset.materialize_dataset( )
+                        notification.processed = True
+                        notification.save( )
+                    message += "process_received_notifications: diff from " + notification.previous_UKCL + " imported<br>"
+                    continue
+                except Exception as ex:
+                    # we import the whole dataset
+                    message += "process_received_notifications diff not imported: " + str( ex ) + "<br>"
+                    logger.warning( "process_received_notifications diff from " + notification.previous_UKCL +
+                                    " not imported: " + str( ex ) )
             try:
                 with transaction.atomic( ):
                     '''
@@ -2598,17 +3347,7 @@ class KnowledgeServer( ShareableModel ):
                     # otherwise we might get Dangling references
 
                     # so we parse structure_xml_stream searching for all tags <model_metadata
-                    # http://stackoverflow.com/questions/3310614/remove-whitespaces-in-xml-string 
-                    p = etree.XMLParser( remove_blank_text=True )
-                    elem = etree.XML( structure_xml_stream, parser=p )
-                    dataset_xml_stream = etree.tostring( elem )
-                    xmldoc = minidom.parseString( dataset_xml_stream )
-                    model_metadata_tags = xmldoc.getElementsByTagName( "model_metadata" )
-                    model_metadata_URIs = [ ]
-                    for mmt in model_metadata_tags:
-                        model_metadata_URIs.append( mmt.attributes[ "UKCL" ].firstChild.data )
-                    # let's make it unique
-                    model_metadata_URIs = list( set( model_metadata_URIs ) )
+                    model_metadata_URIs = model_metadata_UKCLs( structure_xml_stream )
                     # and we loop through the ModelMetadata
                     for mmu in model_metadata_URIs:
                         try:
@@ -2618,9 +3357,9 @@ class KnowledgeServer( ShareableModel ):
                             url_to_invoke = KsUrl( mmu ).home( ) + reverse( 'api_dataset', args=(
                             urllib.parse.urlencode( {'': mmu} )[ 1: ], "XML",) )
                             response = urlopen( url_to_invoke )
-                            mm_xml_stream = response.read( )
                             mm_dataset = DataSet( )
-                            mm_dataset = mm_dataset.import_dataset( mm_xml_stream )
+                            # the response is imported while it is read
+                            mm_dataset = mm_dataset.import_dataset( response )
                             mm_dataset.materialize_dataset( )
                     ds_structure = DataSet( )
                     ds_structure = ds_structure.import_dataset( structure_xml_stream )
@@ -2637,9 +3376,8 @@ class KnowledgeServer( ShareableModel ):
                     # the DataSet and also the complete actual instance 
                     # import_dataset will create the DataSet and the actual instance
                     response = urlopen( notification.URL_dataset )
-                    dataset_xml_stream = response.read( )
                     actual_dataset = DataSet( )
-                    actual_dataset = actual_dataset.import_dataset( dataset_xml_stream )
+                    actual_dataset = actual_dataset.import_dataset( response )
                     actual_dataset.dataset_structure = ds_structure.root
                     actual_dataset.materialize_dataset( )
                     notification.processed = True
@@ -2683,6 +3421,11 @@ class KnowledgeServer( ShareableModel ):
         d_self.this_ks = True
         d_self.UKCL = ""
         d_self.save( )
+        # the names of the model containers depend on the netloc of this_ks; the other processes clear
+        # their cache when they see the new generation (see OrmWrapper.load_dynamic_apps)
+        OrmWrapper.clear_cache( )
+        Generation.bump( Generation.DYNAMIC_APPS )
+        Generation.bump( Generation.THIS_KS )
 
     @staticmethod
     def this_knowledge_server(db_alias='materialized'):
@@ -2693,12 +3436,26 @@ class KnowledgeServer( ShareableModel ):
         when working on the default database we must first fetch it on the
         materialized; then, using the UKCL we search it on the default
         because the UKCL will be unique there
+        Both are cached by each process until Generation.THIS_KS (see set_as_this_ks) or Generation.RELEASE
+        (the dataset of this_ks might have been released) change or a KnowledgeServer is saved here; each caller
+        gets a copy of the cached instance so that what it changes is not seen by the others unless it is saved
         '''
-        materialized_ks = KnowledgeServer.objects.using( 'materialized' ).get( this_ks=True )
+        generations = ( Generation.current( Generation.THIS_KS ), Generation.current( Generation.RELEASE ) )
+        cache = KnowledgeServer._this_ks
+        cached = cache.get( db_alias )
+        if cached and cached[ 0 ] == generations:
+            this_ks = copy.copy( cached[ 1 ] )
+            # copy.copy shares the __dict__ entries, _state included
+            this_ks._state = copy.copy( cached[ 1 ]._state )
+            return this_ks
+        materialized_ks = KnowledgeServer.get_current( this_ks=True )
         if db_alias == 'default':
-            return KnowledgeServer.objects.using( 'default' ).get( UKCL=materialized_ks.UKCL )
+            this_ks = KnowledgeServer.objects.using( 'default' ).get( UKCL=materialized_ks.UKCL )
         else:
-            return materialized_ks
+            this_ks = materialized_ks
+        # if cleared meanwhile it goes in the old cache
+        cache[ db_alias ] = ( generations, this_ks )
+        return this_ks
 
     @staticmethod
     def get_remote_ks(remote_url):
@@ -2864,6 +3621,9 @@ class NotificationReceived( ShareableModel ):
     # URL to fetch the new data
     URL_dataset = models.CharField( max_length=200 )
     URL_structure = models.CharField( max_length=200 )
+    # the version we should already have and the URL to fetch only what has changed from it (see DataSetDelta)
+    previous_UKCL = models.CharField( max_length=750, default="", blank=True )
+    URL_diff = models.CharField( max_length=2000, default="", blank=True )
     processed = models.BooleanField( default=False, db_index=True )
     timestamp = models.DateTimeField( auto_now_add=True )
 
@@ -2911,11 +3671,64 @@ class ApiResponse( ):
         else:
             return default_format
 
+    # the ETag, Last-Modified and content_hash of the body (in the ArtifactStore) of the responses received, by url;
+    # see urlopen
+    _received = OrderedDict( )
+    _received_lock = threading.Lock( )
+    received_max_entries = 100
+
     def urlopen(self, remote_url):
-        response = urlopen( remote_url )
-        self.response = response.read( ).decode( "utf-8" )
+        '''
+        The body of a response with an ETag or a Last-Modified is written to the ArtifactStore; when the same url is
+        requested again they are sent in If-None-Match and If-Modified-Since and if the other OKS answers 304 Not
+        Modified the body is read from the file; only the validators and the name of the file are kept in memory
+        '''
+        with ApiResponse._received_lock:
+            received = ApiResponse._received.get( remote_url )
+        req = Request( remote_url )
+        if received:
+            if received[ "etag" ]:
+                req.add_header( "If-None-Match", received[ "etag" ] )
+            if received[ "last_modified" ]:
+                req.add_header( "If-Modified-Since", received[ "last_modified" ] )
+        try:
+            response = urlopen( req )
+            self.response = response.read( ).decode( "utf-8" )
+            etag = response.headers.get( "ETag" )
+            last_modified = response.headers.get( "Last-Modified" )
+            if etag or last_modified:
+                content_hash, size = ArtifactStore.write( [ self.response ] )
+                with ApiResponse._received_lock:
+                    ApiResponse._received[ remote_url ] = {"etag": etag, "last_modified": last_modified,
+                                                           "content_hash": content_hash}
+                    ApiResponse._received.move_to_end( remote_url )
+                    while len( ApiResponse._received ) > ApiResponse.received_max_entries:
+                        ApiResponse._received.popitem( last=False )
+            else:
+                with ApiResponse._received_lock:
+                    ApiResponse._received.pop( remote_url, None )
+        except HTTPError as ex:
+            if ex.code != 304 or not received:
+                raise
+            try:
+                with open( ArtifactStore.path( received[ "content_hash" ] ), 'rb' ) as f:
+                    self.response = f.read( ).decode( "utf-8" )
+            except OSError as ose:
+                # e.g. removed by ArtifactStore.collect_garbage in another process; I ask for the whole response
+                logger.warning( "ApiResponse.urlopen " + remote_url + ": " + str( ose ) )
+                with ApiResponse._received_lock:
+                    ApiResponse._received.pop( remote_url, None )
+                self.response = urlopen( Request( remote_url ) ).read( ).decode( "utf-8" )
         self.parse( self.response )
 
+    @staticmethod
+    def received_content_hashes():
+        '''
+        the files in the ArtifactStore with the bodies kept by urlopen in this process
+        '''
+        with ApiResponse._received_lock:
+            return set( received[ "content_hash" ] for received in ApiResponse._received.values( ) )
+
     def invoke_oks_api(self, oks, api, args):
         oks_url = KsUrl( oks )
         local_url = reverse( api, args=args )
@@ -2929,6 +3742,46 @@ class ApiResponse( ):
         else:
             return exported_xml
 
+    def xml_chunks(self, content_chunks):
+        '''
+        Generator: the same envelope of xml( ) but the content is an iterable of chunks (e.g. DataSet.export_chunks);
+        chunks are grouped in blocks of about stream_block_size characters to be sent by a StreamingHttpResponse
+        '''
+        return ApiResponse.blocks( self._xml_chunks( content_chunks ) )
+
+    def _xml_chunks(self, content_chunks):
+        yield "<Export ExportDateTime=\"" + self.datetime_generated_utc.isoformat( ) + "\" Status=\"" + self.status + "\" Message=\"" + self.message + "\">"
+        yield from content_chunks
+        yield "</Export>"
+
+    def json_chunks(self, content_chunks):
+        '''
+        Generator: the same envelope of json( ); content_chunks yield the json encoding of the content (see xml_chunks)
+        '''
+        return ApiResponse.blocks( self._json_chunks( content_chunks ) )
+
+    def _json_chunks(self, content_chunks):
+        yield "{" + json_members( [ ( "status", self.status ), ( "message", self.message ),
+                                    ( "datetime_generated_utc", self.datetime_generated_utc.isoformat( ) ) ] ) + ', "content": '
+        yield from content_chunks
+        yield "}"
+
+    stream_block_size = 64 * 1024
+
+    @staticmethod
+    def blocks(chunks):
+        block = [ ]
+        length = 0
+        for chunk in chunks:
+            block.append( chunk )
+            length += len( chunk )
+            if length >= ApiResponse.stream_block_size:
+                yield "".join( block )
+                block = [ ]
+                length = 0
+        if length > 0:
+            yield "".join( block )
+
     def json(self):
         #         if self.deprecated:
         #             ret_str +=  '", "deprecated" : "' + self.deprecation_message
@@ -2959,6 +3812,21 @@ def json_serial(obj):
     raise TypeError( "Type not serializable" )
 
 
+def json_members(members):
+    '''
+    members is a list of ( key, value ); it returns them encoded as the members of a json object
+    without the braces, so that an object can be written in chunks
+    '''
+    return ", ".join( json.dumps( key ) + ": " + json.dumps( value, default=json_serial ) for key, value in members )
+
+
+def xml_children(xml_node, tag):
+    '''
+    the children of the lxml element xml_node with the tag (not the descendants)
+    '''
+    return [ child for child in xml_node if child.tag == tag ]
+
+
 class ExternalReferenceNotFoundOnMaterialized( Exception ):
     """While materializing an external reference was not found, we must create 
        a DanglingReference so that we can fix it when it comes"""
@@ -2970,11 +3838,409 @@ class DynamicModelContainer( SerializableModel ):
     Some apps/modules/model containers
     are imported from other OKSs; we need a list of them so that 
     we can load them dynamically using 
-    django.core.signals.request_started 
+    django.core.signals.request_started when Generation.DYNAMIC_APPS changes
     '''
     name = models.CharField( max_length=500 )
 
 
+class DataMigration( ):
+    '''
+    The data migrations (e.g. 0003_initial_data) write with the models of the current code, which have the fields
+    added by the schema migrations that come after them; a new database would not have those columns yet.
+    RunPython( DataMigration.after_migrate( forwards_func ) ) defers forwards_func until every migration has
+    been applied (see run_pending) so that the data migration does not depend on the migrations added later;
+    the deferred functions are run in the order their migrations have been applied.
+    '''
+    # db_alias -> the deferred forwards_func
+    _pending = {}
+
+    @staticmethod
+    def after_migrate(forwards_func):
+        def defer(apps, schema_editor):
+            DataMigration._pending.setdefault( schema_editor.connection.alias, [ ] ).append( forwards_func )
+
+        return defer
+
+    @staticmethod
+    def run_pending(sender, using='default', **kwargs):
+        '''
+        connected to post_migrate, which is sent when migrate has applied every migration on using
+        '''
+        pending = DataMigration._pending.pop( using, [ ] )
+        for forwards_func in pending:
+            try:
+                # not entered: like RunPython on MySQL the function is not run within a transaction
+                forwards_func( global_apps, connections[ using ].schema_editor( ) )
+            except Exception as ex:
+                logger.error( "DataMigration.run_pending " + forwards_func.__module__ + " on " + using + ": " + str( ex ) )
+                raise
+
+
+models.signals.post_migrate.connect( DataMigration.run_pending )
+
+
+class Generation( models.Model ):
+    '''
+    A counter that is increased every time something named name changes, so that whatever
+    has been computed from it (e.g. cached API responses) can be recognized as stale in O(1)
+    Generation.RELEASE is increased whenever a dataset is released or deleted
+    Generation.DYNAMIC_APPS whenever the apps to be loaded dynamically change
+    Generation.THIS_KS whenever another KnowledgeServer becomes this_ks
+    Generation.MODEL_METADATA whenever a ModelMetadata is written
+    '''
+    RELEASE = "release"
+    # increased whenever a DynamicModelContainer is added or its models change or this_ks changes
+    # (see OrmWrapper.load_dynamic_apps)
+    DYNAMIC_APPS = "dynamic_apps"
+    # increased whenever this_ks changes (see KnowledgeServer.this_knowledge_server)
+    THIS_KS = "this_ks"
+    # increased whenever a ModelMetadata is written (see ModelMetadataRegistry)
+    MODEL_METADATA = "model_metadata"
+    name = models.CharField( max_length=100, unique=True )
+    value = models.BigIntegerField( default=0 )
+
+    # per process cache of the values: { name: ( value, expires ) }
+    _cached = {}
+    # seconds; other processes see a new generation at most ttl seconds later
+    ttl = 2
+
+    @staticmethod
+    def bump(name):
+        '''
+        to be invoked within the transaction that changes what name refers to
+        '''
+        Generation.objects.get_or_create( name=name )
+        Generation.objects.filter( name=name ).update( value=F( 'value' ) + 1 )
+        transaction.on_commit( lambda: Generation._cached.pop( name, None ) )
+
+    @staticmethod
+    def current(name):
+        cached = Generation._cached.get( name )
+        now = time.time( )
+        if cached and cached[ 1 ] > now:
+            return cached[ 0 ]
+        value = Generation.objects.filter( name=name ).values_list( 'value', flat=True ).first( ) or 0
+        Generation._cached[ name ] = ( value, now + Generation.ttl )
+        return value
+
+
+class MaterializedBuild( ):
+    '''
+    The records that a release (see DataSet.set_released) writes on the materialized database are committed before
+    swap_materialized makes it the released one; they are written with materialized_build = id, a value never used
+    before, and swap_materialized sets it to 0 with an UPDATE for each class written. Readers skip the records whose
+    materialized_build is not 0 (see ShareableModel.swapped) so they see neither a release not swapped yet nor one
+    that has failed.
+    Within "with build:" each record inserted on the materialized database by this thread gets the id of build
+    (see ShareableModel.save and BulkMaterialization.collect)
+    '''
+    NAME = "materialized_build"
+    _local = threading.local( )
+
+    def __init__(self):
+        self.id = 0
+        # the classes of the records written
+        self.classes = set( )
+
+    def __enter__(self):
+        if not self.id:
+            # on the materialized database, in a transaction of its own: the id is not used again even if the
+            # release is rolled back
+            with transaction.atomic( using='materialized' ):
+                Generation.objects.using( 'materialized' ).get_or_create( name=MaterializedBuild.NAME )
+                Generation.objects.using( 'materialized' ).filter( name=MaterializedBuild.NAME ).update(
+                    value=F( 'value' ) + 1 )
+                self.id = Generation.objects.using( 'materialized' ).get( name=MaterializedBuild.NAME ).value
+        MaterializedBuild._local.build = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        MaterializedBuild._local.build = None
+
+    def __bool__(self):
+        return self.id != 0
+
+    @staticmethod
+    def written(model):
+        '''
+        the id to be written on a record of model inserted on the materialized database; 0 outside of a build
+        '''
+        build = getattr( MaterializedBuild._local, "build", None )
+        if build is None:
+            return 0
+        build.classes.add( model )
+        return build.id
+
+    @staticmethod
+    def current():
+        '''
+        the id of the build of this thread; 0 outside of a build
+        '''
+        build = getattr( MaterializedBuild._local, "build", None )
+        return build.id if build else 0
+
+    @contextlib.contextmanager
+    def visible(self):
+        '''
+        within it the readers of this thread see the records of this build too (see ShareableModel.swapped), e.g.
+        set_released looking for the views its release affects before swap_materialized
+        '''
+        MaterializedBuild._local.visible = self.id
+        try:
+            yield self
+        finally:
+            MaterializedBuild._local.visible = 0
+
+    @staticmethod
+    def visible_builds():
+        return [ 0, getattr( MaterializedBuild._local, "visible", 0 ) ]
+
+    def swap(self):
+        '''
+        the records of this build become visible; invoked by swap_materialized within its transaction
+        '''
+        for model in self.classes:
+            model.objects.using( 'materialized' ).filter( materialized_build=self.id ).update( materialized_build=0 )
+
+
+class ExportArtifact( models.Model ):
+    '''
+    The file with the response of an API for a released dataset, rendered when it has been released;
+    the file is in the ArtifactStore and its name is content_hash; see knowledge_server/artifacts.py
+    '''
+    dataset_UKCL = models.CharField( max_length=750, db_index=True )
+    # one of ExportArtifacts.content_types.keys()
+    artifact_type = models.CharField( max_length=20 )
+    content_hash = models.CharField( max_length=64 )
+    size = models.BigIntegerField( default=0 )
+    created = models.DateTimeField( auto_now_add=True )
+
+
+class ReleaseJob( models.Model ):
+    '''
+    The release of a dataset (DataSet.set_released) requested by the release_dataset view and run later by
+    a worker (manage.py release_worker); the table is the queue so jobs survive restarts
+    A job is claimed with a conditional UPDATE so that two workers never run the same one; while it runs its worker
+    writes updated every heartbeat seconds however long set_released takes (see beat), a job RUNNING whose
+    worker has not done so for stale_after seconds is considered abandoned and claimed again
+    '''
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    # the phases of set_released, in order
+    VERSIONS = "versions"
+    MATERIALIZATION = "materialization"
+    EVENTS = "events"
+    VIEWS = "views"
+    INSTANCES = "instances"
+    phases = [ VERSIONS, MATERIALIZATION, EVENTS, VIEWS, INSTANCES ]
+    heartbeat = 60
+    # several heartbeats missed
+    stale_after = 600
+
+    dataset_UKCL = models.CharField( max_length=750 )
+    status = models.CharField( max_length=20, default=PENDING, db_index=True )
+    # the phase set_released is in; when the job is DONE, the last one it has gone through
+    phase = models.CharField( max_length=20, default="", blank=True )
+    # the error if FAILED
+    message = models.TextField( default="", blank=True )
+    worker = models.CharField( max_length=200, default="", blank=True )
+    created = models.DateTimeField( auto_now_add=True )
+    # the last time the worker has reported progress or its heartbeat
+    updated = models.DateTimeField( auto_now=True )
+    finished = models.DateTimeField( null=True, blank=True )
+
+    @staticmethod
+    def enqueue(dataset):
+        return ReleaseJob.objects.create( dataset_UKCL=dataset.UKCL )
+
+    @staticmethod
+    def claim(worker):
+        '''
+        the oldest job that can be run, now RUNNING for worker; None if there is none
+        '''
+        while True:
+            stale = timezone.now( ) - timedelta( seconds=ReleaseJob.stale_after )
+            job = ReleaseJob.objects.filter( Q( status=ReleaseJob.PENDING ) |
+                                             Q( status=ReleaseJob.RUNNING, updated__lt=stale ) ).order_by( 'pk' ).first( )
+            if job is None:
+                return None
+            # if another worker has claimed it in the meantime nothing is updated and I try the next one
+            if ReleaseJob.objects.filter( pk=job.pk, status=job.status, updated=job.updated ).update(
+                    status=ReleaseJob.RUNNING, worker=worker, phase="", updated=timezone.now( ) ) == 1:
+                return ReleaseJob.objects.get( pk=job.pk )
+
+    def set_phase(self, phase):
+        '''
+        set_released runs in a transaction; the phase is written with a connection of its own (see
+        PkAllocator.connection) so that it can be seen before the release is committed
+        '''
+        self.phase = phase
+        if connections[ 'default' ].vendor == 'sqlite':
+            # a second connection to an in memory database would be a different database
+            self.save( )
+            return
+        self.report( phase=phase )
+
+    def report(self, **fields):
+        '''
+        it writes updated, and fields, with a connection of its own of the current thread
+        '''
+        connection = PkAllocator.connection( 'default' )
+        fields[ 'updated' ] = models.DateTimeField( ).get_db_prep_value( timezone.now( ), connection )
+        names = sorted( fields.keys( ) )
+        with connection.cursor( ) as cursor:
+            cursor.execute( "UPDATE " + connection.ops.quote_name( ReleaseJob._meta.db_table ) + " SET " +
+                            ", ".join( connection.ops.quote_name( name ) + " = %s" for name in names ) +
+                            " WHERE id = %s", [ fields[ name ] for name in names ] + [ self.pk ] )
+
+    def beat(self, stopped):
+        '''
+        run in a thread of its own until stopped is set: it writes updated every heartbeat seconds so that the
+        job is not claimed again while set_released is still running
+        '''
+        if connections[ 'default' ].vendor == 'sqlite':
+            # see set_phase
+            return
+        while not stopped.wait( ReleaseJob.heartbeat ):
+            try:
+                self.report( )
+            except Exception as ex:
+                logger.error( "ReleaseJob " + str( self.pk ) + " heartbeat: " + str( ex ) )
+
+    def run(self):
+        '''
+        it releases the dataset; errors are logged and stored on the job
+        '''
+        stopped = threading.Event( )
+        heartbeat = threading.Thread( target=self.beat, args=( stopped, ), daemon=True )
+        heartbeat.start( )
+        try:
+            dataset = DataSet.objects.get( UKCL=self.dataset_UKCL )
+            dataset.set_released( progress=self.set_phase )
+            self.status = ReleaseJob.DONE
+        except Exception as ex:
+            logger.error( "ReleaseJob " + str( self.pk ) + " " + self.dataset_UKCL + ": " + str( ex ) )
+            self.status = ReleaseJob.FAILED
+            self.message = str( ex )
+        finally:
+            stopped.set( )
+            heartbeat.join( )
+        self.finished = timezone.now( )
+        self.save( )
+
+    @staticmethod
+    def run_pending(worker, max_jobs=None):
+        '''
+        it runs the jobs that can be claimed until there are none left (or max_jobs have been run);
+        returns the number of jobs run
+        '''
+        count = 0
+        while max_jobs is None or count < max_jobs:
+            job = ReleaseJob.claim( worker )
+            if job is None:
+                break
+            job.run( )
+            count += 1
+        return count
+
+    def progress(self):
+        '''
+        what the release_job_status view returns
+        '''
+        if self.status == ReleaseJob.DONE:
+            phases_done = list( ReleaseJob.phases )
+        elif self.phase in ReleaseJob.phases:
+            phases_done = ReleaseJob.phases[ :ReleaseJob.phases.index( self.phase ) ]
+        else:
+            phases_done = [ ]
+        return {"id": self.pk, "dataset_UKCL": self.dataset_UKCL, "status": self.status, "phase": self.phase,
+                "phases": ReleaseJob.phases, "phases_done": phases_done, "message": self.message,
+                "created": self.created, "updated": self.updated, "finished": self.finished}
+
+
+class ViewMembership( models.Model ):
+    '''
+    Reverse index of the views: for each view DataSet the UKCLs of the instances it contains on the materialized
+    database, of any type and anywhere in its structure; set_released finds the views a release affects
+    with one indexed query instead of navigating every view (see views_containing)
+    A row with instance_UKCL="" tells that the view has been indexed (it might contain nothing)
+    The rows of a view are written the first time it is needed and then updated by each release (see update)
+    '''
+    dataset = models.ForeignKey( DataSet, related_name='+' )
+    instance_UKCL = models.CharField( max_length=750, db_index=True, default="", blank=True )
+
+    batch_size = 1000
+
+    @staticmethod
+    def index(dataset):
+        UKCLs = set( [ "" ] )
+        for instances in dataset.dataset_structure.navigate( dataset, "", "navigate_helper_list_by_type" ).values( ):
+            UKCLs.update( instance.UKCL for instance in instances )
+        with transaction.atomic( ):
+            ViewMembership.objects.filter( dataset=dataset ).delete( )
+            ViewMembership.objects.bulk_create( list( ViewMembership( dataset=dataset, instance_UKCL=UKCL )
+                                                      for UKCL in UKCLs ), batch_size=ViewMembership.batch_size )
+
+    @staticmethod
+    def update(dataset_view, removed, renamed, added):
+        '''
+        the rows of an indexed view after a release: the UKCLs in removed are no longer in the view, those in
+        renamed ( UKCL -> UKCL of the new version of the instance, same content ) are replaced by the new one
+        if the view has them, those in added are in the view; no navigation of the view is needed.
+        Errors are logged and the rows of the view are deleted, it will be indexed again when needed
+        '''
+        try:
+            with transaction.atomic( ):
+                renamed_here = ViewMembership.contained( dataset_view, renamed.keys( ) )
+                gone = list( set( removed ) | renamed_here )
+                for start in range( 0, len( gone ), ViewMembership.batch_size ):
+                    ViewMembership.objects.filter( dataset=dataset_view, instance_UKCL__in=gone[
+                        start:start + ViewMembership.batch_size ] ).delete( )
+                new_UKCLs = ( set( added ) | set( renamed[ UKCL ] for UKCL in renamed_here ) ) - set( [ "" ] )
+                new_UKCLs -= ViewMembership.contained( dataset_view, new_UKCLs )
+                ViewMembership.objects.bulk_create( list( ViewMembership( dataset=dataset_view, instance_UKCL=UKCL )
+                                                          for UKCL in new_UKCLs ), batch_size=ViewMembership.batch_size )
+        except Exception as ex:
+            logger.error( "ViewMembership.update " + dataset_view.UKCL + ": " + str( ex ) )
+            ViewMembership.objects.filter( dataset=dataset_view ).delete( )
+
+    @staticmethod
+    def contained(dataset_view, UKCLs):
+        '''
+        the UKCLs, among UKCLs, that dataset_view has rows for
+        '''
+        UKCLs = list( UKCLs )
+        found = set( )
+        for start in range( 0, len( UKCLs ), ViewMembership.batch_size ):
+            found.update( ViewMembership.objects.filter(
+                dataset=dataset_view, instance_UKCL__in=UKCLs[ start:start + ViewMembership.batch_size ] ).values_list(
+                'instance_UKCL', flat=True ) )
+        return found
+
+    @staticmethod
+    def ensure_indexed(dataset_views):
+        indexed = set( ViewMembership.objects.filter( dataset__in=dataset_views, instance_UKCL="" ).values_list(
+            'dataset_id', flat=True ) )
+        for dataset_view in dataset_views:
+            if not dataset_view.pk in indexed:
+                ViewMembership.index( dataset_view )
+
+    @staticmethod
+    def views_containing(dataset_views, UKCLs):
+        '''
+        the pks of the views in dataset_views (indexed) that contain at least one of UKCLs
+        '''
+        pks = set( )
+        UKCLs = list( set( UKCLs ) - set( [ "", None ] ) )
+        for start in range( 0, len( UKCLs ), ViewMembership.batch_size ):
+            pks.update( ViewMembership.objects.filter(
+                dataset__in=dataset_views, instance_UKCL__in=UKCLs[ start:start + ViewMembership.batch_size ] ).values_list(
+                'dataset_id', flat=True ) )
+        return pks
+
+
 class UploadedFile( models.Model ):
     '''
     Used to save uploaded xml file so that it can be later retrieved and imported
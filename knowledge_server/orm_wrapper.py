@@ -7,11 +7,13 @@
 
 import importlib
 import logging
+import threading
 
 from collections import OrderedDict
 
 import knowledge_server.models
 
+from django.apps import AppConfig
 from django.apps.registry import apps as global_apps
 from django.conf import settings
 from django.core import signals
@@ -21,9 +23,38 @@ logger = logging.getLogger(__name__)
 
 
 class OrmWrapper():
+    # the Generation.DYNAMIC_APPS whose apps have been loaded by this process
+    dynamic_apps_generation = None
+    # held only while the registry of the apps is changed (see load_module)
+    apps_lock = threading.RLock()
+    # held by make_persistable while it writes the code of an app and migrates it; loading classes doesn't wait
+    persist_lock = threading.Lock()
+    # per process: ( method, arguments ) -> result; emptied by clear_cache
+    _resolved = {}
+    # increased by clear_cache so that what has been computed before it is not stored
+    _resolved_epoch = 0
+
     def __init__(self):
         self.model_containers = global_apps
     
+    @staticmethod
+    def _memoized(key, compute):
+        if not key in OrmWrapper._resolved:
+            epoch = OrmWrapper._resolved_epoch
+            value = compute()
+            if epoch == OrmWrapper._resolved_epoch:
+                OrmWrapper._resolved[key] = value
+            return value
+        return OrmWrapper._resolved[key]
+
+    @staticmethod
+    def clear_cache():
+        '''
+        to be invoked when the apps change (see load_module) or this_ks changes (see KnowledgeServer.set_as_this_ks)
+        '''
+        OrmWrapper._resolved_epoch += 1
+        OrmWrapper._resolved = {}
+
     @staticmethod
     def load_class(netloc, module_name, class_name):
         '''
@@ -31,16 +62,19 @@ class OrmWrapper():
         Since some classes have been added dynamically, if not found it also 
         tries to reload the app/module 
         '''
+        return OrmWrapper._memoized(("load_class", netloc, module_name, class_name),
+                                    lambda: OrmWrapper._load_class(netloc, module_name, class_name))
+
+    @staticmethod
+    def _load_class(netloc, module_name, class_name):
         try:
             module_name = OrmWrapper.get_model_container_name(netloc, module_name)
             module = importlib.import_module(module_name + ".models")
             if not module_name in global_apps.app_configs.keys():
                 if not hasattr(module, class_name):
-                    OrmWrapper.load_module(module_name)
-                    # I reload the module
-                    # and reload the module
-                    importlib.invalidate_caches()
-                    module = importlib.reload(module)
+                    # I load the app and reload the module
+                    OrmWrapper.load_module(module_name, just_do_it=True)
+                    module = importlib.import_module(module_name + ".models")
             return getattr(module, class_name)        
         except Exception as ex:
             logger.warning("OrmWrapper.load_class not found netloc %s, module_name %s, class_name %s: _%s" % (netloc, module_name, class_name, str(ex)))
@@ -94,6 +128,11 @@ class OrmWrapper():
         PLEASE NOTE that the root OKS is an exception as its modules "knowledge_server" and "serializable"
                     have the same name in any OKS
         '''
+        return OrmWrapper._memoized(("get_model_container_name", netloc, name),
+                                    lambda: OrmWrapper._get_model_container_name(netloc, name))
+
+    @staticmethod
+    def _get_model_container_name(netloc, name):
         try:
             if netloc == "root.beta.thekoa.org":
                 return name
@@ -123,6 +162,11 @@ class OrmWrapper():
         '''
         TODO: documentation
         '''
+        return OrmWrapper._memoized(("get_model_metadata_module", app_label),
+                                    lambda: OrmWrapper._get_model_metadata_module(app_label))
+
+    @staticmethod
+    def _get_model_metadata_module(app_label):
         position = app_label.rfind("__")
         if position >= 0:
             return app_label[position+2:]
@@ -131,6 +175,11 @@ class OrmWrapper():
         
     @staticmethod
     def get_model_metadata_netloc(app_label):
+        return OrmWrapper._memoized(("get_model_metadata_netloc", app_label),
+                                    lambda: OrmWrapper._get_model_metadata_netloc(app_label))
+
+    @staticmethod
+    def _get_model_metadata_netloc(app_label):
         # the apps in the root OKS are an exception because they have always the same label
         # even in other OKSs
         if app_label in knowledge_server.models.KnowledgeServer.root_apps:
@@ -155,18 +204,58 @@ class OrmWrapper():
 
     @staticmethod
     def load_dynamic_apps():
-        dmcs = knowledge_server.models.DynamicModelContainer.objects.all()
-        for dmc in dmcs:
-            OrmWrapper.load_module(dmc.name)
+        '''
+        It loads the apps added by any process (see DataSetStructure.make_persistable); DynamicModelContainer
+        is read only when Generation.DYNAMIC_APPS has changed, which is checked at most every Generation.ttl seconds
+        '''
+        generation = knowledge_server.models.Generation.current(knowledge_server.models.Generation.DYNAMIC_APPS)
+        if generation == OrmWrapper.dynamic_apps_generation:
+            return
+        # e.g. another process has changed this_ks
+        OrmWrapper.clear_cache()
+        for name in knowledge_server.models.DynamicModelContainer.objects.values_list('name', flat=True):
+            OrmWrapper.load_module(name)
+        OrmWrapper.dynamic_apps_generation = generation
         
+    @staticmethod
+    def app_config(module_name):
+        for app_config in global_apps.app_configs.values():
+            if app_config.name == module_name:
+                return app_config
+        return None
+
     @staticmethod
     def load_module(module_name, just_do_it=False):
-        if just_do_it or (not module_name in settings.INSTALLED_APPS):
-            settings.INSTALLED_APPS += (module_name, )
-            # I load the app
-            global_apps.app_configs = OrderedDict()
-            global_apps.ready = False
-            global_apps.populate(settings.INSTALLED_APPS)
+        '''
+        It adds the app module_name to the registry; the apps already there are left as they are
+        With just_do_it the models module of the app is reloaded too, e.g. when classes have been added to it
+        The registry is never emptied: the models of the app are imported, the registry is copied, the app is
+        added to the copy and the copy replaces it in a single assignment so that the other threads see it either
+        without the app or with the app and its models
+        '''
+        if not just_do_it and OrmWrapper.app_config(module_name) is not None:
+            return
+        with OrmWrapper.apps_lock:
+            app_config = OrmWrapper.app_config(module_name)
+            added = app_config is None
+            if added:
+                app_config = AppConfig.create(module_name)
+                app_config.apps = global_apps
+                app_config.import_models(global_apps.all_models[app_config.label])
+                app_configs = OrderedDict(global_apps.app_configs)
+                app_configs[app_config.label] = app_config
+                global_apps.app_configs = app_configs
+            elif not just_do_it:
+                return
+            if just_do_it and app_config.models_module is not None:
+                importlib.invalidate_caches()
+                app_config.models_module = importlib.reload(app_config.models_module)
+            global_apps.clear_cache()
+            OrmWrapper.clear_cache()
+            if not module_name in settings.INSTALLED_APPS:
+                settings.INSTALLED_APPS = settings.INSTALLED_APPS + (module_name, )
+            if added:
+                app_config.ready()
     
 class ModelContainer():
     '''
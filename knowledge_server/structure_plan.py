@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Subject to the terms of the GNU AFFERO GENERAL PUBLIC LICENSE, v. 3.0. If a copy of the AGPL was not
+# distributed with this file, You can obtain one at http://www.gnu.org/licenses/agpl.txt
+#
+# Author: Davide Galletti                davide   ( at )   c4k.it
+
+'''
+A DataSetStructure is a graph of StructureNode records stored on the database; navigating
+it while serializing a DataSet used to cost a few queries for each serialized instance
+(child_nodes, model_metadata, ...). Here the graph is compiled once into plain python
+objects (PlanNode) that can be walked any number of times without touching the database.
+'''
+
+import hashlib
+import logging
+import threading
+
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.db import transaction
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor, ReverseOneToOneDescriptor, \
+    ReverseManyToOneDescriptor, ManyToManyDescriptor
+
+import knowledge_server.models
+
+from knowledge_server.caches import ModelMetadataRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class PlanNode():
+    '''
+    In-memory copy of a StructureNode; it exposes the same attributes that are used
+    when navigating a structure; child_nodes.all() is replaced by the list children.
+    model_metadata is the ModelMetadata instance fetched when compiling; it is None
+    when the node is a GenericForeignKey (see StructureNode.sn_model_metadata)
+    '''
+
+    def __init__(self, structure_node):
+        self.pk = structure_node.pk
+        self.UKCL = structure_node.UKCL
+        self.attribute = structure_node.attribute
+        self.is_many = structure_node.is_many
+        self.external_reference = structure_node.external_reference
+        self.method_to_retrieve = structure_node.method_to_retrieve
+        self.ct_field = structure_node.ct_field
+        self.fk_field = structure_node.fk_field
+        self.model_metadata = structure_node.model_metadata
+        self.db_alias = structure_node._state.db
+        self.children = []
+        # related_lookups per model class
+        self._lookups = {}
+
+    def sn_model_metadata(self, parent=None):
+        '''
+        see StructureNode.sn_model_metadata
+        '''
+        if self.model_metadata is None:
+            child = getattr( parent, self.attribute )
+            return child.get_model_metadata( )
+        else:
+            return self.model_metadata
+
+    def as_external_reference(self):
+        '''
+        A copy of this node marked as external reference; used to serialize the
+        root of a structure just with its reference without changing the compiled plan
+        '''
+        node = PlanNode.__new__( PlanNode )
+        node.__dict__.update( self.__dict__ )
+        node.external_reference = True
+        node._lookups = {}
+        return node
+
+    def related_lookups(self, model):
+        '''
+        It returns ( select_related, prefetch_related ): the lookups that load, together with
+        the instances of model, all the instances reached navigating the structure from this node
+        so that the navigation costs a number of queries that depends on the depth of the structure
+        and not on the number of instances.
+        Forward ForeignKey and OneToOne not below a "many" relationship go in select_related;
+        everything else, GenericForeignKey included, in prefetch_related. External references are
+        loaded but not followed; a node that is already on the path (e.g. StructureNode.child_nodes
+        in the structure of the structures) is loaded once and not followed again: deeper levels
+        are loaded lazily while navigating
+        '''
+        if not model in self._lookups.keys( ):
+            select_related = [ ]
+            prefetch_related = [ ]
+            self._related_lookups( model, "", True, set( ), select_related, prefetch_related )
+            self._lookups[ model ] = ( select_related, prefetch_related )
+        return self._lookups[ model ]
+
+    def _related_lookups(self, model, prefix, selectable, on_path, select_related, prefetch_related):
+        on_path = on_path | { id( self ) }
+        for child in self.children:
+            # nothing to load for a method_to_retrieve
+            if child.method_to_retrieve or not child.attribute:
+                continue
+            lookup = prefix + child.attribute
+            descriptor = getattr( model, child.attribute, None )
+            child_selectable = False
+            # ManyToManyDescriptor must be before ReverseManyToOneDescriptor (see SerializableModel.get_parent_field_name)
+            if isinstance( descriptor, ForwardManyToOneDescriptor ):
+                child_model = descriptor.field.related_model
+                child_selectable = selectable
+            elif isinstance( descriptor, ReverseOneToOneDescriptor ):
+                child_model = descriptor.related.related_model
+                child_selectable = selectable
+            elif isinstance( descriptor, ManyToManyDescriptor ):
+                child_model = descriptor.rel.related_model if descriptor.reverse else descriptor.rel.model
+            elif isinstance( descriptor, ReverseManyToOneDescriptor ):
+                child_model = descriptor.rel.related_model
+            elif isinstance( descriptor, GenericForeignKey ):
+                # the model is known only on each instance; I load it but I do not follow it
+                prefetch_related.append( lookup )
+                continue
+            else:
+                logger.warning( "PlanNode.related_lookups: can't load \"" + child.attribute + "\" of " + model.__name__ )
+                continue
+            if child_selectable:
+                select_related.append( lookup )
+            else:
+                prefetch_related.append( lookup )
+            if not child.external_reference and not id( child ) in on_path:
+                child._related_lookups( child_model, lookup + "__", child_selectable, on_path, select_related,
+                                        prefetch_related )
+
+    @staticmethod
+    def compile(structure_node):
+        '''
+        It compiles the graph starting from structure_node; a node can be the child of
+        more than one node and it can also be its own child (e.g. StructureNode.child_nodes
+        in the structure of the structures) so nodes are compiled just once and linked
+        A StructureNode that has not been saved (e.g. the temporary ones used by DataSet.export)
+        has no children
+        '''
+        if isinstance( structure_node, PlanNode ):
+            return structure_node
+        compiled = {}
+        root = PlanNode( structure_node )
+        to_do = [ ( structure_node, root ) ]
+        if structure_node.pk:
+            compiled[ structure_node.pk ] = root
+        while len( to_do ) > 0:
+            node, plan_node = to_do.pop( )
+            if not node.pk:
+                continue
+            for child_node in node.child_nodes.select_related( 'model_metadata' ).all( ):
+                if child_node.pk in compiled.keys( ):
+                    plan_node.children.append( compiled[ child_node.pk ] )
+                else:
+                    child_plan_node = PlanNode( child_node )
+                    compiled[ child_node.pk ] = child_plan_node
+                    plan_node.children.append( child_plan_node )
+                    to_do.append( ( child_node, child_plan_node ) )
+        return root
+
+    def pks(self):
+        '''
+        the pks of the StructureNodes compiled in the graph starting from self
+        '''
+        pks = set( )
+        to_do = [ self ]
+        visited = set( )
+        while len( to_do ) > 0:
+            node = to_do.pop( )
+            if id( node ) in visited:
+                continue
+            visited.add( id( node ) )
+            if node.pk:
+                pks.add( node.pk )
+            to_do.extend( node.children )
+        return pks
+
+
+class StructurePlan():
+    '''
+    Per process cache of the compiled plans; the key is the UKCL of the DataSetStructure
+    (and the database alias as the pk of the nodes are different on default and materialized).
+    Released content identified by a UKCL does not change, so the plan is dropped when the dataset
+    of the structure is released again (see DataSet.set_released) or when one of its StructureNodes
+    is changed (see nodes_changed): here at once, in the other processes through a Generation of
+    the structure that is checked before using a plan
+    '''
+    # key -> ( Generation of the structure, plan, pks of the nodes in the plan )
+    _plans = {}
+    # key -> ( plan, pks of the nodes in the plan )
+    _shallow_plans = {}
+    _reference_nodes = {}
+    _lock = threading.Lock( )
+    # per thread: db_alias -> pks of the StructureNodes changed in the current transaction
+    _changed = threading.local( )
+
+    @staticmethod
+    def generation_name(UKCL):
+        # the name of a Generation is short, a UKCL is not
+        return "plan " + hashlib.md5( UKCL.encode( 'utf-8' ) ).hexdigest( )
+
+    @staticmethod
+    def for_structure(dataset_structure):
+        key = ( dataset_structure.UKCL, dataset_structure._state.db )
+        Generation = knowledge_server.models.Generation
+        generation = Generation.current( StructurePlan.generation_name( dataset_structure.UKCL ) )
+        cached = StructurePlan._plans.get( key )
+        if cached is not None and cached[ 0 ] == generation:
+            return cached[ 1 ]
+        plan = PlanNode.compile( dataset_structure.root_node )
+        if dataset_structure.UKCL:
+            with StructurePlan._lock:
+                StructurePlan._plans[ key ] = ( generation, plan, plan.pks( ) )
+        return plan
+
+    @staticmethod
+    def for_shallow(instance, db_alias='default'):
+        '''
+        The plan of the shallow structure of the class of instance; see ShareableModel.shallow_structure
+        '''
+        key = ( instance.__class__, db_alias )
+        cached = StructurePlan._shallow_plans.get( key )
+        if cached is not None:
+            return cached[ 0 ]
+        plan = PlanNode.compile( instance.shallow_structure( db_alias ).root_node )
+        with StructurePlan._lock:
+            StructurePlan._shallow_plans[ key ] = ( plan, plan.pks( ) )
+        return plan
+
+    @staticmethod
+    def reference_node(model_class, attribute, db_alias='default'):
+        '''
+        a node used to serialize a single instance of model_class as an external reference
+        e.g. the DataSet.dataset_structure in DataSet.export; its ModelMetadata is the one of
+        model_class on db_alias (see ModelMetadataRegistry.get: same name, module and netloc)
+        '''
+        key = ( model_class, attribute, db_alias )
+        plan = StructurePlan._reference_nodes.get( key )
+        if plan is None:
+            structure_node = knowledge_server.models.StructureNode( model_metadata=ModelMetadataRegistry.get(
+                model_class, db_alias ), external_reference=True, is_many=False, attribute=attribute )
+            structure_node._state.db = db_alias
+            plan = PlanNode.compile( structure_node )
+            with StructurePlan._lock:
+                StructurePlan._reference_nodes[ key ] = plan
+        return plan
+
+    @staticmethod
+    def prefetch(queryset, plan):
+        '''
+        queryset with the select_related and prefetch_related lookups of plan (see PlanNode.related_lookups)
+        '''
+        select_related, prefetch_related = PlanNode.compile( plan ).related_lookups( queryset.model )
+        if len( select_related ) > 0:
+            queryset = queryset.select_related( *select_related )
+        if len( prefetch_related ) > 0:
+            queryset = queryset.prefetch_related( *prefetch_related )
+        return queryset
+
+    @staticmethod
+    def load(queryset, plan):
+        '''
+        the list of the instances in queryset with everything reached by plan already loaded;
+        if the lookups can't be followed the instances are returned as they are and the
+        structure will be navigated lazily as before
+        '''
+        plan = PlanNode.compile( plan )
+        if plan.external_reference:
+            return list( queryset )
+        try:
+            return list( StructurePlan.prefetch( queryset, plan ) )
+        except Exception as ex:
+            logger.warning( "StructurePlan.load " + queryset.model.__name__ + ": " + str( ex ) )
+            return list( queryset )
+
+    @staticmethod
+    def prefetched(instance, plan):
+        '''
+        instance loaded again from its database with everything reached by plan (see load)
+        '''
+        if instance is None or instance.pk is None or PlanNode.compile( plan ).external_reference:
+            return instance
+        instances = StructurePlan.load(
+            instance.__class__.objects.using( instance._state.db ).filter( pk=instance.pk ), plan )
+        return instances[ 0 ] if len( instances ) > 0 else instance
+
+    @staticmethod
+    def invalidate(UKCL):
+        with StructurePlan._lock:
+            for key in list( StructurePlan._plans.keys( ) ):
+                if key[ 0 ] == UKCL:
+                    del StructurePlan._plans[ key ]
+            # shallow structures and the ModelMetadata in reference nodes can be part of the released structure
+            StructurePlan._shallow_plans.clear( )
+            StructurePlan._reference_nodes.clear( )
+
+    @staticmethod
+    def nodes_changed(structure_nodes):
+        '''
+        to be invoked when StructureNodes or their child_nodes have been changed (see model_post_save); the
+        plans containing them are dropped at once; when the transaction is committed the structures containing
+        them are found on the database and their Generation is increased, once for each structure
+        '''
+        pks = set( node.pk for node in structure_nodes if node.pk )
+        if len( pks ) == 0:
+            return
+        db_alias = structure_nodes[ 0 ]._state.db or 'default'
+        with StructurePlan._lock:
+            for cache in ( StructurePlan._plans, StructurePlan._shallow_plans ):
+                for key in list( cache.keys( ) ):
+                    if len( cache[ key ][ -1 ] & pks ) > 0:
+                        del cache[ key ]
+        if not hasattr( StructurePlan._changed, db_alias ):
+            setattr( StructurePlan._changed, db_alias, set( ) )
+        getattr( StructurePlan._changed, db_alias ).update( pks )
+        # once for each transaction; the callbacks of a transaction rolled back are discarded by django
+        if not any( getattr( callback, "structure_plan", False ) for savepoints, callback in
+                    transaction.get_connection( db_alias ).run_on_commit ):
+            callback = lambda: StructurePlan.bump_changed( db_alias )
+            callback.structure_plan = True
+            transaction.on_commit( callback, using=db_alias )
+
+    @staticmethod
+    def bump_changed(db_alias):
+        pks = getattr( StructurePlan._changed, db_alias )
+        setattr( StructurePlan._changed, db_alias, set( ) )
+        Generation = knowledge_server.models.Generation
+        for UKCL in StructurePlan.structures_containing( pks, db_alias ):
+            Generation.bump( StructurePlan.generation_name( UKCL ) )
+
+    @staticmethod
+    def structures_containing(pks, db_alias):
+        '''
+        the UKCLs of the DataSetStructures whose root_node reaches one of the StructureNodes pks; a query
+        for each level of the structures going up from the nodes
+        '''
+        StructureNode = knowledge_server.models.StructureNode
+        reached = set( pks )
+        level = set( pks )
+        while len( level ) > 0:
+            level = set( StructureNode.objects.using( db_alias ).filter( child_nodes__in=level ).values_list(
+                'pk', flat=True ) ) - reached
+            reached |= level
+        return set( knowledge_server.models.DataSetStructure.objects.using( db_alias ).filter(
+            root_node_id__in=reached ).exclude( UKCL="" ).values_list( 'UKCL', flat=True ) )
+
+    @staticmethod
+    def clear():
+        with StructurePlan._lock:
+            StructurePlan._plans.clear( )
+            StructurePlan._shallow_plans.clear( )
+            StructurePlan._reference_nodes.clear( )
@@ -4,10 +4,12 @@
 #
 # Author: Davide Galletti                davide   ( at )   c4k.it
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from knowledge_server.models import KnowledgeServer
 
 class ThisKSTestCase(TestCase):
+    multi_db = True
+
     def setUp(self):
         pass
 
@@ -19,3 +21,659 @@ class ThisKSTestCase(TestCase):
             pass
         self.assertIsNotNone(thisKS)
 
+    def test_this_ks_is_cached(self):
+        # e.g. generate_UKCL and get_model_metadata for each instance exported
+        KnowledgeServer.this_knowledge_server()
+        KnowledgeServer.this_knowledge_server('default')
+        with self.assertNumQueries(0), self.assertNumQueries(0, using='materialized'):
+            for i in range(10):
+                KnowledgeServer.this_knowledge_server()
+                KnowledgeServer.this_knowledge_server('default')
+        # each caller gets a copy: what it changes without saving is not seen by the others
+        this_ks = KnowledgeServer.this_knowledge_server('default')
+        name = this_ks.name
+        this_ks.name = name + " changed"
+        self.assertEqual(KnowledgeServer.this_knowledge_server('default').name, name)
+        this_ks.name = name
+        this_ks.save()
+        self.assertEqual(KnowledgeServer.this_knowledge_server('default').UKCL, this_ks.UKCL)
+
+
+class StructurePlanTestCase(TestCase):
+    '''
+    Serializing a Continent with its states, regions and provinces must take a number
+    of queries that depends on the depth of the structure and not on the number of instances
+    '''
+    multi_db = True
+
+    def setUp(self):
+        from geo.models import Continent, State, Region, Province
+        from knowledge_server.models import Generation, ModelMetadata, StructureNode
+        from knowledge_server.structure_plan import PlanNode
+
+        # the generations are read again only after Generation.ttl seconds
+        self.ttl = Generation.ttl
+        Generation.ttl = 3600
+        parent_node = None
+        for model_class, attribute in ((Continent, ""), (State, "state_set"), (Region, "region_set"), (Province, "province_set")):
+            mm = ModelMetadata.objects.create(name=model_class.__name__, module="geo")
+            node = StructureNode.objects.create(model_metadata=mm, attribute=attribute, is_many=(attribute != ""))
+            if parent_node is None:
+                root_node = node
+            else:
+                parent_node.child_nodes.add(node)
+            parent_node = node
+        self.plan = PlanNode.compile(root_node)
+
+    def tearDown(self):
+        from knowledge_server.models import Generation
+        Generation.ttl = self.ttl
+
+    def continent(self, name, size):
+        from geo.models import Continent, State, Region, Province
+
+        continent = Continent.objects.create(name=name)
+        for s in range(size):
+            state = State.objects.create(name="State %d" % s, continent=continent)
+            for r in range(size):
+                region = Region.objects.create(name="Region %d %d" % (s, r), state=state)
+                for p in range(size):
+                    Province.objects.create(name="Province %d %d %d" % (s, r, p), state=state, region=region)
+        return continent
+
+    def serialize(self, continent):
+        '''
+        the serialization and the number of queries it has taken on both databases
+        '''
+        from django.db import connections
+        from django.test.utils import CaptureQueriesContext
+        from knowledge_server.structure_plan import StructurePlan
+
+        with CaptureQueriesContext(connections['default']) as default, \
+                CaptureQueriesContext(connections['materialized']) as materialized:
+            continent = StructurePlan.prefetched(continent, self.plan)
+            serialized = continent.serialize(self.plan, exported_instances=[], export_format='XML')
+        return serialized, len(default) + len(materialized)
+
+    def test_serialize_queries_do_not_depend_on_rows(self):
+        # the first serialization reads the ModelMetadata and the generations
+        self.serialize(self.continent("Africa", 1))
+        serialized, small_queries = self.serialize(self.continent("Oceania", 1))
+        self.assertEqual(serialized.count("<Province "), 1)
+        serialized, large_queries = self.serialize(self.continent("Europe", 3))
+        self.assertEqual(serialized.count("<Province "), 27)
+        self.assertEqual(small_queries, large_queries)
+
+
+class FragmentCacheTestCase(TestCase):
+    '''
+    A cached fragment is reused only if what it exported has not been exported yet in the file
+    and what it referenced (REFERENCE_IN_THIS_FILE) has
+    '''
+    def setUp(self):
+        from knowledge_server.caches import FragmentCache
+        FragmentCache.clear()
+
+    def test_reuse_depends_on_exported_instances(self):
+        from knowledge_server.caches import ExportedInstances, FragmentCache
+
+        with self.settings(KS_FRAGMENT_CACHE={'CACHE_ALIAS': None}):
+            FragmentCache.store("k", {"text": "<a/>", "exported": ["a"], "references": ["r"]})
+            self.assertIsNone(FragmentCache.get("k", ExportedInstances([])))
+            self.assertIsNone(FragmentCache.get("k", ExportedInstances(["r", "a"])))
+            self.assertEqual(FragmentCache.get("k", ExportedInstances(["r"]))["text"], "<a/>")
+
+
+class CachePagePerReleaseTestCase(TestCase):
+    '''
+    A streamed response is cached through the artifacts once it has been sent completely
+    '''
+    def test_streamed_response_is_served_from_the_artifacts(self):
+        import tempfile
+        from django.core.cache import cache
+        from django.http import FileResponse, StreamingHttpResponse
+        from django.test import RequestFactory
+        from knowledge_server.caches import cache_page_per_release
+
+        calls = []
+
+        @cache_page_per_release(60)
+        def view(request):
+            calls.append(request)
+            response = StreamingHttpResponse(iter(["<a>", "</a>"]), content_type="application/xhtml+xml")
+            response.truncated = request.GET.get("truncated") == "1"
+            return response
+
+        cache.clear()
+        with self.settings(KS_ARTIFACTS={'ROOT': tempfile.mkdtemp()}):
+            for truncated in ("1", "0"):
+                for i in range(2):
+                    response = view(RequestFactory().get("/datasets/", {"truncated": truncated}))
+                    self.assertEqual(b"".join(response.streaming_content), b"<a></a>")
+            self.assertEqual(len(calls), 3)
+            self.assertIsInstance(response, FileResponse)
+            self.assertEqual(response["Content-Type"], "application/xhtml+xml")
+
+
+class ModelMetadataRegistryTestCase(TestCase):
+    '''
+    The ModelMetadata written in a transaction increase Generation.MODEL_METADATA once, when it is committed
+    '''
+    def test_one_bump_for_each_transaction(self):
+        from django.db import transaction
+        from knowledge_server.models import ModelMetadata
+
+        for name in ("Continent", "State"):
+            ModelMetadata.objects.create(name=name, module="geo")
+        callbacks = list(callback for savepoints, callback in transaction.get_connection().run_on_commit
+                         if getattr(callback, "model_metadata_registry", False))
+        self.assertEqual(len(callbacks), 1)
+
+
+class ReleaseJobTestCase(TestCase):
+    '''
+    release_dataset queues a ReleaseJob; here run_pending is the worker
+    '''
+    def test_a_job_is_run_once(self):
+        from knowledge_server.models import ReleaseJob
+
+        job = ReleaseJob.objects.create(dataset_UKCL="http://example.com/DataSet/0")
+        self.assertEqual(ReleaseJob.run_pending("test"), 1)
+        job.refresh_from_db()
+        # there is no such dataset
+        self.assertEqual(job.status, ReleaseJob.FAILED)
+        self.assertEqual(job.worker, "test")
+        self.assertNotEqual(job.message, "")
+        self.assertEqual(ReleaseJob.run_pending("test"), 0)
+        self.assertIsNone(ReleaseJob.claim("test"))
+
+
+class ContinentReleaseTestCase(TransactionTestCase):
+    '''
+    A structure Continent-State released together with the dataset Europe; set_released swaps the release
+    on the materialized database when its transaction is committed hence it is a TransactionTestCase
+    '''
+    multi_db = True
+    serialized_rollback = True
+
+    def setUp(self):
+        from geo.models import Continent, State
+        from knowledge_server.models import DataSet, DataSetStructure
+
+        this_ks = KnowledgeServer.this_knowledge_server('default')
+        dss = DataSetStructure(name="Test Continent-State")
+        dss.SetNotNullFields()
+        dss.save()
+        mm_continent = dss.create_model_metadata("Continent", "geo", "name")
+        mm_state = dss.create_model_metadata("State", "geo", "name")
+        KnowledgeServer.register_models([mm_continent, mm_state])
+        dss.root_model_metadata(mm_continent)
+        dss.root_node.children_nodes_for(["state_set"], this_ks.netloc)
+        dss.save()
+        dss_dss = DataSetStructure.get_from_name(DataSetStructure.dataset_structure_DSN)
+        DataSet(description='DataSet for data set structure "Continent-State"', knowledge_server=this_ks,
+                dataset_structure=dss_dss, root=dss, version_major=0, version_minor=1, version_patch=0).save()
+        DataSet.objects.get(root_instance_id=dss.pk, dataset_structure=dss_dss).set_released()
+
+        europe = Continent.objects.create(name="Europe")
+        for name in ("Italy", "Spain"):
+            State.objects.create(name=name, continent=europe)
+        self.dataset = DataSet(knowledge_server=this_ks, dataset_structure=dss, root=europe, description="Europe",
+                               version_major=0, version_minor=1, version_patch=0, version_description="")
+        self.dataset.save()
+
+
+class BulkDeletionTestCase(ContinentReleaseTestCase):
+    '''
+    Deleting a superseded release from the materialized database must leave default as it is: the
+    previous versions there still point at the instances of that release
+    '''
+    def test_previous_version_on_default_is_intact(self):
+        from geo.models import State
+        from knowledge_server.models import DataSet
+
+        self.dataset.set_released()
+        new_version = self.dataset.new_version()
+        new_version.set_released()
+        self.assertTrue(DataSet.objects.using('materialized').get(UKCL=self.dataset.UKCL).superseded)
+        DataSet.collect_superseded()
+        self.assertFalse(DataSet.objects.using('materialized').filter(UKCL=self.dataset.UKCL).exists())
+        self.assertTrue(DataSet.objects.using('materialized').get(UKCL=new_version.UKCL).version_released)
+
+        previous_root = DataSet.objects.get(pk=self.dataset.pk).root
+        new_root = DataSet.objects.get(pk=new_version.pk).root
+        self.assertNotEqual(previous_root.pk, new_root.pk)
+        self.assertEqual(sorted(State.objects.filter(continent=previous_root).values_list('name', flat=True)),
+                         ["Italy", "Spain"])
+        self.assertEqual(sorted(State.objects.filter(continent=new_root).values_list('name', flat=True)),
+                         ["Italy", "Spain"])
+
+
+class ReleaseJobRunTestCase(ContinentReleaseTestCase):
+    '''
+    A job releases its dataset going through the phases of set_released in order
+    '''
+    def test_a_job_releases_the_dataset(self):
+        from knowledge_server.models import DataSet, ReleaseJob
+
+        ReleaseJob.enqueue(self.dataset)
+        job = ReleaseJob.claim("test")
+        phases = []
+
+        def set_phase(phase, set_phase=job.set_phase):
+            phases.append(phase)
+            set_phase(phase)
+        job.set_phase = set_phase
+        job.run()
+        self.assertEqual(phases, ReleaseJob.phases)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReleaseJob.DONE)
+        self.assertEqual(job.phase, ReleaseJob.INSTANCES)
+        self.assertIsNotNone(job.finished)
+        self.assertEqual(job.progress()["phases_done"], ReleaseJob.phases)
+        self.assertTrue(DataSet.objects.get(pk=self.dataset.pk).version_released)
+        self.assertTrue(DataSet.objects.using('materialized').get(UKCL=self.dataset.UKCL).version_released)
+        self.assertIsNone(ReleaseJob.claim("test"))
+
+
+class DataSetDiffTestCase(ContinentReleaseTestCase):
+    '''
+    A new version gives a new UKCL to each instance it copies; without changes they are all unchanged
+    '''
+    def test_a_new_version_without_changes_is_unchanged(self):
+        from knowledge_server.diff import DataSetDiff
+
+        self.dataset.set_released()
+        new_version = self.dataset.new_version()
+        diff = DataSetDiff(self.dataset, new_version)
+        self.assertEqual(diff.added, [])
+        self.assertEqual(diff.removed, [])
+        self.assertEqual(diff.modified, [])
+        self.assertEqual(sorted(instance.name for instance in diff.renamed), ["Europe", "Italy", "Spain"])
+
+
+class SwapFailureTestCase(ContinentReleaseTestCase):
+    '''
+    A release whose swap on the materialized database fails is not done: its job fails and releasing it again
+    completes it
+    '''
+    def test_a_failed_swap_fails_the_job(self):
+        from knowledge_server.models import DataSet, ReleaseJob
+
+        def failing_swap(*args, **kwargs):
+            raise Exception("swap failed")
+        swap_materialized = DataSet.swap_materialized
+        DataSet.swap_materialized = failing_swap
+        try:
+            job = ReleaseJob.enqueue(self.dataset)
+            ReleaseJob.run_pending("test")
+        finally:
+            DataSet.swap_materialized = swap_materialized
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReleaseJob.FAILED)
+        self.assertFalse(DataSet.objects.using('materialized').get(UKCL=self.dataset.UKCL).version_released)
+        DataSet.objects.get(pk=self.dataset.pk).set_released()
+        self.assertTrue(DataSet.objects.using('materialized').get(UKCL=self.dataset.UKCL).version_released)
+
+
+class NavigateTestCase(ContinentReleaseTestCase):
+    '''
+    Navigating a dataset takes a number of queries that depends on its structure and not on its instances
+    '''
+    def test_navigate_queries_do_not_depend_on_rows(self):
+        from django.db import connections
+        from django.test.utils import CaptureQueriesContext
+        from geo.models import State
+        from knowledge_server.models import ModelMetadata
+
+        mm_state = ModelMetadata.objects.get(name="State", module="geo")
+        # the first navigation compiles the plan
+        self.dataset.get_instances_of_a_type(mm_state)
+        with CaptureQueriesContext(connections['default']) as few:
+            self.assertEqual(len(self.dataset.get_instances_of_a_type(mm_state)), 2)
+        for s in range(10):
+            State.objects.create(name="State %d" % s, continent=self.dataset.root)
+        with CaptureQueriesContext(connections['default']) as many:
+            self.assertEqual(len(self.dataset.get_instances_of_a_type(mm_state)), 12)
+        self.assertEqual(len(many), len(few))
+
+
+class ExportChunksTestCase(ContinentReleaseTestCase):
+    '''
+    The chunks streamed by the API are the same export that is built in memory
+    '''
+    def test_chunks_are_the_export(self):
+        import json
+
+        self.assertEqual("".join(self.dataset.export_chunks('XML')), self.dataset.export('XML'))
+        self.assertEqual(json.loads("".join(self.dataset.export_chunks('JSON'))), self.dataset.export('DICT'))
+
+
+class ExportArtifactsTestCase(ContinentReleaseTestCase):
+    '''
+    A released dataset is served from the file rendered when it has been released; a new release invalidates
+    the exports of the versions whose version_released changes and the info of all the versions
+    '''
+    def artifact_types(self, dataset):
+        from knowledge_server.models import ExportArtifact
+
+        return sorted(ExportArtifact.objects.filter(dataset_UKCL=dataset.UKCL).values_list('artifact_type', flat=True))
+
+    def test_released_dataset_is_served_from_its_artifact(self):
+        import tempfile
+        from django.http import FileResponse
+        from knowledge_server.artifacts import ArtifactStore, ExportArtifacts
+        from knowledge_server.models import DataSet, ExportArtifact
+
+        with self.settings(KS_ARTIFACTS={'ROOT': tempfile.mkdtemp()}):
+            self.dataset.set_released()
+            self.assertEqual(self.artifact_types(self.dataset), sorted(ExportArtifacts.content_types.keys()))
+            response = self.client.get("/api/dataset/", {"UKCL": self.dataset.UKCL, "format": "XML"})
+            self.assertIsInstance(response, FileResponse)
+            artifact = ExportArtifact.objects.get(dataset_UKCL=self.dataset.UKCL, artifact_type=ExportArtifacts.XML)
+            with open(ArtifactStore.path(artifact.content_hash), 'rb') as f:
+                self.assertEqual(b"".join(response.streaming_content), f.read())
+
+            new_version = self.dataset.new_version()
+            self.assertEqual(self.artifact_types(self.dataset), [ExportArtifacts.JSON, ExportArtifacts.XML])
+            DataSet.objects.get(pk=new_version.pk).set_released()
+            self.assertEqual(self.artifact_types(self.dataset), [])
+            self.assertEqual(self.artifact_types(new_version), sorted(ExportArtifacts.content_types.keys()))
+
+
+class ConditionalGetTestCase(ContinentReleaseTestCase):
+    '''
+    The export of a released dataset doesn't change: a client that has it gets a 304
+    '''
+    def test_unchanged_export_is_not_modified(self):
+        self.dataset.set_released()
+        parameters = {"UKCL": self.dataset.UKCL, "format": "JSON"}
+        response = self.client.get("/api/dataset/", parameters)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header("ETag"))
+        self.assertTrue(response.has_header("Last-Modified"))
+        etag = response["ETag"]
+        response = self.client.get("/api/dataset/", parameters, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # another format is another content
+        response = self.client.get("/api/dataset/", {"UKCL": self.dataset.UKCL, "format": "XML"},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class DataSetImportTestCase(ContinentReleaseTestCase):
+    '''
+    The export of a dataset whose instances are not in this database imports them with their UKCLs
+    '''
+    def reimport(self, bulk):
+        from geo.models import Continent, State
+        from knowledge_server.models import DataSet
+
+        exported = "<Export>" + self.dataset.export('XML') + "</Export>"
+        root_UKCL = self.dataset.root.UKCL
+        states = sorted(State.objects.filter(continent=self.dataset.root).values_list('UKCL', 'name'))
+        Continent.objects.filter(UKCL=root_UKCL).delete()
+        imported = DataSet().import_dataset(exported, bulk=bulk)
+        self.assertEqual(imported.pk, self.dataset.pk)
+        imported = DataSet.objects.get(pk=imported.pk)
+        self.assertEqual(imported.root.UKCL, root_UKCL)
+        self.assertEqual(sorted(State.objects.filter(continent=imported.root).values_list('UKCL', 'name')), states)
+
+    def test_streaming_import(self):
+        self.reimport(bulk=False)
+
+    def test_bulk_import(self):
+        self.reimport(bulk=True)
+
+
+class PkAllocatorTestCase(ContinentReleaseTestCase):
+    '''
+    The ids are handed out from blocks reserved on Generation; a request larger than what is left in
+    the block in memory continues in a new one
+    '''
+    def setUp(self):
+        from knowledge_server.allocator import PkAllocator
+
+        super(PkAllocatorTestCase, self).setUp()
+        self.block_size = PkAllocator.block_size
+        PkAllocator.block_size = 3
+        PkAllocator.clear()
+
+    def tearDown(self):
+        from knowledge_server.allocator import PkAllocator
+
+        PkAllocator.block_size = self.block_size
+        PkAllocator.clear()
+        super(PkAllocatorTestCase, self).tearDown()
+
+    def test_reserve_across_blocks(self):
+        from geo.models import Continent
+        from knowledge_server.allocator import PkAllocator
+
+        first = PkAllocator.reserve(Continent, 'default', 2)
+        # one id left in the first block, three more from a new one reserved with a connection of its own
+        with self.assertNumQueries(0):
+            second = PkAllocator.reserve(Continent, 'default', 4)
+        ids = first + second
+        self.assertEqual(len(set(ids)), 6)
+        self.assertEqual(ids, list(range(ids[0], ids[0] + 6)))
+        self.assertGreater(ids[0], Continent.objects.get(name="Europe").pk)
+
+    def test_a_new_instance_gets_its_UKCL_before_the_insert(self):
+        from geo.models import Continent
+
+        asia = Continent(name="Asia")
+        asia.save()
+        self.assertIsNotNone(asia.pk)
+        self.assertTrue(asia.UKCL.endswith("/" + str(asia.pk)))
+        self.assertEqual(Continent.objects.get(pk=asia.pk).UKCL, asia.UKCL)
+
+
+class BulkMaterializationTestCase(ContinentReleaseTestCase):
+    '''
+    The released instances are on the materialized database with the same UKCL; a ForeignKey points at the
+    copy of the instance it refers to
+    '''
+    def assertMaterialized(self, root):
+        from geo.models import Continent, State
+
+        materialized_root = Continent.objects.using('materialized').get(UKCL=root.UKCL)
+        self.assertEqual(materialized_root.materialized_build, 0)
+        states = State.objects.using('materialized').filter(UKCL__in=[s.UKCL for s in root.state_set.all()])
+        self.assertEqual(sorted(states.values_list('UKCL', 'name')), sorted(root.state_set.values_list('UKCL', 'name')))
+        self.assertEqual(set(state.continent_id for state in states), {materialized_root.pk})
+
+    def test_set_released_materializes_the_structure(self):
+        self.dataset.set_released()
+        self.assertMaterialized(self.dataset.root)
+
+    def test_sql_copy_needs_committed_rows(self):
+        from django.db import transaction
+        from knowledge_server.bulk import BulkMaterialization, SqlCopy
+
+        sql_copy = SqlCopy('default', 'materialized')
+        self.assertTrue(sql_copy.source_committed())
+        with transaction.atomic():
+            self.assertFalse(sql_copy.source_committed())
+            self.assertIsNotNone(sql_copy.not_possible(BulkMaterialization()))
+
+    def test_sql_copy_outside_of_a_transaction(self):
+        from knowledge_server.bulk import SqlCopy, bulk_materialize
+
+        if not SqlCopy('default', 'materialized').same_server():
+            self.skipTest("default and materialized are not schemas on the same MySQL server")
+        bulk_materialize(self.dataset.root, self.dataset.dataset_structure.serialization_plan())
+        self.assertMaterialized(self.dataset.root)
+
+
+class DataSetDiffApiTestCase(ContinentReleaseTestCase):
+    '''
+    api_dataset_diff lists what changed from the version a dataset has been created from
+    '''
+    def changed_version(self):
+        '''
+        a new version of self.dataset where Italy is renamed, Spain removed and France added
+        '''
+        from geo.models import State
+
+        self.dataset.set_released()
+        new_version = self.dataset.new_version()
+        for state in State.objects.filter(continent=new_version.root):
+            if state.name == "Italy":
+                state.name = "Italia"
+                state.save()
+            else:
+                state.delete()
+        State.objects.create(name="France", continent=new_version.root)
+        return new_version
+
+    def test_diff_of_a_new_version(self):
+        from geo.models import State
+
+        spain = State.objects.get(continent=self.dataset.root, name="Spain")
+        new_version = self.changed_version()
+        new_version.set_released()
+        response = self.client.get("/api/dataset_diff/", {"UKCL": new_version.UKCL, "format": "XML"})
+        self.assertEqual(response.status_code, 200)
+        content = b"".join(response.streaming_content).decode("utf-8")
+        added = content[content.index("<Added>"):content.index("</Added>")]
+        removed = content[content.index("<Removed>"):content.index("</Removed>")]
+        modified = content[content.index("<Modified>"):content.index("</Modified>")]
+        self.assertIn('"France"', added)
+        # a removed instance is only referred to
+        self.assertIn('UKCL="' + spain.UKCL + '"', removed)
+        self.assertIn('"Italia"', modified)
+
+    def test_only_from_the_previous_version(self):
+        new_version = self.changed_version()
+        new_version.set_released()
+        response = self.client.get("/api/dataset_diff/", {"UKCL": new_version.UKCL, "format": "XML",
+                                                          "previous_UKCL": new_version.UKCL})
+        self.assertEqual(response.status_code, 500)
+        response = self.client.get("/api/dataset_diff/", {"UKCL": self.dataset.UKCL, "format": "XML"})
+        self.assertEqual(response.status_code, 500)
+
+
+class DataSetDeltaTestCase(ContinentReleaseTestCase):
+    '''
+    The diff of a version applied to the previous one where that version is not gives the same version
+    '''
+    changed_version = DataSetDiffApiTestCase.changed_version
+
+    def test_diff_and_delta_round_trip(self):
+        from geo.models import Continent, State
+        from knowledge_server.diff import DataSetDelta, DataSetDiff
+        from knowledge_server.models import DataSet
+
+        new_version = self.changed_version()
+        content_hash = new_version.compute_content_hash()
+        diff_xml = "".join(DataSetDiff(self.dataset, new_version).chunks('XML'))
+        states = sorted(State.objects.filter(continent=new_version.root).values_list('UKCL', 'name'))
+        # as on a subscriber that has only the previous version
+        root_pk = new_version.root.pk
+        DataSet.objects.filter(pk=new_version.pk).delete()
+        Continent.objects.filter(pk=root_pk).delete()
+
+        applied = DataSetDelta(DataSet.objects.get(pk=self.dataset.pk), diff_xml).apply()
+        self.assertEqual(applied.UKCL, new_version.UKCL)
+        self.assertEqual(applied.compute_content_hash(), content_hash)
+        self.assertEqual(sorted(State.objects.filter(continent=applied.root).values_list('UKCL', 'name')), states)
+
+    def test_a_diff_from_another_version_is_not_applied(self):
+        from knowledge_server.diff import DataSetDelta, DataSetDiff, DeltaNotApplicable
+        from knowledge_server.models import DataSet
+
+        new_version = self.changed_version()
+        diff_xml = "".join(DataSetDiff(self.dataset, new_version).chunks('XML'))
+        versions = DataSet.objects.filter(first_version_id=self.dataset.first_version_id).count()
+        with self.assertRaises(DeltaNotApplicable):
+            DataSetDelta(new_version, diff_xml).apply()
+        self.assertEqual(DataSet.objects.filter(first_version_id=self.dataset.first_version_id).count(), versions)
+
+
+class DynamicAppsTestCase(TestCase):
+    '''
+    The dynamic apps are loaded again only when Generation.DYNAMIC_APPS changes, not on each request
+    '''
+    multi_db = True
+
+    def setUp(self):
+        from knowledge_server.models import Generation
+
+        self.ttl = Generation.ttl
+        Generation.ttl = 3600
+        Generation._cached.clear()
+
+    def tearDown(self):
+        from knowledge_server.models import Generation
+
+        Generation.ttl = self.ttl
+        Generation._cached.clear()
+
+    def test_apps_are_loaded_when_the_generation_changes(self):
+        from knowledge_server.models import Generation
+        from knowledge_server.orm_wrapper import OrmWrapper
+
+        OrmWrapper.load_dynamic_apps()
+        with self.assertNumQueries(0):
+            for i in range(10):
+                OrmWrapper.load_dynamic_apps()
+        generation = OrmWrapper.dynamic_apps_generation
+        Generation.bump(Generation.DYNAMIC_APPS)
+        # the transaction is not committed in a TestCase, the cached value is dropped as on_commit would
+        Generation._cached.clear()
+        OrmWrapper.load_dynamic_apps()
+        self.assertEqual(OrmWrapper.dynamic_apps_generation, generation + 1)
+
+
+class LoadModuleTestCase(TestCase):
+    '''
+    Threads loading the same app add it once, to a copy of the registry: the registry a thread was already
+    using doesn't change
+    '''
+    def test_concurrent_load_module(self):
+        import threading
+        from django.apps import apps
+        from django.conf import settings
+        from knowledge_server.orm_wrapper import OrmWrapper
+
+        app_configs = apps.app_configs
+        installed_apps = settings.INSTALLED_APPS
+        try:
+            threads = [threading.Thread(target=OrmWrapper.load_module, args=("django.contrib.humanize",))
+                       for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertNotIn("humanize", app_configs)
+            self.assertEqual(apps.get_app_config("humanize").name, "django.contrib.humanize")
+            self.assertEqual(list(settings.INSTALLED_APPS).count("django.contrib.humanize"), 1)
+        finally:
+            apps.app_configs = app_configs
+            settings.INSTALLED_APPS = installed_apps
+            apps.clear_cache()
+            OrmWrapper.clear_cache()
+
+
+class LoadClassTestCase(TestCase):
+    '''
+    The classes are resolved once per process; clear_cache resolves them again
+    '''
+    multi_db = True
+
+    def test_load_class_is_memoized(self):
+        from knowledge_server.models import DataSet
+        from knowledge_server.orm_wrapper import OrmWrapper
+
+        netloc = KnowledgeServer.this_knowledge_server().netloc
+        OrmWrapper.clear_cache()
+        self.assertIs(OrmWrapper.load_class(netloc, "knowledge_server", "DataSet"), DataSet)
+        with self.assertNumQueries(0), self.assertNumQueries(0, using='materialized'):
+            for i in range(10):
+                self.assertIs(OrmWrapper.load_class(netloc, "knowledge_server", "DataSet"), DataSet)
+                OrmWrapper.get_model_container_name(netloc, "knowledge_server")
+        OrmWrapper.clear_cache()
+        self.assertEqual(OrmWrapper._resolved, {})
+        self.assertIs(OrmWrapper.load_class(netloc, "knowledge_server", "DataSet"), DataSet)
@@ -20,6 +20,7 @@ urlpatterns = [
     url( r'^dataset_types/$', api.api_dataset_types, name='api_dataset_types'),
     #52
     url( r'^dataset_info/$', api.api_dataset_info, name='api_dataset_info'),
+    url( r'^dataset_diff/$', api.api_dataset_diff, name='api_dataset_diff'),
     #80:
     url( r'^ks_info/$', api.api_ks_info, name='api_ks_info' ),
     #35
@@ -101,7 +101,7 @@ class KsUrl(object):
         if self.is_sintactically_correct:
             # I search the ks by netloc and scheme on materialized
             try:
-                self.knowledge_server = knowledge_server.models.KnowledgeServer.objects.using('materialized').get(scheme=self.scheme, netloc=self.netloc)
+                self.knowledge_server = knowledge_server.models.KnowledgeServer.get_current(scheme=self.scheme, netloc=self.netloc)
                 self.is_ks_known = True
             except:
                 self.is_ks_known = False
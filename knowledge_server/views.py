@@ -25,7 +25,7 @@ from django.views.decorators.csrf import csrf_exempt
 
 from knowledge_server.forms import ExploreOtherKSForm, UploadFileForm, ImportChoice, ImportChoiceNothingOnDB
 from knowledge_server.models import ApiResponse, DataSet, Event, KnowledgeServer, Notification, DataSetStructure
-from knowledge_server.models import NotificationReceived, SubscriptionToOther, SubscriptionToThis, UploadedFile
+from knowledge_server.models import NotificationReceived, ReleaseJob, SubscriptionToOther, SubscriptionToThis, UploadedFile
 from knowledge_server.utils import KsUrl
 
 logger = logging.getLogger(__name__)
@@ -172,12 +172,26 @@ def this_ks_unsubscribes_to(request, UKCL):
 @login_required
 def release_dataset(request, Dataset_UKCL):
     '''
+    the release is queued and run by a worker (manage.py release_worker); the content of the response
+    is the id of the ReleaseJob, see release_job_status
     '''
     try:
         Dataset_UKCL = urllib.parse.unquote(Dataset_UKCL)
         dataset = DataSet.objects.get(UKCL = Dataset_UKCL)
-        dataset.set_released()
-        return render(request, 'knowledge_server/export.json', {'json': ApiResponse(ApiResponse.success, Dataset_UKCL + " successfully released.").json()}, content_type="application/json")
+        job = ReleaseJob.enqueue(dataset)
+        return render(request, 'knowledge_server/export.json', {'json': ApiResponse(ApiResponse.success, Dataset_UKCL + " queued for release.", job.pk).json()}, content_type="application/json")
+    except Exception as ex:
+        return render(request, 'knowledge_server/export.json', {'json': ApiResponse(ApiResponse.failure, str(ex)).json()}, content_type="application/json")
+
+
+@login_required
+def release_job_status(request, job_id):
+    '''
+    the status of a ReleaseJob and the phases of the release it has gone through
+    '''
+    try:
+        job = ReleaseJob.objects.get(pk=job_id)
+        return render(request, 'knowledge_server/export.json', {'json': ApiResponse(ApiResponse.success, job.status, job.progress()).json()}, content_type="application/json")
     except Exception as ex:
         return render(request, 'knowledge_server/export.json', {'json': ApiResponse(ApiResponse.failure, str(ex)).json()}, content_type="application/json")
         
@@ -260,9 +274,9 @@ def upload_page(request):
         if form.is_valid( ):
             xml_uploaded = request.FILES[ 'file' ].read( )
             # http://stackoverflow.com/questions/3310614/remove-whitespaces-in-xml-string
+            # a single parse; the tree is used below and to show the file to the user
             p = etree.XMLParser( remove_blank_text=True )
-            elem = etree.XML( xml_uploaded, parser=p )
-            xml_uploaded = etree.tostring( elem )
+            xmldoc = etree.XML( xml_uploaded, parser=p )
 
             new_uploaded_file = UploadedFile( docfile=request.FILES[ 'file' ] )
             # we save it on disk so that we can process it after the user has told us which part to import and how to import it
@@ -275,39 +289,36 @@ def upload_page(request):
                 initial_data = {}
                 initial_data[ 'uploaded_file_id' ] = new_uploaded_file.id
                 initial_data[ 'new_uploaded_file_relpath' ] = new_uploaded_file.docfile.url
-                xmldoc = minidom.parseString( xml_uploaded )
-                URI = xmldoc.childNodes[ 0 ].attributes[ "DataSetStructureURI" ].firstChild.data
+                URI = xmldoc.attrib[ "DataSetStructureURI" ]
                 e = DataSetStructure.objects.get( URIInstance=URI )
+                child_node = xmldoc[ 0 ]
                 # I check that the first SimpleEntity is the same simple_entity of the DataSetStructure's entry_point
-                if e.entry_point.simple_entity.name != xmldoc.childNodes[ 0 ].childNodes[ 0 ].tagName:
+                if e.entry_point.simple_entity.name != child_node.tag:
                     message = "The DataSetStructure structure tells that the first SimpleEntity should be " + e.entry_point.simple_entity.name + " but the first TAG in the file is " + \
-                              xmldoc.childNodes[ 0 ].childNodes[ 0 ].tagName
+                              child_node.tag
                     raise Exception( message )
                 else:
                     # Is there a URIInstance of the first SimpleEntity;
                     try:
-                        simple_entity_uri_instance = xmldoc.childNodes[ 0 ].childNodes[ 0 ].attributes[
-                            "URIInstance" ].firstChild.data
+                        simple_entity_uri_instance = child_node.attrib[ "URIInstance" ]
                     except Exception as ex:
                         # if it's not in the file it means that the data in the file does not come from a KS
                         simple_entity_uri_instance = None
                     initial_data[ 'simple_entity_uri_instance' ] = simple_entity_uri_instance
                     try:
-                        initial_data[ 'simple_entity_name' ] = xmldoc.childNodes[ 0 ].childNodes[ 0 ].attributes[
-                            e.entry_point.simple_entity.name_field ].firstChild.data
+                        initial_data[ 'simple_entity_name' ] = child_node.attrib[ e.entry_point.simple_entity.name_field ]
                     except:
                         initial_data[ 'simple_entity_name' ] = None
                     try:
-                        initial_data[ 'simple_entity_description' ] = xmldoc.childNodes[ 0 ].childNodes[ 0 ].attributes[
-                            e.entry_point.simple_entity.description_field ].firstChild.data
+                        initial_data[ 'simple_entity_description' ] = child_node.attrib[
+                            e.entry_point.simple_entity.description_field ]
                     except:
                         initial_data[ 'simple_entity_description' ] = None
                     module_name = e.entry_point.simple_entity.module
-                    child_node = xmldoc.childNodes[ 0 ].childNodes[ 0 ]
-                    actual_class_name = module_name + ".models " + child_node.tagName
+                    actual_class_name = module_name + ".models " + child_node.tag
                     initial_data[ 'actual_class_name' ] = actual_class_name
                     module = importlib.import_module( module_name + ".models" )
-                    actual_class = getattr( module, child_node.tagName )
+                    actual_class = getattr( module, child_node.tag )
 #                    actual_class = utils.load_class( module_name + ".models", child_node.tagName )
                     try:
                         '''
@@ -336,7 +347,7 @@ def upload_page(request):
                         # should be to export, modify the newly exported file and import again; this last method would work
                         # the first wouldn't yield initial_data['simple_entity_on_db'] = None
                         initial_data[ 'simple_entity_on_db' ] = None
-                    initial_data[ 'prettyxml' ] = xmldoc.toprettyxml( indent="    " )
+                    initial_data[ 'prettyxml' ] = etree.tostring( xmldoc, pretty_print=True, encoding="unicode" )
                     initial_data[ 'file' ] = request.FILES[ 'file' ]
                     initial_data[ 'new_uploaded_file' ] = new_uploaded_file
                     if initial_data[ 'simple_entity_on_db' ] is None:
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('licenses', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='license',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+    ]
@@ -191,3 +191,25 @@ if not DEBUG:
             'LOCATION': '/var/tmp/oks_cache/root_beta',
             }
       }
+
+# serialized fragments of released datasets, see knowledge_server/caches.py
+KS_FRAGMENT_CACHE = {
+    'CACHE_ALIAS': 'default',
+    'MAX_ENTRIES': 10000,
+    'MAX_FRAGMENT_SIZE': 1024 * 1024,
+    'TIMEOUT': 60 * 60 * 24 * 7,
+}
+
+# responses of the API rendered when a dataset is released, see knowledge_server/artifacts.py
+KS_ARTIFACTS = {
+    'ROOT': '/var/tmp/oks_artifacts',
+    # None: served by Django; 'X-Accel-Redirect' (nginx with an internal location INTERNAL_URL aliased to ROOT) or 'X-Sendfile'
+    'SERVE_WITH': None,
+    'INTERNAL_URL': '/oks_artifacts/',
+}
+
+# import of datasets, see knowledge_server/importer.py
+KS_IMPORT = {
+    # True: instances are written with bulk_create, each ActualInstance is kept in memory while importing it
+    'BULK': False,
+}
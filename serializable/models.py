@@ -17,49 +17,67 @@ logger = logging.getLogger(__name__)
 class SerializableModel(models.Model):
     types_serialized_as_tags = ["CharField"]
     is_a_placeholder = models.BooleanField(default=False, db_column='oks_internals_placeholder', db_index=True)
+    '''
+    The lists of attributes below depend only on the class; they are computed once per class
+    (and parent_class) and kept here; a copy is returned so that callers can modify it
+    '''
+    _class_attributes = {}
+
+    @classmethod
+    def _memoized(cls, name, compute):
+        key = (cls, name)
+        if not key in SerializableModel._class_attributes:
+            SerializableModel._class_attributes[key] = compute()
+        return SerializableModel._class_attributes[key]
 
     def generic_content_types_attributes(self):
         '''
         see documentation for GenericForeignKey
         ''' 
-        attributes = []
-        for key in self._meta.virtual_fields:
-            attributes.append(key.ct_field)
-        return attributes
+        return list(self._memoized("generic_content_types_attributes",
+                                   lambda: list(key.ct_field for key in self._meta.virtual_fields)))
                 
     def generic_foreign_key_attributes(self):
         '''
         see documentation for GenericForeignKey
         ''' 
-        attributes = []
-        for key in self._meta.virtual_fields:
-            attributes.append((key.name, key.ct_field, key.fk_field))
-        return attributes
+        return list(self._memoized("generic_foreign_key_attributes",
+                                   lambda: list((key.name, key.ct_field, key.fk_field) for key in self._meta.virtual_fields)))
                 
     def foreign_key_attributes(self): 
-        attributes = []
-        # I must exclude each generic content types for GenericForeignKey
-        generic = self.generic_content_types_attributes()
-        for key in self._meta.fields:
-            if key.__class__.__name__ == "ForeignKey" and (not key.name in generic):
-                attributes.append(key.name)
-        return attributes
+        def compute():
+            attributes = []
+            # I must exclude each generic content types for GenericForeignKey
+            generic = self.generic_content_types_attributes()
+            for key in self._meta.fields:
+                if key.__class__.__name__ == "ForeignKey" and (not key.name in generic):
+                    attributes.append(key.name)
+            return attributes
+        return list(self._memoized("foreign_key_attributes", compute))
                 
     def many_to_many_attributes(self): 
-        attributes = []
-        for key in self._meta.many_to_many:
-            if key.__class__.__name__ == "ManyToManyField":
-                attributes.append(key.name)
-        return attributes
+        return list(self._memoized("many_to_many_attributes",
+                                   lambda: list(key.name for key in self._meta.many_to_many if key.__class__.__name__ == "ManyToManyField")))
                 
     def virtual_field_attributes(self): 
         '''
         see documentation for GenericForeignKey
         ''' 
-        attributes = []
-        for key in self._meta.virtual_fields:
-                attributes.append(key.name)
-        return attributes
+        return list(self._memoized("virtual_field_attributes",
+                                   lambda: list(key.name for key in self._meta.virtual_fields)))
+
+    def serializable_fields(self, parent_class=None):
+        '''
+        the fields that are serialized by serialized_tags and serialized_attributes (all but ForeignKey)
+        as a list of tuples (name, is_serialized_as_tag); a field of the parent_class is never serialized as tag
+        '''
+        def compute():
+            parent_class_attributes = []
+            if parent_class:
+                parent_class_attributes = list(key.name for key in parent_class._meta.fields)
+            return list((key.name, key.__class__.__name__ in SerializableModel.types_serialized_as_tags and (not key.name in parent_class_attributes))
+                        for key in self._meta.fields if key.__class__.__name__ != "ForeignKey")
+        return list(self._memoized(("serializable_fields", parent_class), compute))
                 
     def serialized_tags(self, parent_class=None):
         '''
@@ -74,19 +92,14 @@ class SerializableModel(models.Model):
         ###########################################################################
         '''
         attributes = ""
-        parent_class_attributes = []
-        if parent_class:
-            parent_class_attributes = list(key.name for key in parent_class._meta.fields)
-        
-        for key in self._meta.fields: 
-            if key.__class__.__name__ != "ForeignKey":
-                value = getattr(self, key.name)
+        for name, as_tag in self.serializable_fields(parent_class):
+            # if it is an instance of a class that has to be serialized as tags and it is not an 
+            # attribute of the parent_class I serialize it as a tag with CDATA
+            if as_tag:
+                value = getattr(self, name)
                 if value is None:
                     value = ""
-                # if it is an instance of a class that has to be serialized as tags and it is not an 
-                # attribute of the parent_class I serialize it as a tag with CDATA
-                if key.__class__.__name__ in SerializableModel.types_serialized_as_tags and (not key.name in parent_class_attributes):
-                    attributes += '<' + key.name + '><![CDATA[' + str(value) + ']]></' + key.name + '>'
+                attributes += '<' + name + '><![CDATA[' + str(value) + ']]></' + name + '>'
         return attributes
     
     def serialized_attributes(self, parent_class=None, format='XML'):
@@ -99,30 +112,25 @@ class SerializableModel(models.Model):
         attributes = ""
         comma = ""
         tmp_dict = {}
-        parent_class_attributes = []
-        if parent_class:
-            parent_class_attributes = list(key.name for key in parent_class._meta.fields)
-        
-        for key in self._meta.fields: 
-            if key.__class__.__name__ != "ForeignKey":
-                value = getattr(self, key.name)
-                if value is None:
-                    pass # I do not export an attribute that can be None/null
-                elif format == 'XML':
-                    # if it is an instance of a class that has to be serialized as tags I do not serialize it
-                    # as attribute unless it is an attribute of the parent_class ( that is a normally 
-                    # ShareableModel class whose attributes should not contain characters that need to be
-                    # put into CDATA tags ) 
-                    if (not key.__class__.__name__ in SerializableModel.types_serialized_as_tags) or key.name in parent_class_attributes:
-                        attributes += ' ' + key.name + '="' + str(value) + '"'  
-                elif format == 'JSON':
-                    attributes += comma + '"' + key.name + '" : "' + str(value) + '"'
-                    comma = ", "
-                elif format == 'DICT':
-                    tmp_dict[key.name] = value
-                elif format == 'HTML':
-                    attributes += comma + key.name + ' : "' + str(value) + '"'
-                    comma = "<br>"
+        for name, as_tag in self.serializable_fields(parent_class):
+            value = getattr(self, name)
+            if value is None:
+                pass # I do not export an attribute that can be None/null
+            elif format == 'XML':
+                # if it is an instance of a class that has to be serialized as tags I do not serialize it
+                # as attribute unless it is an attribute of the parent_class ( that is a normally 
+                # ShareableModel class whose attributes should not contain characters that need to be
+                # put into CDATA tags ) 
+                if not as_tag:
+                    attributes += ' ' + name + '="' + str(value) + '"'  
+            elif format == 'JSON':
+                attributes += comma + '"' + name + '" : "' + str(value) + '"'
+                comma = ", "
+            elif format == 'DICT':
+                tmp_dict[name] = value
+            elif format == 'HTML':
+                attributes += comma + name + ' : "' + str(value) + '"'
+                comma = "<br>"
         if format == 'DICT':
             return tmp_dict
         else:
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('test1', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='continent',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='province',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='region',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='state',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='subcontinent',
+            name='materialized_build',
+            field=models.BigIntegerField(db_column='oks_internals_build', db_index=True, default=0),
+        ),
+    ]
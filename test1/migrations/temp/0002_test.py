@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 
 from django.db import models, migrations
 from knowledge_server.models import Organization, KnowledgeServer, DataSet, DataSetStructure, StructureNode, ModelMetadata
+from knowledge_server.models import DataMigration
 from test1.models import Continent, SubContinent, State, Region, Province
 from knowledge_server.utils import KsUrl
 
@@ -64,12 +65,12 @@ def forwards_func(apps, schema_editor):
 class Migration(migrations.Migration):
 
     dependencies = [
-        ('test1', '0001_initial'),
+        ('test1', '0003_content_hash'),
     ]
 
     operations = [
         migrations.RunPython(
-            forwards_func,
+            DataMigration.after_migrate(forwards_func),
         ),
     ]
 